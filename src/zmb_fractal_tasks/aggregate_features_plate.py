@@ -0,0 +1,217 @@
+"""Fractal task to aggregate feature tables of images per well or condition."""
+
+import logging
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Literal, Optional
+
+import numpy as np
+import pandas as pd
+from ngio import open_ome_zarr_container
+from pydantic import validate_call
+
+from zmb_fractal_tasks.utils.aggregation import GroupedStats
+from zmb_fractal_tasks.utils.plate_scan import parse_zarr_url, plate_name, well_name
+
+
+@validate_call
+def aggregate_features_plate(
+    *,
+    zarr_urls: list[str],
+    zarr_dir: str,
+    input_table_name: str,
+    output_table_name: Optional[str] = None,
+    group_by: Sequence[Literal["plate", "well", "condition"]] = ("plate", "well"),
+    features_to_aggregate: Optional[Sequence[str]] = None,
+    aggregation_methods: Sequence[
+        Literal["sum", "mean", "std", "sem", "min", "max"]
+    ] = ("mean", "std"),
+    plate_layout_path: Optional[str] = None,
+    max_workers: int = 8,
+) -> None:
+    r"""Aggregate a feature table of all images per well or condition.
+
+    The feature tables of all images are read concurrently and reduced to
+    per-group statistics, which are merged across images. Only the compact
+    aggregated table is written to {zarr_dir}/{output_table_name}.csv, with
+    one row per group.
+
+    Args:
+        zarr_urls: List of paths or urls to the individual OME-Zarr images to
+            be processed.
+            (Standard argument for Fractal tasks, managed by Fractal server).
+        zarr_dir: Aggregated table will be exported to
+            {zarr_dir}/{output_table_name}.csv
+            (Standard argument for Fractal tasks, managed by Fractal server).
+        input_table_name: Name of the feature table to aggregate (e.g.
+            `nuclei_features`).
+        output_table_name: Name of the output table. If left empty,
+            `{input_table_name}_aggregated` is used.
+        group_by: Columns to group objects by. `condition` requires a
+            plate_layout_path.
+        features_to_aggregate: List of feature names (columns in the feature
+            table) to aggregate. If left empty, all numeric features of the
+            first table are aggregated (features missing in other tables
+            count as missing values).
+        aggregation_methods: List of aggregation methods to use for each
+            feature. A count of objects per group is always added
+            automatically.
+        plate_layout_path: Path to a CSV file containing plate layout
+            information. Column names should be non-zero-padded numbers
+            (e.g., 1, 2, 3, not 01, 02, 03). It should have the following
+            format:
+            , 1, 2, 3, ...
+            A, conditionA1, conditionA2, conditionA3, ...
+            B, conditionB1, conditionB2, conditionB3, ...
+            ...
+        max_workers: Number of feature tables read concurrently.
+    """
+    group_by = list(group_by)
+    if "condition" in group_by and not plate_layout_path:
+        raise ValueError("Grouping by condition requires a plate_layout_path.")
+
+    plate_layout = None
+    if plate_layout_path:
+        logging.info(f"loading plate layout from {plate_layout_path}")
+        plate_layout = pd.read_csv(
+            plate_layout_path,
+            header=0,
+            index_col=0,
+        )
+
+    if output_table_name is None:
+        output_table_name = f"{input_table_name}_aggregated"
+
+    # columns added from the image url, which are never aggregated
+    plate_columns = ["plate", "well", "condition"]
+
+    def _load_table(zarr_url: str) -> Optional[pd.DataFrame]:
+        ome_zarr_container = open_ome_zarr_container(zarr_url)
+        if input_table_name not in ome_zarr_container.list_tables():
+            logging.warning(f"Table {input_table_name} not found in {zarr_url}.")
+            return None
+        table_df = ome_zarr_container.get_table(input_table_name).dataframe
+        table_df = add_plate_columns(table_df, zarr_url, plate_layout)
+        if table_df[group_by].isna().any(axis=None):
+            # objects with missing group keys would be dropped silently
+            raise ValueError(
+                f"Image {zarr_url} is not part of a plate, so its objects "
+                f"can't be grouped by {group_by}."
+            )
+        return table_df
+
+    def _reduce(zarr_url: str, table_df: pd.DataFrame) -> GroupedStats:
+        # all images are reduced to the same features, so they can be merged
+        missing = [feature for feature in features if feature not in table_df]
+        if missing:
+            logging.warning(
+                f"Features {missing} not found in {input_table_name} of "
+                f"{zarr_url}; they are aggregated as missing values."
+            )
+            table_df = table_df.assign(**dict.fromkeys(missing, np.nan))
+        if features_to_aggregate is None:
+            extra = set(numeric_features(table_df, plate_columns)) - set(features)
+            if extra:
+                logging.warning(
+                    f"Features {sorted(extra)} of {zarr_url} are not in the first "
+                    f"{input_table_name} table and are not aggregated."
+                )
+        return GroupedStats.from_dataframe(table_df, by=group_by, columns=features)
+
+    def _image_stats(zarr_url: str) -> Optional[GroupedStats]:
+        table_df = _load_table(zarr_url)
+        if table_df is None:
+            return None
+        return _reduce(zarr_url, table_df)
+
+    logging.info(f"Aggregating table {input_table_name} of {len(zarr_urls)} images")
+    stats = None
+    remaining_urls = list(zarr_urls)
+    if features_to_aggregate is None:
+        # the features are chosen once, from the first table
+        while remaining_urls and stats is None:
+            zarr_url = remaining_urls.pop(0)
+            table_df = _load_table(zarr_url)
+            if table_df is not None:
+                features = numeric_features(table_df, plate_columns)
+                stats = _reduce(zarr_url, table_df)
+    else:
+        features = list(features_to_aggregate)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_image_stats, url) for url in remaining_urls]
+        for future in as_completed(futures):
+            image_stats = future.result()
+            if image_stats is None:
+                continue
+            stats = image_stats if stats is None else stats.merge(image_stats)
+
+    if stats is None:
+        raise ValueError(f"Table {input_table_name} not found in any image.")
+
+    df = aggregated_stats_to_dataframe(stats, aggregation_methods)
+
+    logging.info(
+        f"Exporting table {output_table_name} to {zarr_dir}/{output_table_name}.csv"
+    )
+    output_path = Path(zarr_dir) / f"{output_table_name}.csv"
+    df.to_csv(output_path, index=False)
+
+
+def add_plate_columns(
+    table_df: pd.DataFrame,
+    zarr_url: str,
+    plate_layout: Optional[pd.DataFrame] = None,
+) -> pd.DataFrame:
+    """Add (or overwrite) plate, well and condition columns of a table.
+
+    For an image that isn't part of a plate, plate and well are None.
+
+    Args:
+        table_df: Feature table of a single image.
+        zarr_url: Path or url to the OME-Zarr image of the table.
+        plate_layout: Optional plate layout (rows x columns) with conditions.
+    """
+    table_df = table_df.copy()
+    plate_url, well_row, well_column = parse_zarr_url(zarr_url)
+    table_df["plate"] = plate_name(plate_url)
+    table_df["well"] = well_name(well_row, well_column)
+    if plate_layout is not None:
+        if plate_url is None:
+            raise ValueError(
+                f"Image {zarr_url} is not part of a plate, "
+                "so it has no condition in the plate layout."
+            )
+        table_df["condition"] = plate_layout.loc[well_row, str(well_column)]
+    return table_df
+
+
+def numeric_features(table_df: pd.DataFrame, exclude: Sequence[str] = ()) -> list[str]:
+    """Names of the numeric columns of a table (except the excluded ones)."""
+    columns = table_df.select_dtypes(include=[np.number]).columns
+    return [column for column in columns if column not in exclude]
+
+
+def aggregated_stats_to_dataframe(
+    stats: GroupedStats,
+    aggregation_methods: Sequence[str],
+) -> pd.DataFrame:
+    """Convert grouped statistics to a table with one row per group.
+
+    Args:
+        stats: Grouped statistics.
+        aggregation_methods: Aggregation methods to include for each feature.
+    """
+    columns = {"count": stats.size}
+    values = {method: stats.get(method) for method in aggregation_methods}
+    for i, feature in enumerate(stats.columns):
+        for method in aggregation_methods:
+            columns[f"{feature}_{method}"] = values[method][:, i]
+    df = pd.DataFrame(columns, index=stats.keys)
+    return df.reset_index()
+
+
+if __name__ == "__main__":
+    from fractal_task_tools.task_wrapper import run_fractal_task
+
+    run_fractal_task(task_function=aggregate_features_plate)
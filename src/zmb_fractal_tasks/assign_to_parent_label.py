@@ -13,6 +13,8 @@ from ngio.tables import FeatureTable
 from ngio.transforms import ZoomTransform
 from pydantic import BaseModel, validate_call
 
+from zmb_fractal_tasks.utils.aggregation import grouped_aggregate
+from zmb_fractal_tasks.utils.pyramid import update_stale_pyramid
 from zmb_fractal_tasks.utils.regionprops_table_plus import regionprops_table_plus
 
 
@@ -116,6 +118,8 @@ def assign_to_parent_label(
         )
         for parent_label in parent_labels
     }
+    for label_image in [seed_label_image, *parent_label_images.values()]:
+        update_stale_pyramid(label_image)
 
     # find plate and well names
     plate_name = Path(Path(zarr_url).as_posix().split(".zarr/")[0]).stem
@@ -346,14 +350,23 @@ def aggregate_features(
     # If no features specified, aggregate all numeric columns
     if features_to_aggregate is None:
         features_to_aggregate = seed_df.select_dtypes(include=[np.number]).columns
-
-    # perform aggregation
-    group = seed_df.groupby(by=parent_label_name + "_ID")
-    agg_dict = {f"{seed_label_name}_count": (features_to_aggregate[0], "count")}
+    features_to_aggregate = list(features_to_aggregate)
+
+    # perform aggregation (sorts once by parent ID & reduces all features
+    # together, instead of one pandas aggregation per feature & method)
+    aggregated = grouped_aggregate(
+        seed_df,
+        by=parent_label_name + "_ID",
+        columns=features_to_aggregate,
+        methods=["count", *aggregation_methods],
+    )
+    agg_dict = {
+        f"{seed_label_name}_count": aggregated[(features_to_aggregate[0], "count")]
+    }
     for feature in features_to_aggregate:
         for agg in aggregation_methods:
-            agg_dict[f"{seed_label_name}_{feature}_{agg}"] = (feature, agg)
-    seed_df_agg = group.agg(**agg_dict)
+            agg_dict[f"{seed_label_name}_{feature}_{agg}"] = aggregated[(feature, agg)]
+    seed_df_agg = pd.DataFrame(agg_dict)
     seed_df_agg.index.name = "label"
 
     # combine with parent df if provided
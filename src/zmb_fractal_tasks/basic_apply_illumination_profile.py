@@ -1,13 +1,23 @@
 """Fractal task to apply illumination profiles calculated by BaSiC."""
 
 import logging
+import threading
+from collections.abc import Sequence
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
 import numpy as np
-from ngio import open_ome_zarr_container
+from ngio import Roi, open_ome_zarr_container
+from ngio.images import Image
 from pydantic import BaseModel, validate_call
 
+from zmb_fractal_tasks.utils.illumination_profiles import (
+    IlluminationProfile,
+    load_illumination_profile,
+)
+from zmb_fractal_tasks.utils.parallel import bounded_map
+from zmb_fractal_tasks.utils.pyramid import DirtyRegions
+
 
 class InitArgsBaSiCApply(BaseModel):
     """Init Args for basic_apply_illumination_profile task.
@@ -33,7 +43,10 @@ def basic_apply_illumination_profile(
     *,
     zarr_url: str,
     init_args: InitArgsBaSiCApply,
-
+    # Advanced parameters
+    defer_consolidation: bool = False,
+    # Parallelization
+    max_workers: int = 1,
 ) -> dict[str, Any]:
     """Applies illumination correction to the OME-Zarr.
 
@@ -44,6 +57,13 @@ def basic_apply_illumination_profile(
         zarr_url: Absolute path to the OME-Zarr image.
             (standard argument for Fractal tasks, managed by Fractal server).
         init_args: Initialization arguments from the init task.
+        defer_consolidation: If `True`, the pyramid levels of the output
+            image are not updated, but only marked as stale. They are built
+            later from level 0 (e.g. by the 'Build pyramids' task, or by a
+            task reading a coarser level). Useful if several tasks write to
+            the image in a row.
+        max_workers: Number of FOVs read & corrected concurrently (across all
+            channels), while the corrected FOVs are written.
     """
     omezarr = open_ome_zarr_container(zarr_url)
 
@@ -67,32 +87,32 @@ def basic_apply_illumination_profile(
     # TODO: handle case where no channel names are available?
     channels = source_image.wavelength_ids
 
-    # Process each channel & FOV
+    # Load illumination profiles of each channel
+    corrections = {}
     for channel in channels:
         # load illumination profiles
         channel_idx = source_image.wavelength_ids.index(channel)
         folder_path = Path(init_args.illumination_profiles_folder) / channel
-        flatfield = np.load(folder_path / "flatfield.npy")
-        darkfield = np.load(folder_path / "darkfield.npy")
+        profile = load_illumination_profile(folder_path)
         if init_args.subtract_median_baseline:
-            baseline_array = np.load(folder_path / "baseline.npy")
-            baseline = int(np.median(baseline_array))
+            baseline = int(np.median(profile.baseline))
         else:
             baseline = 0
-        # Correct each FOV
-        for roi in roi_table.rois():
-            patch = source_image.get_roi(
-                roi, c=channel_idx, axes_order=["c", "z", "y", "x"]
-            )
-            patch_corrected = correct(patch, flatfield, darkfield, baseline)
-            output_image.set_roi(
-                patch=patch_corrected,
-                roi=roi,
-                c=channel_idx,
-                axes_order=["c", "z", "y", "x"],
-            )
+        corrections[channel_idx] = IlluminationCorrection.from_profile(
+            profile, baseline
+        )
+
+    # Correct each channel & FOV
+    dirty_regions = apply_illumination_corrections(
+        source_image,
+        output_image,
+        roi_table.rois(),
+        corrections,
+        max_workers=max_workers,
+    )
 
-    output_image.consolidate()
+    # Update the pyramid where the image was corrected
+    dirty_regions.consolidate(defer=defer_consolidation)
 
     if init_args.overwrite_input_image:
         image_list_updates = {"image_list_updates": [{"zarr_url": zarr_url}]}
@@ -103,6 +123,146 @@ def basic_apply_illumination_profile(
     return image_list_updates
 
 
+def apply_illumination_corrections(
+    source_image: Image,
+    output_image: Image,
+    rois: Sequence[Roi],
+    corrections: dict[int, "IlluminationCorrection"],
+    max_workers: int = 1,
+) -> DirtyRegions:
+    """Correct all ROIs of all channels of an image.
+
+    Reading & correcting runs in a thread pool, while the main thread writes
+    the corrected ROIs. At most 2 * max_workers ROIs are in memory.
+
+    Args:
+        source_image: Image to correct.
+        output_image: Image to write the corrected ROIs to (can be the same as
+            source_image).
+        rois: ROIs (e.g. FOVs) to correct.
+        corrections: Illumination correction for each channel index.
+        max_workers: Number of ROIs read & corrected concurrently.
+
+    Returns:
+        The regions of output_image that were written.
+    """
+    dirty_regions = DirtyRegions(output_image)
+    tasks = [(c, roi) for c in corrections for roi in rois]
+
+    def _correct_roi(task):
+        channel_idx, roi = task
+        patch = source_image.get_roi(roi, c=channel_idx, axes_order="czyx")
+        return corrections[channel_idx](patch, out=patch)
+
+    corrected_patches = bounded_map(_correct_roi, tasks, max_workers=max_workers)
+    for (channel_idx, roi), patch in zip(tasks, corrected_patches, strict=True):
+        output_image.set_roi(patch=patch, roi=roi, c=channel_idx, axes_order="czyx")
+        dirty_regions.add_roi(roi, c=channel_idx)
+    return dirty_regions
+
+
+class IlluminationCorrection:
+    """Illumination correction of images with the profile of one channel.
+
+    The reciprocal of the flatfield is computed once (or loaded from the
+    profile store), so that images can be corrected with a single fused
+    float32 pass: subtract darkfield, multiply by 1/flatfield, subtract
+    baseline, clip & round, all in place in a work buffer that is reused
+    between images of the same shape (per thread).
+    """
+
+    def __init__(
+        self,
+        flatfield: np.ndarray,
+        darkfield: Optional[np.ndarray] = None,
+        baseline: int = 0,
+    ):
+        """Precompute the correction of a channel.
+
+        Args:
+            flatfield: 2D numpy array (yx)
+            darkfield: 2D numpy array (yx), or None if there is no darkfield
+            baseline: baseline value to be subtracted from the image
+        """
+        profile = IlluminationProfile.from_arrays(flatfield, darkfield)
+        self._set_profile(profile, baseline)
+
+    @classmethod
+    def from_profile(
+        cls, profile: IlluminationProfile, baseline: int = 0
+    ) -> "IlluminationCorrection":
+        """Create the correction from a (loaded) illumination profile.
+
+        The arrays of the profile are used as they are (e.g. memory-mapped).
+
+        Args:
+            profile: Illumination profile of the channel.
+            baseline: baseline value to be subtracted from the image
+        """
+        correction = cls.__new__(cls)
+        correction._set_profile(profile, baseline)
+        return correction
+
+    def _set_profile(self, profile: IlluminationProfile, baseline: int) -> None:
+        self.inv_flatfield = profile.inv_flatfield
+        # None, if there is no darkfield (the subtraction is skipped)
+        self.darkfield = profile.darkfield
+        self.baseline = baseline
+        # work buffers are reused per thread
+        self._local = threading.local()
+
+    def __call__(
+        self,
+        img: np.ndarray,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Apply illumination correction to an image.
+
+        Args:
+            img: 4D numpy array (czyx), with dummy size along c.
+            out: Optional output array with the shape & dtype of img. Can be
+                img itself.
+        """
+        # Check shapes
+        if self.inv_flatfield.shape != img.shape[2:] or img.shape[0] != 1:
+            raise ValueError(
+                "Error in illumination_correction:\n"
+                f"{img.shape=}\n{self.inv_flatfield.shape=}"
+            )
+        if out is None:
+            out = np.empty_like(img)
+        dtype_max = np.iinfo(img.dtype).max
+
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or buffer.shape != img.shape:
+            buffer = self._local.buffer = np.empty(img.shape, dtype=np.float32)
+
+        if self.darkfield is not None:
+            np.subtract(img, self.darkfield, out=buffer)
+            np.multiply(buffer, self.inv_flatfield, out=buffer)
+        else:
+            np.multiply(img, self.inv_flatfield, out=buffer)
+
+        # Background subtraction (negative values are clipped below)
+        if self.baseline != 0:
+            np.subtract(buffer, self.baseline, out=buffer)
+
+        # Handle edge case: corrected image may have values beyond the limit of
+        # the encoding, e.g. beyond 65535 for 16bit images. This clips values
+        # that surpass this limit and triggers a warning
+        if buffer.max() > dtype_max:
+            logging.warning(
+                "Illumination correction created values beyond the max range of "
+                f"the current image type. These have been clipped to {dtype_max=}."
+            )
+        np.clip(buffer, 0, dtype_max, out=buffer)
+        np.rint(buffer, out=buffer)
+
+        # Cast back to original dtype
+        np.copyto(out, buffer, casting="unsafe")
+        return out
+
+
 def correct(
     img: np.ndarray,
     flatfield: np.ndarray,
@@ -112,7 +272,8 @@ def correct(
     """Apply illumination correction to an image.
 
     Corrects an image, using a given illumination profile (e.g. bright
-    in the center of the image, dim outside).
+    in the center of the image, dim outside). To correct many images with the
+    same profile, use `IlluminationCorrection` directly.
 
     Args:
         img: 4D numpy array (czyx), with dummy size along c.
@@ -120,40 +281,7 @@ def correct(
         darkfield: 2D numpy array (yx)
         baseline: baseline value to be subtracted from the image
     """
-    # Check shapes
-    if flatfield.shape != img.shape[2:] or img.shape[0] != 1:
-        raise ValueError(
-            f"Error in illumination_correction:\n{img.shape=}\n{flatfield.shape=}"
-        )
-
-    # Store info about dtype
-    dtype = img.dtype
-    dtype_max = np.iinfo(dtype).max
-
-    #  Apply the normalized correction matrix (requires a float array)
-    # img_stack = img_stack.astype(np.float64)
-    new_img = (img - darkfield) / flatfield
-
-    # Background subtraction
-    if baseline != 0:
-        new_img = np.where(
-            new_img > baseline,
-            new_img - baseline,
-            0,
-        )
-
-    # Handle edge case: corrected image may have values beyond the limit of
-    # the encoding, e.g. beyond 65535 for 16bit images. This clips values
-    # that surpass this limit and triggers a warning
-    if np.sum(new_img > dtype_max) > 0:
-        logging.warning(
-            "Illumination correction created values beyond the max range of "
-            f"the current image type. These have been clipped to {dtype_max=}."
-        )
-        new_img[new_img > dtype_max] = dtype_max
-
-    # Cast back to original dtype and return
-    return new_img.astype(dtype)
+    return IlluminationCorrection(flatfield, darkfield, baseline)(img)
 
 
 if __name__ == "__main__":
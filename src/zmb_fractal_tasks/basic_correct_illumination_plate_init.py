@@ -1,18 +1,33 @@
 """Fractal task to perform illumination correction for a plate using BaSiC."""
 
 import logging
+import multiprocessing
 import os
 import random
 import shutil
+from collections.abc import Sequence
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Any, Literal, Optional
 
-import dask.array as da
 import numpy as np
+import torch
+import torch.nn.functional as F
 from basicpy import BaSiC
-from ngio import open_ome_zarr_container
+from ngio.images import Image
 from pydantic import BaseModel, Field, validate_call
 
+from zmb_fractal_tasks.utils.halo import roi_halo_slices
+from zmb_fractal_tasks.utils.illumination_profiles import save_illumination_profile
+from zmb_fractal_tasks.utils.parallel import bounded_map
+from zmb_fractal_tasks.utils.plate_scan import ImageInfo, scan_images
+
 
 class OutputOptions(BaseModel):
     """Options for output
@@ -84,6 +99,11 @@ class AdvancedBaSiCParameters(BaseModel):
         sparse_cost_darkfield: Weight of the darkfield sparse term in the
             Lagrangian.
         working_size: Size for running computations. None means no rescaling.
+        downsample_while_loading: If True, the sampled images are downsampled
+            to working_size while they are loaded (the same way BaSiC does it
+            internally), so the full resolution images are never held in
+            memory together. The profiles are upsampled to the full image size
+            afterwards.
     """
 
     epsilon: float = 0.1
@@ -101,6 +121,7 @@ class AdvancedBaSiCParameters(BaseModel):
     sort_intensity: bool = False
     sparse_cost_darkfield: float = 0.01
     working_size: int = 128
+    downsample_while_loading: bool = True
 
 
 @validate_call
@@ -112,6 +133,9 @@ def basic_correct_illumination_plate_init(
     output_options: OutputOptions = OutputOptions(),  # noqa: B008
     core_basic_parameters: CoreBaSiCParameters = CoreBaSiCParameters(),  # noqa: B008
     advanced_basic_parameters: AdvancedBaSiCParameters = AdvancedBaSiCParameters(),  # noqa: B008
+    # Parallelization
+    max_workers: int = 1,
+    max_processes: int = 1,
 ) -> dict[str, Any]:
     """Calculate illumination profiles and correct channels using BaSiC.
 
@@ -138,6 +162,11 @@ def basic_correct_illumination_plate_init(
         advanced_basic_parameters (AdvancedBaSiCParameters): Advanced
             parameters for BaSiC illumination correction.
             See https://basicpy.readthedocs.io/en/latest/api.html
+        max_workers (int): Number of images loaded concurrently.
+        max_processes (int): Number of channels fitted concurrently, each in
+            a separate process. The images of the next channel are loaded
+            while the fits are running. If 0, the channels are fitted one
+            after another in the task process.
     """
     # Set illumination profiles folder
     illumination_profiles_folder = str(
@@ -148,102 +177,81 @@ def basic_correct_illumination_plate_init(
 
     logging.info(f"Processing {len(zarr_urls)} images")
 
-    omezarrs = [open_ome_zarr_container(zarr_url) for zarr_url in zarr_urls]
-    ngio_images = [omezarr.get_image() for omezarr in omezarrs]
+    # read the metadata of all images once
+    image_infos = scan_images(zarr_urls, tables=["FOV_ROI_table"])
 
     # check if all FOVs have the same dimensions
     roi_dims = []
-    for omezarr in omezarrs:
-        roi_table = omezarr.get_table("FOV_ROI_table")
-        for roi in roi_table.rois():
+    for image_info in image_infos:
+        for roi in image_info.tables["FOV_ROI_table"].rois():
             roi_dims.append((roi.z_length, roi.y_length, roi.x_length))
 
     if not all(dim == roi_dims[0] for dim in roi_dims):
         raise ValueError("FOVs have differing dimensions")
 
     # get list of all channels
-    wavelength_ids = [ngio_image.wavelength_ids for ngio_image in ngio_images]
+    wavelength_ids = [image_info.wavelength_ids for image_info in image_infos]
     wavelength_ids = {wlid for sublist in wavelength_ids for wlid in sublist}
     logging.info(f"Processing {len(wavelength_ids)} channels: {wavelength_ids}")
 
-    # process each channel
-    basic_dict = {}
-    for i, channel in enumerate(wavelength_ids):
-        logging.info(f"Processing channel {i}/{len(wavelength_ids)}: {channel}")
-        fov_data_all = []
-        for omezarr in omezarrs:
-            ngio_image = omezarr.get_image()
-            if channel in ngio_image.wavelength_ids:
-                channel_idx = ngio_image.wavelength_ids.index(channel)
-                roi_table = omezarr.get_table("FOV_ROI_table")
-                for roi in roi_table.rois():
-                    roi_data = ngio_image.get_roi(
-                        roi, axes_order=["c", "z", "y", "x"], c=channel_idx, mode="dask"
-                    )
-                    fov_data_all.append(roi_data)
-        if len(fov_data_all) >= core_basic_parameters.n_images_sampled:
-            logging.info(
-                f"Using {core_basic_parameters.n_images_sampled} random images out of"
-                + f" {len(fov_data_all)}."
-            )
-            fov_data_sample = random.sample(
-                fov_data_all, core_basic_parameters.n_images_sampled
-            )
-        else:
-            logging.warning(
-                f"{core_basic_parameters.n_images_sampled} images requested, but only"
-                + f" {len(fov_data_all)} available. "
-                + f"Using all {len(fov_data_all)} images."
-            )
-            fov_data_sample = fov_data_all
-        if fov_data_sample[0].shape[1] > 1:
-            # take random slice along z-axis
-            logging.info("Image is z-stack, taking random slices along z-axis.")
-            fov_data_sample = [
-                img[0, random.randint(0, img.shape[1] - 1), ...]
-                for img in fov_data_sample
-            ]
-        else:
-            fov_data_sample = [img[0, 0, ...] for img in fov_data_sample]
-        logging.info("Loading data...")
-        basic_data = da.stack(fov_data_sample).compute()
-
-        # calculate illumination correction profile
-        logging.info("Calculating illumination correction profile...")
-        basic = BaSiC(
-            get_darkfield=core_basic_parameters.get_darkfield,
-            smoothness_flatfield=core_basic_parameters.smoothness_flatfield,
-            smoothness_darkfield=core_basic_parameters.smoothness_darkfield,
-            epsilon=advanced_basic_parameters.epsilon,
-            fitting_mode=advanced_basic_parameters.fitting_mode,
-            max_iterations=advanced_basic_parameters.max_iterations,
-            max_mu_coef=advanced_basic_parameters.max_mu_coef,
-            max_reweight_iterations=advanced_basic_parameters.max_reweight_iterations,
-            max_reweight_iterations_baseline=advanced_basic_parameters.max_reweight_iterations_baseline,
-            mu_coef=advanced_basic_parameters.mu_coef,
-            optimization_tol=advanced_basic_parameters.optimization_tol,
-            optimization_tol_diff=advanced_basic_parameters.optimization_tol_diff,
-            reweighting_tol=advanced_basic_parameters.reweighting_tol,
-            resize_params=advanced_basic_parameters.resize_params,
-            rho=advanced_basic_parameters.rho,
-            sort_intensity=advanced_basic_parameters.sort_intensity,
-            sparse_cost_darkfield=advanced_basic_parameters.sparse_cost_darkfield,
-            working_size=advanced_basic_parameters.working_size,
+    # downsample the sampled images while loading them
+    if advanced_basic_parameters.downsample_while_loading:
+        working_size = advanced_basic_parameters.working_size
+    else:
+        working_size = None
+
+    # Channels are fitted in separate processes, while the samples of the next
+    # channel are loaded. Profiles are saved as soon as their fit finishes.
+    if max_processes > 0:
+        executor = ProcessPoolExecutor(
+            max_workers=max_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=torch.set_num_threads,
+            initargs=(max(1, (os.cpu_count() or 1) // max_processes),),
         )
-        basic.fit(basic_data)
+    else:
+        executor = None
 
-        # save illumination correction profile
-        logging.info("Saving illumination correction profile...")
+    def _save_profiles(channel, profiles):
+        logging.info(f"Saving illumination correction profile of {channel}...")
         folder_path = Path(illumination_profiles_folder) / f"{channel}"
         if output_options.overwrite_illumination_profiles:
             if os.path.isdir(folder_path):
                 shutil.rmtree(folder_path)
         folder_path.mkdir(parents=True, exist_ok=False)
-        # basic.save_model(model_dir=filename, overwrite=overwrite)
-        np.save(folder_path / "flatfield.npy", basic.flatfield)
-        np.save(folder_path / "darkfield.npy", basic.darkfield)
-        np.save(folder_path / "baseline.npy", basic.baseline)
-        basic_dict[channel] = basic
+        save_illumination_profile(folder_path, *profiles)
+
+    # process each channel
+    with executor or nullcontext():
+        pending = {}
+        for i, channel in enumerate(wavelength_ids):
+            logging.info(f"Processing channel {i}/{len(wavelength_ids)}: {channel}")
+            planes = sample_fov_planes(
+                image_infos, channel, core_basic_parameters.n_images_sampled
+            )
+            logging.info("Loading data...")
+            basic_data = load_fov_planes(
+                planes, working_size=working_size, max_workers=max_workers
+            )
+
+            # calculate illumination correction profile
+            logging.info("Calculating illumination correction profile...")
+            fit_args = (
+                basic_data,
+                _plane_shape(planes[0][1]),
+                core_basic_parameters,
+                advanced_basic_parameters,
+            )
+            if executor is None:
+                _save_profiles(channel, fit_basic_profiles(*fit_args))
+                continue
+            while len(pending) >= max_processes:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _save_profiles(pending.pop(future), future.result())
+            pending[executor.submit(fit_basic_profiles, *fit_args)] = channel
+        for future in as_completed(pending):
+            _save_profiles(pending[future], future.result())
 
     logging.info("Finished processing all channels.")
 
@@ -266,6 +274,178 @@ def basic_correct_illumination_plate_init(
     return {"parallelization_list": parallelization_list}
 
 
+def fit_basic_profiles(
+    basic_data: np.ndarray,
+    fov_shape: Sequence[int],
+    core_basic_parameters: CoreBaSiCParameters,
+    advanced_basic_parameters: AdvancedBaSiCParameters,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Fit BaSiC on the sampled planes of one channel.
+
+    Args:
+        basic_data: Planes from `load_fov_planes`, shape (n_planes, y, x).
+        fov_shape: Shape (y, x) of the FOVs. If basic_data was downsampled
+            while loading, the profiles are upsampled to this shape.
+        core_basic_parameters: Core parameters for BaSiC.
+        advanced_basic_parameters: Advanced parameters for BaSiC.
+
+    Returns:
+        Flatfield, darkfield & baseline.
+    """
+    basic = BaSiC(
+        get_darkfield=core_basic_parameters.get_darkfield,
+        smoothness_flatfield=core_basic_parameters.smoothness_flatfield,
+        smoothness_darkfield=core_basic_parameters.smoothness_darkfield,
+        epsilon=advanced_basic_parameters.epsilon,
+        fitting_mode=advanced_basic_parameters.fitting_mode,
+        max_iterations=advanced_basic_parameters.max_iterations,
+        max_mu_coef=advanced_basic_parameters.max_mu_coef,
+        max_reweight_iterations=advanced_basic_parameters.max_reweight_iterations,
+        max_reweight_iterations_baseline=advanced_basic_parameters.max_reweight_iterations_baseline,
+        mu_coef=advanced_basic_parameters.mu_coef,
+        optimization_tol=advanced_basic_parameters.optimization_tol,
+        optimization_tol_diff=advanced_basic_parameters.optimization_tol_diff,
+        reweighting_tol=advanced_basic_parameters.reweighting_tol,
+        resize_params=advanced_basic_parameters.resize_params,
+        rho=advanced_basic_parameters.rho,
+        sort_intensity=advanced_basic_parameters.sort_intensity,
+        sparse_cost_darkfield=advanced_basic_parameters.sparse_cost_darkfield,
+        working_size=advanced_basic_parameters.working_size,
+    )
+    basic.fit(basic_data)
+    flatfield, darkfield = basic.flatfield, basic.darkfield
+    if tuple(flatfield.shape) != tuple(fov_shape):
+        flatfield = resize_like_basic(flatfield, fov_shape, antialias=False)
+        darkfield = resize_like_basic(darkfield, fov_shape, antialias=False)
+    return flatfield, darkfield, basic.baseline
+
+
+def sample_fov_planes(
+    image_infos: Sequence[ImageInfo],
+    channel: str,
+    n_images_sampled: int,
+) -> list[tuple[Image, dict[str, Any]]]:
+    """Randomly choose FOV planes of a channel to fit BaSiC on.
+
+    Samples n_images_sampled FOVs (of the "FOV_ROI_table") of all images
+    containing the channel, and a random z-plane of each sampled FOV (if the
+    image has a z axis).
+
+    Args:
+        image_infos: Images to sample from (from `scan_images`, with the
+            "FOV_ROI_table" loaded).
+        channel: Wavelength id of the channel.
+        n_images_sampled: Number of FOVs to sample. If less FOVs are
+            available, all of them are used.
+
+    Returns:
+        List of (image, slicing kwargs) of the sampled planes, to be passed to
+        `load_fov_planes`.
+    """
+    fovs_all = []
+    for image_info in image_infos:
+        ngio_image = image_info.image
+        if channel in image_info.wavelength_ids:
+            channel_idx = image_info.wavelength_ids.index(channel)
+            roi_table = image_info.tables["FOV_ROI_table"]
+            for roi in roi_table.rois():
+                _, fov_slices, _ = roi_halo_slices(roi, ngio_image, halo={})
+                fov_slices["c"] = channel_idx
+                fovs_all.append((ngio_image, fov_slices))
+    if len(fovs_all) >= n_images_sampled:
+        logging.info(f"Using {n_images_sampled} random images out of {len(fovs_all)}.")
+        fovs_sample = random.sample(fovs_all, n_images_sampled)
+    else:
+        logging.warning(
+            f"{n_images_sampled} images requested, but only"
+            + f" {len(fovs_all)} available. "
+            + f"Using all {len(fovs_all)} images."
+        )
+        fovs_sample = fovs_all
+
+    planes = []
+    for ngio_image, fov_slices in fovs_sample:
+        z_slice = fov_slices.get("z")
+        if z_slice is None:
+            planes.append((ngio_image, fov_slices))
+            continue
+        n_z = z_slice.stop - z_slice.start
+        # take random slice along z-axis
+        z = z_slice.start + (random.randint(0, n_z - 1) if n_z > 1 else 0)
+        planes.append((ngio_image, {**fov_slices, "z": z}))
+    return planes
+
+
+def load_fov_planes(
+    planes: Sequence[tuple[Image, dict[str, Any]]],
+    working_size: Optional[int] = None,
+    max_workers: int = 1,
+) -> np.ndarray:
+    """Load FOV planes concurrently into one preallocated array.
+
+    Args:
+        planes: List of (image, slicing kwargs) from `sample_fov_planes`.
+        working_size: If given, each plane is downsampled to
+            (working_size, working_size) while loading, the same way BaSiC
+            resizes its input.
+        max_workers: Number of planes loaded concurrently.
+
+    Returns:
+        Array of shape (n_planes, y, x).
+    """
+    ngio_image, slices = planes[0]
+    if working_size is None:
+        shape = _plane_shape(slices)
+        dtype = ngio_image.dtype
+    else:
+        shape = (working_size, working_size)
+        dtype = np.float32
+    data = np.empty((len(planes), *shape), dtype=dtype)
+
+    def _load_plane(plane):
+        ngio_image, slices = plane
+        plane_data = ngio_image.get_array(axes_order="yx", **slices)
+        if working_size is not None:
+            plane_data = resize_like_basic(plane_data, shape)
+        return plane_data
+
+    for i, plane_data in enumerate(
+        bounded_map(_load_plane, planes, max_workers=max_workers)
+    ):
+        data[i] = plane_data
+    return data
+
+
+def resize_like_basic(
+    image: np.ndarray, shape: Sequence[int], antialias: bool = True
+) -> np.ndarray:
+    """Resize a 2D image like BaSiC (bilinear interpolation, with torch).
+
+    Args:
+        image: 2D image.
+        shape: Target shape (y, x).
+        antialias: Use anti-aliasing (BaSiC uses it to downsample the images,
+            but not to upsample the profiles).
+    """
+    tensor = torch.from_numpy(np.asarray(image, dtype=np.float32))[None, None]
+    resized = F.interpolate(
+        tensor,
+        tuple(shape),
+        mode="bilinear",
+        align_corners=True,
+        antialias=antialias,
+    )
+    return resized[0, 0].numpy()
+
+
+def _plane_shape(slices: dict[str, Any]) -> tuple[int, int]:
+    """Shape (y, x) of a plane from `sample_fov_planes`."""
+    return (
+        slices["y"].stop - slices["y"].start,
+        slices["x"].stop - slices["x"].start,
+    )
+
+
 if __name__ == "__main__":
     from fractal_task_tools.task_wrapper import run_fractal_task
 
@@ -0,0 +1,47 @@
+"""Fractal task to build the pyramid levels of an OME-Zarr image."""
+
+import logging
+
+from ngio import open_ome_zarr_container
+from pydantic import validate_call
+
+from zmb_fractal_tasks.utils.pyramid import consolidate_pyramid, is_pyramid_stale
+
+
+@validate_call
+def build_pyramids(
+    *,
+    zarr_url: str,
+    only_stale: bool = True,
+    include_labels: bool = True,
+) -> None:
+    """Build the pyramid levels of an image (and its labels) from level 0.
+
+    Use this after tasks that ran with `defer_consolidation`, which only mark
+    the pyramid of their output as stale.
+
+    Args:
+        zarr_url: Absolute path to the OME-Zarr image.
+            (standard argument for Fractal tasks, managed by Fractal server).
+        only_stale: If `True`, only build pyramids marked as stale. If
+            `False`, rebuild all pyramids.
+        include_labels: If `True`, also build the pyramids of the labels.
+    """
+    omezarr = open_ome_zarr_container(zarr_url)
+
+    images = {"image": omezarr.get_image()}
+    if include_labels:
+        for label_name in omezarr.list_labels():
+            images[f"label {label_name}"] = omezarr.get_label(label_name)
+
+    for name, image in images.items():
+        if only_stale and not is_pyramid_stale(image):
+            continue
+        logging.info(f"Building pyramid of {name}")
+        consolidate_pyramid(image)
+
+
+if __name__ == "__main__":
+    from fractal_task_tools.task_wrapper import run_fractal_task
+
+    run_fractal_task(task_function=build_pyramids)
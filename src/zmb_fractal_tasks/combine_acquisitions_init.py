@@ -7,6 +7,8 @@ from typing import Optional
 from ngio import open_ome_zarr_plate
 from pydantic import validate_call
 
+from zmb_fractal_tasks.utils.plate_scan import parse_zarr_url
+
 
 @validate_call
 def combine_acquisitions_init(
@@ -43,9 +45,13 @@ def combine_acquisitions_init(
             moment, as we get filesystem errors when trying to delete the
             individual acquisitions.)
     """
-    zarr_paths = [Path(url) for url in zarr_urls]
     # extract all plate roots
-    plate_roots = {p.parent.parent.parent for p in zarr_paths}
+    plate_roots = set()
+    for url in zarr_urls:
+        plate_url, _, _ = parse_zarr_url(url)
+        if plate_url is None:
+            raise ValueError(f"Image {url} is not part of a plate.")
+        plate_roots.add(Path(plate_url))
     parallelization_list = []
     for plate_root in plate_roots:
         ome_zarr_plate = open_ome_zarr_plate(plate_root)
@@ -96,6 +96,13 @@ TASK_LIST = [
         category="Utility",
         tags=["Labels", "Delete"],
     ),
+    ParallelTask(
+        name="Build pyramids",
+        executable="build_pyramids.py",
+        meta={"cpus_per_task": 1, "mem": 4000},
+        category="Utility",
+        tags=["Pyramid", "Consolidate", "Multiscale"],
+    ),
     ParallelTask(
         name="Update display range",
         executable="update_display_range.py",
@@ -138,6 +145,13 @@ TASK_LIST = [
         category="Measurement",
         tags=["Measure", "Assign", "Aggregate"],
     ),
+    NonParallelTask(
+        name="Aggregate features per well",
+        executable="aggregate_features_plate.py",
+        meta={"cpus_per_task": 1, "mem": 4000},
+        category="Measurement",
+        tags=["Measure", "Aggregate", "Plate", "Table"],
+    ),
     ParallelTask(
         name="Measure shortest distance to label",
         executable="measure_shortest_distance.py",
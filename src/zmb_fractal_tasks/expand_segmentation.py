@@ -1,5 +1,6 @@
 """Fractal task to expand the labels of a label-image."""
 
+from collections.abc import Sequence
 from typing import Optional
 
 import numpy as np
@@ -7,6 +8,11 @@ from ngio import open_ome_zarr_container
 from pydantic import validate_call
 from skimage.segmentation import expand_labels
 
+from zmb_fractal_tasks.utils.halo import roi_halo_slices
+from zmb_fractal_tasks.utils.label_rois import LabelBoxes, roi_origin
+from zmb_fractal_tasks.utils.label_writer import LabelWriter
+from zmb_fractal_tasks.utils.parallel import bounded_map
+
 
 @validate_call
 def expand_segmentation(
@@ -19,7 +25,13 @@ def expand_segmentation(
     union_output_label_name: Optional[str] = None,
     save_difference: bool = True,
     difference_output_label_name: Optional[str] = None,
+    output_ROI_table: Optional[str] = None,
     overwrite_existing_label: bool = True,
+    expand_across_ROI_borders: bool = False,
+    z_block_size: int = 32,
+    defer_consolidation: bool = False,
+    # Parallelization
+    max_workers: int = 1,
 ) -> None:
     """Expand the labels on the ROIs of a single OME-Zarr image.
 
@@ -34,7 +46,8 @@ def expand_segmentation(
         input_label_name: Name of the input label image to be expanded (e.g.
             `"nuclei"`).
         expansion_distance: Distance by which the labels are expanded, in
-            pixels at level 0.
+            pixels at level 0. In 3D, the distance along z is scaled by the
+            voxel size (pixel_size.z / pixel_size.x).
         save_union: If `True`, save the union of the original and expanded
             labels. (corresponds to e.g. the entire cell)
         union_output_label_name: Name of the output label image for the union
@@ -43,62 +56,159 @@ def expand_segmentation(
             and expanded labels. (corresponds to e.g. the cytoplasm)
         difference_output_label_name: Name of the output label image for the
             difference (e.g. `cytoplasms`).
+        output_ROI_table: If provided, a masking ROI table with that name is
+            created, which will contain the bounding boxes of the union labels
+            (or of the difference labels, if save_union is `False`). ROI
+            tables should have `ROI` in their name.
         overwrite_existing_label: If `True`, overwrite the created labels, if
             they already exist.
+        expand_across_ROI_borders: If `True`, each ROI is read with a margin
+            of expansion_distance, so that labels can grow across the ROI
+            border and compete with the labels of neighbouring ROIs (e.g. to
+            avoid seams between FOVs). Only the ROI itself is written.
+        z_block_size: Number of z-planes of 3D ROIs that are expanded
+            together, to limit memory usage. If 0, the full ROI is expanded at
+            once.
+        defer_consolidation: If `True`, the pyramid levels of the output
+            label image are not updated, but only marked as stale. They are
+            built later from level 0 (e.g. by the 'Build pyramids' task, or by
+            a task reading a coarser level).
+        max_workers: Number of ROIs expanded concurrently.
     """
     omezarr = open_ome_zarr_container(zarr_url)
     input_label_image = omezarr.get_label(name=input_label_name)
 
     roi_table = omezarr.get_table(input_ROI_table)
 
+    # voxel spacing in units of x-pixels
+    pixel_size = input_label_image.pixel_size
+    spacing = (pixel_size.z / pixel_size.x, pixel_size.y / pixel_size.x, 1.0)
+
+    # output labels start with the smallest label dtype & are widened as needed
     if save_union:
-        output_label_image_union = omezarr.derive_label(
+        output_label_image_union = LabelWriter(
+            omezarr,
             name=union_output_label_name,
             overwrite=overwrite_existing_label,
-            dtype=input_label_image.dtype,
         )
     if save_difference:
-        output_label_image_diff = omezarr.derive_label(
+        output_label_image_diff = LabelWriter(
+            omezarr,
             name=difference_output_label_name,
             overwrite=overwrite_existing_label,
-            dtype=input_label_image.dtype,
         )
 
-    for roi in roi_table.rois():
-        patch = input_label_image.get_roi(roi, axes_order="zyx")
-        segmentation = expand_labels_ROI(patch, expansion_distance=expansion_distance)
-        if save_union:
-            output_label_image_union.set_roi(
-                patch=segmentation, roi=roi, axes_order="zyx"
+    # margin in pixels, to expand ROIs across their borders
+    halo = {
+        "z": int(np.ceil(expansion_distance / spacing[0])),
+        "y": int(np.ceil(expansion_distance / spacing[1])),
+        "x": int(np.ceil(expansion_distance)),
+    }
+
+    def _expand_roi(roi):
+        if expand_across_ROI_borders:
+            extended_slices, write_kwargs, core = roi_halo_slices(
+                roi, input_label_image, halo
             )
+            patch = input_label_image.get_array(axes_order="zyx", **extended_slices)
+        else:
+            write_kwargs, core = {"roi": roi}, ...
+            patch = input_label_image.get_roi(roi, axes_order="zyx")
+        segmentation = expand_labels_ROI(
+            patch,
+            expansion_distance=expansion_distance,
+            spacing=spacing,
+            z_block_size=z_block_size,
+        )
+        return write_kwargs, patch[core], segmentation[core]
+
+    def _write(label_image, patch, write_kwargs):
+        if expand_across_ROI_borders:
+            label_image.set_array(patch, axes_order="zyx", **write_kwargs)
+        else:
+            label_image.set_roi(patch=patch, axes_order="zyx", **write_kwargs)
+
+    # bounding boxes of the labels, found while writing them
+    label_boxes = LabelBoxes()
+
+    # ROIs are expanded concurrently & written in order by the main thread
+    rois = roi_table.rois()
+    results = bounded_map(_expand_roi, rois, max_workers=max_workers)
+    for roi, (write_kwargs, patch, segmentation) in zip(rois, results, strict=True):
+        if output_ROI_table is not None:
+            origin = roi_origin(roi, input_label_image)
+        if save_union:
+            if output_ROI_table is not None:
+                label_boxes.add_labels(segmentation, origin)
+            _write(output_label_image_union, segmentation, write_kwargs)
         if save_difference:
-            output_label_image_diff.set_roi(
-                patch=segmentation - patch, roi=roi, axes_order="zyx"
-            )
+            # union is already written, so the difference is computed in place
+            # (expanded labels keep the original labels inside the objects)
+            segmentation[patch > 0] = 0
+            if output_ROI_table is not None and not save_union:
+                label_boxes.add_labels(segmentation, origin)
+            _write(output_label_image_diff, segmentation, write_kwargs)
 
     # Consolidate the segmentation image
     if save_union:
-        output_label_image_union.consolidate()
+        output_label_image_union.consolidate(defer=defer_consolidation)
     if save_difference:
-        output_label_image_diff.consolidate()
+        output_label_image_diff.consolidate(defer=defer_consolidation)
 
-    # TODO: Add ROI table with bounding boxes of the labels
+    if output_ROI_table is not None and (save_union or save_difference):
+        output_label_image = (
+            output_label_image_union if save_union else output_label_image_diff
+        )
+        omezarr.add_table(
+            output_ROI_table,
+            label_boxes.to_masking_roi_table(output_label_image.label_image),
+            overwrite=overwrite_existing_label,
+        )
 
 
 def expand_labels_ROI(
     x: np.ndarray,
     expansion_distance: int = 0,
+    spacing: Sequence[float] = (1.0, 1.0, 1.0),
+    z_block_size: Optional[int] = None,
 ) -> np.ndarray:
     """Expand labels for a single ROI.
 
+    Labels are expanded in 3D via a euclidean distance transform that
+    respects the voxel spacing. Large stacks are processed in blocks of
+    z-planes, with a halo of planes that are within expansion_distance of
+    the block, so the result is the same as for the full stack.
+
     Args:
-        x: 3D numpy array of labels
+        x: 3D numpy array of labels (zyx).
         expansion_distance: Distance by which the labels are expanded, in
-            pixels.
+            units of spacing.
+        spacing: Voxel spacing along (z, y, x).
+        z_block_size: Number of z-planes expanded together. If None (or 0),
+            the full stack is expanded at once.
     """
-    if x.ndim != 3 and x.shape[0] != 1:
-        raise ValueError("Input array must be 3D with the first dimension being 1.")
-    return expand_labels(x[0], expansion_distance).reshape(x.shape)
+    if x.ndim != 3:
+        raise ValueError("Input array must be 3D (zyx).")
+    if x.shape[0] == 1:
+        return expand_labels(
+            x[0], expansion_distance, spacing=tuple(spacing[1:])
+        ).reshape(x.shape)
+
+    n_z = x.shape[0]
+    if not z_block_size or z_block_size >= n_z:
+        return expand_labels(x, expansion_distance, spacing=tuple(spacing))
+
+    halo = int(np.ceil(expansion_distance / spacing[0]))
+    expanded = np.empty_like(x)
+    for start in range(0, n_z, z_block_size):
+        stop = min(start + z_block_size, n_z)
+        halo_start = max(start - halo, 0)
+        halo_stop = min(stop + halo, n_z)
+        block = expand_labels(
+            x[halo_start:halo_stop], expansion_distance, spacing=tuple(spacing)
+        )
+        expanded[start:stop] = block[start - halo_start : stop - halo_start]
+    return expanded
 
 
 if __name__ == "__main__":
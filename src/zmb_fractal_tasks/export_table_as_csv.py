@@ -1,12 +1,16 @@
 """Fractal task to export a table to .csv format."""
 
 import logging
+import tempfile
 from typing import Optional
 from pathlib import Path
 
 import pandas as pd
-from pydantic import validate_call
 from ngio import open_ome_zarr_container
+from pydantic import validate_call
+
+from zmb_fractal_tasks.utils.parallel import bounded_map
+from zmb_fractal_tasks.utils.plate_scan import parse_zarr_url, plate_name, well_name
 
 
 @validate_call
@@ -46,39 +50,54 @@ def export_table_as_csv(
 
     for table_to_export in tables_to_export:
         logging.info(f"Collecting table {table_to_export}")
-        df_list = []
-        for zarr_url in zarr_urls:
-            ome_zarr_container = open_ome_zarr_container(zarr_url)
-            table_df = ome_zarr_container.get_table(table_to_export).dataframe
+
+        def _load_table(zarr_url, table_name=table_to_export):
+            omezarr = open_ome_zarr_container(zarr_url)
+            table_df = omezarr.get_table(table_name).dataframe
             table_df = table_df.reset_index()
-            # find plate and well names
-            plate_name = Path(Path(zarr_url).as_posix().split(".zarr/")[0]).stem
-            component = Path(zarr_url).as_posix().split(".zarr/")[1]
-            well_row = component.split("/")[0]
-            well_col = int(component.split("/")[1])
-            well_name = well_row + f"{well_col:02d}"
-            table_df["plate"] = plate_name
-            table_df["well"] = well_name
+            plate_url, well_row, well_col = parse_zarr_url(zarr_url)
+            table_df["plate"] = plate_name(plate_url)
+            table_df["well"] = well_name(well_row, well_col)
             # insert plate and well columns at the front
             table_df.insert(0, "plate", table_df.pop("plate"))
             table_df.insert(1, "well", table_df.pop("well"))
             # add condition from plate layout if provided
             if plate_layout_path:
+                if well_row is None:
+                    raise ValueError(
+                        f"Image {zarr_url} is not part of a plate, "
+                        "so it has no condition in the plate layout."
+                    )
                 condition = plate_layout.loc[well_row, str(well_col)]
                 table_df["condition"] = condition
                 table_df.insert(2, "condition", table_df.pop("condition"))
-
-            df_list.append(table_df)
-
-        # concatenate all dataframes
-        df = pd.concat(df_list, axis=0).reset_index(drop=True)
+            return table_df
 
         export_table_name = table_to_export
         logging.info(
             f"Exporting table {table_to_export} to {zarr_dir}/{export_table_name}.csv")
         output_path = Path(zarr_dir) / f"{export_table_name}.csv"
-        df.to_csv(output_path)
 
+        # The tables are spooled to disk image by image (the next table is
+        # read while the previous one is spooled), collecting the union of
+        # their columns. They are then appended to the csv with all columns
+        # (like concatenating them), without holding all tables in memory.
+        with tempfile.TemporaryDirectory(dir=zarr_dir) as spool_dir:
+            columns = {}
+            spooled = []
+            tables = bounded_map(_load_table, zarr_urls, max_workers=1, max_pending=2)
+            for i, table_df in enumerate(tables):
+                columns.update(dict.fromkeys(table_df.columns))
+                spooled.append(Path(spool_dir) / f"{i}.pkl")
+                table_df.to_pickle(spooled[-1])
+
+            n_rows = 0
+            with open(output_path, "w", newline="") as csv_file:
+                for i, path in enumerate(spooled):
+                    table_df = pd.read_pickle(path).reindex(columns=list(columns))
+                    table_df.index = pd.RangeIndex(n_rows, n_rows + len(table_df))
+                    table_df.to_csv(csv_file, header=i == 0)
+                    n_rows += len(table_df)
 
 if __name__ == "__main__":
     from fractal_task_tools.task_wrapper import run_fractal_task
@@ -2,10 +2,8 @@
 
 import logging
 from collections.abc import Sequence
-from pathlib import Path
 
 import zarr
-from ngio import open_ome_zarr_container
 from ngio.tables import GenericTable
 from pydantic import validate_call
 
@@ -14,6 +12,7 @@ from zmb_fractal_tasks.utils.histogram import (
     anndata_to_histograms,
     histograms_to_anndata,
 )
+from zmb_fractal_tasks.utils.plate_scan import group_by_plate, scan_images
 
 
 @validate_call
@@ -52,22 +51,15 @@ def histogram_aggregate_plate(
             is True).
         overwrite: If True, overwrite existing histogram table.
     """
-    # identify plates
-    plate_to_urls = {}
-    for zarr_url in zarr_urls:
-        plate_path = Path(zarr_url).as_posix().split(".zarr/")[0] + ".zarr"
-        if plate_path not in plate_to_urls:
-            plate_to_urls[plate_path] = []
-        plate_to_urls[plate_path].append(zarr_url)
+    # load the histograms of all images & identify plates
+    image_infos = scan_images(zarr_urls, tables=[histogram_input_name])
 
-    for plate_path, plate_zarr_urls in plate_to_urls.items():
+    for plate_path, plate_image_infos in group_by_plate(image_infos).items():
         combined_channel_histogram = {}
         levels = []
-        # load and combine histograms from all images in the plate
-        for zarr_url in plate_zarr_urls:
-            ome_zarr_container = open_ome_zarr_container(zarr_url)
-            table = ome_zarr_container.get_table(histogram_input_name)
-            adata = table.anndata
+        # combine histograms from all images in the plate
+        for image_info in plate_image_infos:
+            adata = image_info.tables[histogram_input_name].anndata
             levels.append(adata.uns["pyramid_level"])
             histo_dict = anndata_to_histograms(adata)
             for channel, histo in histo_dict.items():
@@ -89,9 +81,10 @@ def histogram_aggregate_plate(
         adata = histograms_to_anndata(combined_channel_histogram)
         adata.uns["level"] = level
         generic_table = GenericTable(table_data=adata)
-        for zarr_url in plate_zarr_urls:
-            omezarr = open_ome_zarr_container(zarr_url)
-            omezarr.add_table(histogram_output_name, generic_table, overwrite=overwrite)
+        for image_info in plate_image_infos:
+            image_info.omezarr.add_table(
+                histogram_output_name, generic_table, overwrite=overwrite
+            )
 
         # calculate percentiles & write omero metadata
         if update_display_range:
@@ -106,8 +99,8 @@ def histogram_aggregate_plate(
                     [p / 100 for p in display_range_percentiles]
                 )
             # write omero metadata for all images in the plate
-            for zarr_url in plate_zarr_urls:
-                with zarr.open(zarr_url, mode="a") as zarr_file:
+            for image_info in plate_image_infos:
+                with zarr.open(image_info.zarr_url, mode="a") as zarr_file:
                     omero_dict = zarr_file.attrs["omero"]
                     for channel_dict in omero_dict["channels"]:
                         channel_name = channel_dict["label"]
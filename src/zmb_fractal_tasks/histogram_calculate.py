@@ -8,6 +8,7 @@ from ngio.tables import GenericTable
 from pydantic import validate_call
 
 from zmb_fractal_tasks.utils.histogram import Histogram, histograms_to_anndata
+from zmb_fractal_tasks.utils.pyramid import update_stale_pyramid
 
 
 @validate_call
@@ -48,6 +49,7 @@ def histogram_calculate(
     omezarr = open_ome_zarr_container(zarr_url)
 
     image = omezarr.get_image(path=pyramid_level)
+    update_stale_pyramid(image)
 
     if input_ROI_table == "":
         input_ROI_table = None
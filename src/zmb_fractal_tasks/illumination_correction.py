@@ -4,12 +4,16 @@ import logging
 from pathlib import Path
 from typing import Any
 
-import numpy as np
-import tifffile
 from ngio import open_ome_zarr_container
 from pydantic import validate_call
 
-from zmb_fractal_tasks.basic_apply_illumination_profile import correct
+from zmb_fractal_tasks.basic_apply_illumination_profile import (
+    IlluminationCorrection,
+    apply_illumination_corrections,
+)
+from zmb_fractal_tasks.utils.illumination_profiles import (
+    load_tiff_illumination_profile,
+)
 
 
 @validate_call
@@ -25,6 +29,9 @@ def illumination_correction(
     overwrite_input_image: bool = True,
     # Advanced parameters
     new_well_subgroup_suffix: str = "_illum_corr",
+    defer_consolidation: bool = False,
+    # Parallelization
+    max_workers: int = 1,
 ) -> dict[str, Any]:
     """Applies illumination correction to the images in the OME-Zarr.
 
@@ -58,6 +65,13 @@ def illumination_correction(
             and the illumination corrected data is saved there.
         new_well_subgroup_suffix: What suffix to append to the illumination
             corrected images. Only relevant if `overwrite_input=False`.
+        defer_consolidation: If `True`, the pyramid levels of the output
+            image are not updated, but only marked as stale. They are built
+            later from level 0 (e.g. by the 'Build pyramids' task, or by a
+            task reading a coarser level). Useful if several tasks write to
+            the image in a row.
+        max_workers: Number of FOVs read & corrected concurrently (across all
+            channels), while the corrected FOVs are written.
     """
     omezarr = open_ome_zarr_container(zarr_url)
 
@@ -78,29 +92,29 @@ def illumination_correction(
 
     roi_table = omezarr.get_table(input_ROI_table)
 
-    # Process each channel & FOV
+    # Load illumination profiles of each channel
+    corrections = {}
     for channel, file_name in illumination_profiles.items():
         # load illumination profiles
         channel_idx = source_image.wavelength_ids.index(channel)
         file_path = Path(illumination_profiles_folder) / file_name
-        flatfield = tifffile.imread(file_path)
-        darkfield = np.zeros_like(flatfield)
-        baseline = background
-
-        # Correct each FOV
-        for roi in roi_table.rois():
-            patch = source_image.get_roi(
-                roi, c=channel_idx, axes_order=["c", "z", "y", "x"]
-            )
-            patch_corrected = correct(patch, flatfield, darkfield, baseline)
-            output_image.set_roi(
-                patch=patch_corrected,
-                roi=roi,
-                c=channel_idx,
-                axes_order=["c", "z", "y", "x"],
-            )
-
-    output_image.consolidate()
+        # the profiles have no darkfield
+        profile = load_tiff_illumination_profile(file_path)
+        corrections[channel_idx] = IlluminationCorrection.from_profile(
+            profile, baseline=background
+        )
+
+    # Correct each channel & FOV
+    dirty_regions = apply_illumination_corrections(
+        source_image,
+        output_image,
+        roi_table.rois(),
+        corrections,
+        max_workers=max_workers,
+    )
+
+    # Update the pyramid where the image was corrected
+    dirty_regions.consolidate(defer=defer_consolidation)
 
     if overwrite_input_image:
         image_list_updates = {"image_list_updates": [{"zarr_url": zarr_url}]}
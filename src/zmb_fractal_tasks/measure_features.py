@@ -14,6 +14,7 @@ from ngio.transforms import ZoomTransform
 from pydantic import BaseModel, validate_call
 
 from zmb_fractal_tasks.utils.channel_utils import MeasurementChannels
+from zmb_fractal_tasks.utils.pyramid import update_stale_pyramid
 from zmb_fractal_tasks.utils.regionprops_table_plus import regionprops_table_plus
 
 
@@ -78,6 +79,7 @@ def measure_features(
         image = ome_zarr.get_image()
     else:
         image = ome_zarr.get_image(path=pyramid_level)
+        update_stale_pyramid(image)
 
     if ome_zarr.is_time_series:
         raise NotImplementedError("Time series are not yet supported.")
@@ -112,6 +114,7 @@ def measure_features(
         input_label_name = input_label_model.input_label_name
         output_table_name = input_label_model.output_table_name
         label = ome_zarr.get_label(input_label_name, pixel_size=image.pixel_size)
+        update_stale_pyramid(label)
 
         # transform to resample label, in case of different resolutions
         zoom_transform = ZoomTransform(
@@ -15,6 +15,8 @@ from pydantic import validate_call
 from scipy.ndimage import distance_transform_edt
 from skimage.measure import regionprops_table
 
+from zmb_fractal_tasks.utils.pyramid import update_stale_pyramid
+
 
 @validate_call
 def measure_shortest_distance(
@@ -53,10 +55,13 @@ def measure_shortest_distance(
         label = ome_zarr.get_label(input_label_name)
     else:
         label = ome_zarr.get_label(input_label_name, path=pyramid_level)
+    update_stale_pyramid(label)
     target_label_images = {
         name: ome_zarr.get_label(name, pixel_size=label.pixel_size)
         for name in target_label_names
     }
+    for target_label_image in target_label_images.values():
+        update_stale_pyramid(target_label_image)
 
     if ome_zarr.is_time_series:
         raise NotImplementedError("Time series are not yet supported.")
@@ -8,11 +8,22 @@ from cellpose import models
 from ngio import open_ome_zarr_container
 from pydantic import validate_call
 
+from zmb_fractal_tasks.utils.cellpose_models import get_cellpose_model
+from zmb_fractal_tasks.utils.label_rois import LabelBoxes, roi_origin
+from zmb_fractal_tasks.utils.label_writer import LabelWriter
 from zmb_fractal_tasks.utils.normalization import (
     CustomNormalizer,
     NormalizedChannelInputModel,
     normalized_image,
 )
+from zmb_fractal_tasks.utils.parallel import bounded_map
+from zmb_fractal_tasks.utils.pyramid import update_stale_pyramid
+from zmb_fractal_tasks.utils.relabel import (
+    add_label_offset,
+    load_label_offsets,
+    roi_label_offset,
+    save_label_offsets,
+)
 
 
 @validate_call
@@ -24,6 +35,7 @@ def segment_cellpose_simple(
     pyramid_level: str = "0",
     channel: NormalizedChannelInputModel,
     input_ROI_table: str = "FOV_ROI_table",
+    ROI_names: Optional[list[str]] = None,
     output_ROI_table: Optional[str] = None,
     output_label_name: Optional[str] = None,
     # Segmentation parameters
@@ -32,8 +44,14 @@ def segment_cellpose_simple(
     batch_size: int = 8,
     diameter: float = 30.0,
     resample: bool = False,
+    do_3D: bool = False,
+    stitch_threshold: float = 0.5,
     # Overwrite option
     overwrite_existing_label: bool = True,
+    # Advanced parameters
+    roi_batch_size: int = 16,
+    torch_threads: Optional[int] = None,
+    defer_consolidation: bool = False,
 ) -> None:
     """Segment a single channel using cellpose.
 
@@ -50,9 +68,18 @@ def segment_cellpose_simple(
             the field of views, `organoid_ROI_table` => loop over the organoid
             ROI table (generated by another task), `well_ROI_table` => process
             the whole well as one image.
-        output_ROI_table: If provided, a ROI table with that name is created,
-            which will contain the bounding boxes of the newly segmented
-            labels. ROI tables should have `ROI` in their name.
+        ROI_names: If provided, only these ROIs of the input ROI table are
+            segmented again (in all timepoints) & written into the existing
+            label image (e.g. to redo a few fields of view), while the labels
+            of all other ROIs are kept. The new labels of a ROI keep its
+            previous label range if they fit into it, otherwise they are
+            placed after the largest label. Requires a label image written by
+            this task from non-overlapping ROIs.
+        output_ROI_table: If provided, a masking ROI table with that name is
+            created, which will contain the bounding boxes of the newly
+            segmented labels. ROI tables should have `ROI` in their name. If
+            ROI_names is provided, the table contains all labels of the label
+            image.
         output_label_name: Name of the output label image (e.g. `"organoids"`).
         gpu: If `True`, use the GPU for segmentation.
         model_type: Type of cellpose model to use for segmentation.
@@ -60,16 +87,36 @@ def segment_cellpose_simple(
         diameter: Diameter of the objects to be segmented (pixels at level 0).
         resample: Run dynamics at original image size (will be slower but
             create more accurate boundaries).
+        do_3D: If `True`, segment 3D images with Cellpose's 3D mode (with
+            the anisotropy given by the pixel sizes). Otherwise, each z-plane
+            is segmented in 2D & the masks are stitched across planes.
+        stitch_threshold: Minimum IoU of masks in neighbouring z-planes to be
+            stitched into one label. Only used for 3D images if do_3D is
+            `False`.
         overwrite_existing_label: If `True`, overwrite the created labels, if
             they already exist.
+        roi_batch_size: Number of ROIs (of a single timepoint) loaded &
+            segmented together. The next batch is loaded while the current
+            one is segmented, so at most two batches of ROIs are held in
+            memory.
+        torch_threads: Number of threads used by torch for CPU inference.
+            Set this to avoid oversubscribing the cores when several tasks
+            run on the same node. If `None`, torch uses all cores.
+        defer_consolidation: If `True`, the pyramid levels of the output
+            label image are not updated, but only marked as stale. They are
+            built later from level 0 (e.g. by the 'Build pyramids' task, or by
+            a task reading a coarser level). Only used if the labels are
+            written at pyramid level `0`.
     """
     omezarr = open_ome_zarr_container(zarr_url)
     image = omezarr.get_image(path=pyramid_level)
+    update_stale_pyramid(image)
 
-    if image.is_3d:
-        raise ValueError("Only 2D images are supported")
-    if image.is_time_series:
-        raise ValueError("Time series are not supported")
+    if image.is_3d and not do_3D and stitch_threshold <= 0:
+        raise ValueError(
+            "3D images require do_3D or a stitch_threshold > 0, otherwise the "
+            "labels of the z-planes are not connected."
+        )
 
     roi_table = omezarr.get_table(input_ROI_table)
 
@@ -78,6 +125,7 @@ def segment_cellpose_simple(
 
     downsample_factor = image.pixel_size.x / omezarr.get_image().pixel_size.x
     diameter_downsampled = diameter / downsample_factor
+    anisotropy = image.pixel_size.z / image.pixel_size.x
 
     if channel.normalize.mode == "omero":
         # load normalization from omero channel
@@ -89,39 +137,108 @@ def segment_cellpose_simple(
     if output_label_name is None:
         output_label_name = "cellpose"
 
-    omezarr.derive_label(name=output_label_name, overwrite=overwrite_existing_label)
-    label_image = omezarr.get_label(name=output_label_name, path=pyramid_level)
-
-    # load data
-    cellpose_patches = []
-    for roi in roi_table.rois():
-        patch = image.get_roi(roi, c=channel_idx, axes_order="zyx")
-        cellpose_patches.append(patch)
-    # compute segmetnations
-    masks = segment_ROIs(
-        images=cellpose_patches,
-        gpu=gpu,
-        model_type=model_type,
-        batch_size=batch_size,
-        diameter=diameter_downsampled,
-        resample=resample,
-        normalize=channel.normalize,
+    label_image = LabelWriter(
+        omezarr,
+        name=output_label_name,
+        path=pyramid_level,
+        overwrite=overwrite_existing_label,
+        create=ROI_names is None,
+    )
+
+    model = get_cellpose_model(
+        model_type=model_type, gpu=gpu, torch_threads=torch_threads
     )
-    # save segmentations
-    max_label = 0
-    for roi, mask in zip(roi_table.rois(), masks):
-        if mask.max() > 0:
-            binary = mask > 0
-            mask[binary] += max_label
-            max_label = mask.max()
-        label_image.set_roi(patch=mask[None, None, ...], roi=roi, axes_order="czyx")
+
+    # Segment the ROIs (of each timepoint) batch by batch, loading the next
+    # batch in the background. Masks are written as soon as their batch is
+    # segmented.
+    if image.is_time_series:
+        timepoints = [{"t": t} for t in range(image.dimensions.get("t"))]
+    else:
+        timepoints = [{}]
+    if ROI_names is None:
+        table_rois = roi_table.rois()
+        # labels of all ROIs are new
+        offsets = {}
+    else:
+        table_rois = [roi_table.get(name) for name in ROI_names]
+        # labels of the other ROIs are kept
+        offsets = load_label_offsets(label_image.label_image)
+        if not offsets:
+            raise ValueError(
+                f"Label image '{output_label_name}' has no label offsets of its "
+                "ROIs, so single ROIs can't be segmented again. Segment all ROIs "
+                "first (without ROI_names)."
+            )
+    rois = [(roi, t) for t in timepoints for roi in table_rois]
+    roi_batches = [
+        rois[i : i + roi_batch_size] for i in range(0, len(rois), roi_batch_size)
+    ]
+
+    def _load_batch(roi_batch):
+        return [
+            image.get_roi(roi, c=channel_idx, axes_order="zyx", **t)
+            for roi, t in roi_batch
+        ]
+
+    # bounding boxes of the labels, found while writing them
+    axes = ("t", "z", "y", "x") if image.is_time_series else ("z", "y", "x")
+    label_boxes = LabelBoxes(axes)
+
+    # labels are made unique across ROIs by offsetting them by the number of
+    # labels in all previous ROIs
+    patch_batches = bounded_map(_load_batch, roi_batches, max_pending=2)
+    for roi_batch, patches in zip(roi_batches, patch_batches, strict=True):
+        masks = segment_ROIs(
+            images=patches,
+            gpu=gpu,
+            model_type=model_type,
+            batch_size=batch_size,
+            diameter=diameter_downsampled,
+            resample=resample,
+            normalize=channel.normalize,
+            model=model,
+            do_3D=do_3D,
+            anisotropy=anisotropy,
+            stitch_threshold=stitch_threshold,
+        )
+        shapes = [patch.shape for patch in patches]
+        del patches
+        batch_offsets = [
+            roi_label_offset(offsets, (roi.name, t.get("t")), int(mask.max()))
+            for (roi, t), mask in zip(roi_batch, masks, strict=True)
+        ]
+        label_image.ensure_fits(max(o + c for o, c in offsets.values()))
+        for (roi, t), mask, shape, offset in zip(
+            roi_batch, masks, shapes, batch_offsets, strict=True
+        ):
+            mask = mask.reshape(shape)
+            if output_ROI_table is not None and ROI_names is None:
+                origin = roi_origin(roi, label_image.label_image)
+                if t:
+                    label_boxes.add_labels(mask[None], (t["t"], *origin), offset)
+                else:
+                    label_boxes.add_labels(mask, origin, offset)
+            mask = add_label_offset(mask, offset)
+            label_image.set_roi(patch=mask[None], roi=roi, axes_order="czyx", **t)
+
+    # keep the offsets, to relabel single ROIs that are segmented again
+    save_label_offsets(label_image.label_image, offsets)
 
     # Consolidate the segmentation image
-    label_image.consolidate()
+    label_image.consolidate(defer=defer_consolidation)
 
-    # TODO: Add ROI table with bounding boxes of the labels
     if output_ROI_table is not None:
-        raise NotImplementedError("ROI table output not implemented yet")
+        if ROI_names is None:
+            masking_roi_table = label_boxes.to_masking_roi_table(
+                label_image.label_image
+            )
+        else:
+            # boxes of the labels of the other ROIs are not known
+            masking_roi_table = label_image.label_image.build_masking_roi_table()
+        omezarr.add_table(
+            output_ROI_table, masking_roi_table, overwrite=overwrite_existing_label
+        )
 
 
 def segment_ROIs(
@@ -132,8 +249,20 @@ def segment_ROIs(
     diameter: float,
     resample: bool,
     normalize: CustomNormalizer,
-) -> Sequence[np.ndarray]:
-    """Segment 2D ROIs using Cellpose."""
+    model: Optional[models.Cellpose] = None,
+    do_3D: bool = False,
+    anisotropy: Optional[float] = None,
+    stitch_threshold: float = 0.0,
+) -> list[np.ndarray]:
+    """Segment 2D or 3D (zyx) ROIs using Cellpose.
+
+    Stacks with more than one z-plane are segmented in 3D mode (if do_3D) or
+    plane by plane & stitched (if stitch_threshold > 0). Their masks are zyx,
+    the masks of 2D ROIs are yx.
+
+    If no model is given, the (cached) model of model_type is used. If a
+    model is given, gpu & model_type are ignored.
+    """
     if normalize is None:
         normalize = CustomNormalizer()
     if normalize.mode == "omero":
@@ -153,15 +282,34 @@ def segment_ROIs(
             )
             for img in images
         ]
-    model = models.Cellpose(gpu=gpu, model_type=model_type)
-    masks, *_ = model.eval(
-        images,
-        diameter=diameter,
-        channels=[[0, 0]],
-        batch_size=batch_size,
-        resample=resample,
-        normalize=normalize.use_default_normalization,
-    )
+    if model is None:
+        model = get_cellpose_model(model_type=model_type, gpu=gpu)
+    eval_kwargs = {
+        "diameter": diameter,
+        "channels": [[0, 0]],
+        "batch_size": batch_size,
+        "resample": resample,
+        "normalize": normalize.use_default_normalization,
+    }
+    is_stack = [np.ndim(img) == 3 and np.shape(img)[0] > 1 for img in images]
+    masks: list[Optional[np.ndarray]] = [None] * len(images)
+    planes = [i for i, stack in enumerate(is_stack) if not stack]
+    if planes:
+        plane_masks, *_ = model.eval([images[i] for i in planes], **eval_kwargs)
+        for i, mask in zip(planes, plane_masks, strict=True):
+            masks[i] = mask
+    stacks = [i for i, stack in enumerate(is_stack) if stack]
+    if stacks:
+        stack_masks, *_ = model.eval(
+            [images[i] for i in stacks],
+            z_axis=0,
+            do_3D=do_3D,
+            anisotropy=anisotropy,
+            stitch_threshold=0.0 if do_3D else stitch_threshold,
+            **eval_kwargs,
+        )
+        for i, mask in zip(stacks, stack_masks, strict=True):
+            masks[i] = mask
     return masks
 
 
@@ -1,6 +1,8 @@
 """Fractal task to segment spot-like particles."""
 
-from collections.abc import Sequence
+import math
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import numpy as np
@@ -8,15 +10,24 @@ from ngio import open_ome_zarr_container
 from pydantic import validate_call
 from scipy import ndimage
 from skimage.feature import peak_local_max
-from skimage.filters import gaussian
 from skimage.morphology import remove_small_holes
 from skimage.segmentation import watershed
 
+from zmb_fractal_tasks.utils.label_rois import LabelBoxes, roi_origin
+from zmb_fractal_tasks.utils.label_writer import LabelWriter
 from zmb_fractal_tasks.utils.normalization import (
     CustomNormalizer,
     NormalizedChannelInputModel,
     normalized_image,
 )
+from zmb_fractal_tasks.utils.parallel import bounded_map
+from zmb_fractal_tasks.utils.pyramid import update_stale_pyramid
+from zmb_fractal_tasks.utils.relabel import (
+    add_label_offset,
+    load_label_offsets,
+    roi_label_offset,
+    save_label_offsets,
+)
 
 
 @validate_call
@@ -28,6 +39,7 @@ def segment_particles(
     pyramid_level: str = "0",
     channel: NormalizedChannelInputModel,
     input_ROI_table: str = "FOV_ROI_table",
+    ROI_names: Optional[list[str]] = None,
     output_ROI_table: Optional[str] = None,
     output_label_name: Optional[str] = None,
     # Segmentation parameters
@@ -39,6 +51,13 @@ def segment_particles(
     fill_max_size: float = 1000,
     # Overwrite option
     overwrite: bool = True,
+    # Advanced parameters
+    defer_consolidation: bool = False,
+    z_block_size: int = 0,
+    float_watershed: bool = False,
+    # Parallelization
+    max_workers: int = 1,
+    max_plane_workers: int = 1,
 ) -> None:
     """Segment spot-like particles in 2D image.
 
@@ -72,9 +91,20 @@ def segment_particles(
             the field of views, `organoid_ROI_table` => loop over the organoid
             ROI table (generated by another task), `well_ROI_table` => process
             the whole well as one image.
-        output_ROI_table: If provided, a ROI table with that name is created,
-            which will contain the bounding boxes of the newly segmented
-            labels. ROI tables should have `ROI` in their name.
+        ROI_names: If provided, only these ROIs of the input ROI table are
+            segmented again & written into the existing label image (e.g. to
+            redo a few fields of view), while the labels of all other ROIs
+            are kept. The new labels of a ROI keep its previous label range
+            if they fit into it, otherwise they are placed after the largest
+            label. Requires a label image written by this task from
+            non-overlapping ROIs.
+        output_ROI_table: If provided, a masking ROI table with that name is
+            created, which will contain the bounding boxes of the newly
+            segmented labels. ROI tables should have `ROI` in their name. If
+            the input ROIs overlap, the boxes of labels that are partly
+            overwritten by later ROIs may be larger than the labels. If
+            ROI_names is provided, the table contains all labels of the label
+            image.
         output_label_name: Name of the output label image (e.g. `"organoids"`).
         gaussian_smoothing_sigma: sigma for preprocessing gaussian filter
             (in pixels @ level0)
@@ -87,9 +117,28 @@ def segment_particles(
         fill_2d: If True, holes will be filled
         fill_max_size: maximum hole-size to be filled (in pixels @ level0)
         overwrite: If `True`, overwrite the task output.
+        defer_consolidation: If `True`, the pyramid levels of the output
+            label image are not updated, but only marked as stale. They are
+            built later from level 0 (e.g. by the 'Build pyramids' task, or by
+            a task reading a coarser level). Only used if the labels are
+            written at pyramid level `0`.
+        z_block_size: If > 0, the watershed of 3D ROIs is run on blocks of
+            that many z-planes (with a halo of neighbouring planes), which can
+            be processed concurrently. Seeds are only kept in the block they
+            belong to, but labels can differ slightly from the watershed of
+            the full stack where objects reach beyond the halo. If 0, the
+            full stack is processed at once.
+        float_watershed: If `True`, the seeds & the watershed use the
+            smoothed image as float32. By default, the smoothed image is
+            cast to uint16, which leaves only a few grey levels of normalized
+            images, so fewer seeds (and particles) are found.
+        max_workers: Number of ROIs segmented concurrently.
+        max_plane_workers: Number of z-planes (and watershed blocks) of each
+            ROI processed concurrently.
     """
     omezarr = open_ome_zarr_container(zarr_url)
     image = omezarr.get_image(path=pyramid_level)
+    update_stale_pyramid(image)
 
     roi_table = omezarr.get_table(input_ROI_table)
 
@@ -106,13 +155,33 @@ def segment_particles(
     if output_label_name is None:
         output_label_name = "particles"
 
-    omezarr.derive_label(
-        name=output_label_name, overwrite=overwrite, dtype='uint32'
-    ) # TODO: maybe expose dtype, or figure out how to set dynamically as needed
-    label_image = omezarr.get_label(name=output_label_name, path=pyramid_level)
+    # label dtype is widened as needed, while writing the labels
+    label_image = LabelWriter(
+        omezarr,
+        name=output_label_name,
+        path=pyramid_level,
+        overwrite=overwrite,
+        create=ROI_names is None,
+    )
 
-    max_label = 0
-    for roi in roi_table.rois():
+    if ROI_names is None:
+        rois = roi_table.rois()
+        # labels of all ROIs are new
+        offsets = {}
+    else:
+        rois = [roi_table.get(name) for name in ROI_names]
+        # labels of the other ROIs are kept
+        offsets = load_label_offsets(label_image.label_image)
+        if not offsets:
+            raise ValueError(
+                f"Label image '{output_label_name}' has no label offsets of its "
+                "ROIs, so single ROIs can't be segmented again. Segment all ROIs "
+                "first (without ROI_names)."
+            )
+    # bounding boxes of the labels, found while writing them
+    label_boxes = LabelBoxes()
+
+    def _segment_roi(roi):
         patch = image.get_roi(roi, c=channel_idx, axes_order="czyx")
         segmentation = segment_ROI(
             patch,
@@ -121,28 +190,79 @@ def segment_particles(
             fill_2d=fill_2d,
             fill_max_size=fill_max_size,
             normalize=channel.normalize,
+            z_block_size=z_block_size,
+            float_watershed=float_watershed,
+            max_workers=max_plane_workers,
         )
-        # Add the max label of the previous segmentation to avoid overlapping labels
-        if segmentation.max() > 0:
-            binary = segmentation > 0
-            segmentation[binary] += max_label
-            max_label = segmentation.max()
-
-        segmentation = segmentation[0]  # drop channel axis TODO: ask if necessary
-
+        return segmentation[0]  # drop channel axis TODO: ask if necessary
+
+    # ROIs are segmented concurrently, but written in ROI order with their
+    # final labels (offset by the label counts of all previous ROIs). So each
+    # ROI is written once & later ROIs overwrite overlapping earlier ones.
+    segmentations = bounded_map(_segment_roi, rois, max_workers=max_workers)
+    for roi, segmentation in zip(rois, segmentations, strict=True):
+        offset = roi_label_offset(offsets, (roi.name, None), int(segmentation.max()))
+        if output_ROI_table is not None and ROI_names is None:
+            origin = roi_origin(roi, label_image.label_image)
+            label_boxes.add_labels(segmentation, origin, offset)
+        segmentation = add_label_offset(segmentation, offset)
         label_image.set_roi(patch=segmentation, roi=roi, axes_order="zyx")
 
+    # keep the offsets, to relabel single ROIs that are segmented again
+    save_label_offsets(label_image.label_image, offsets)
+
     # Consolidate the segmentation image
-    label_image.consolidate()
+    label_image.consolidate(defer=defer_consolidation)
 
-    # TODO: Add ROI table with bounding boxes of the labels
     if output_ROI_table is not None:
-        raise NotImplementedError("ROI table output not implemented yet")
+        if ROI_names is None:
+            masking_roi_table = label_boxes.to_masking_roi_table(
+                label_image.label_image
+            )
+        else:
+            # boxes of the labels of the other ROIs are not known
+            masking_roi_table = label_image.label_image.build_masking_roi_table()
+        omezarr.add_table(output_ROI_table, masking_roi_table, overwrite=overwrite)
+
+
+def log_filter_bank(
+    image: np.ndarray,
+    sigmas: Sequence[float],
+    presmooth_sigma: float = 0.0,
+) -> Iterator[tuple[float, np.ndarray]]:
+    """Laplacian of gaussian (LoG) of an image at multiple scales.
+
+    Only the smallest scale is filtered from the image. Since gaussians
+    combine like G(s1) * G(s2) = G(sqrt(s1**2 + s2**2)), each larger scale is
+    computed by blurring the previous response with a smaller gaussian (in
+    place). A gaussian pre-smoothing is folded into the scales the same way.
+
+    Args:
+        image: nD image.
+        sigmas: Sigmas of the LoG filters.
+        presmooth_sigma: Sigma of a gaussian applied to the image first.
+
+    Yields:
+        (sigma, LoG response) in order of increasing sigma. The response
+        (float32, not scale-normalized) is overwritten by the next scale.
+    """
+    response = None
+    previous_sigma = 0.0
+    for sigma in sorted(set(sigmas)):
+        total_sigma = math.hypot(sigma, presmooth_sigma)
+        if response is None:
+            response = ndimage.gaussian_laplace(image, total_sigma, output=np.float32)
+        else:
+            blur_sigma = math.sqrt(total_sigma**2 - previous_sigma**2)
+            ndimage.gaussian_filter(response, blur_sigma, output=response)
+        previous_sigma = total_sigma
+        yield sigma, response
 
 
 def gaussian_laplace_threshold(
     struct_img: np.ndarray,
     s2_param: Sequence[Sequence[float]],
+    presmooth_sigma: float = 0.0,
 ):
     """Spot-segmentation via laplacian of gaussian.
 
@@ -153,12 +273,21 @@ def gaussian_laplace_threshold(
             second element is the threshold for the filtered image:
             [[sigma1, threshold1], [sigma2, threshold2], ...]
             e.g. [[1, 0.04], [1.5, 0.8], [2, 0.15], [4, 0.20]]
+        presmooth_sigma: sigma of a gaussian filter applied to the image first
     """
+    # lowest threshold per sigma (higher ones don't add to the mask)
+    thresholds: dict[float, float] = {}
+    for log_sigma, threshold in s2_param:
+        thresholds[log_sigma] = min(threshold, thresholds.get(log_sigma, threshold))
+
     bw = np.zeros(struct_img.shape, dtype=bool)
-    for fid in range(len(s2_param)):
-        log_sigma = s2_param[fid][0]
-        response = -1 * (log_sigma**2) * ndimage.gaussian_laplace(struct_img, log_sigma)
-        bw = np.logical_or(bw, response > s2_param[fid][1])
+    above = np.empty(struct_img.shape, dtype=bool)
+    for log_sigma, response in log_filter_bank(
+        struct_img, list(thresholds), presmooth_sigma
+    ):
+        # -sigma**2 * LoG > threshold  <=>  LoG < -threshold / sigma**2
+        np.less(response, -thresholds[log_sigma] / log_sigma**2, out=above)
+        np.logical_or(bw, above, out=bw)
     return bw
 
 
@@ -188,36 +317,122 @@ def spot_mask_2D(
             you can either provide your own rescaling percentiles or fixed
             rescaling upper and lower bound integers.
     """
-    if gaussian_smoothing_sigma:
-        x = gaussian(x, sigma=gaussian_smoothing_sigma, preserve_range=True)
-    mask = gaussian_laplace_threshold(x, s2_param)
+    mask = gaussian_laplace_threshold(
+        x, s2_param, presmooth_sigma=gaussian_smoothing_sigma or 0.0
+    )
     mask = remove_small_holes(mask, fill_max_size)
     return mask
 
 
-def separate_watershed(img, mask, sigma):
+def separate_watershed(
+    img: np.ndarray,
+    mask: np.ndarray,
+    sigma: Optional[float],
+    z_block_size: Optional[int] = None,
+    float_watershed: bool = False,
+    max_workers: int = 1,
+) -> np.ndarray:
     """Perform instance segmentation of a mask via watershed.
 
     1. Gaussian filter image with sigma
     2. Find local intensity maxima (inside mask)
     3. Perform seeded watershed along intensity of image, with maximas as
        seed-points, inside of mask
+
+    Stacks with more than z_block_size planes are processed in blocks of
+    z-planes, extended by a halo of planes that covers the gaussian & the
+    spacing of the maxima. Maxima are only kept in the block they lie in &
+    are labelled for the whole stack, so each seed gets one label. The
+    watershed of each block floods from all seeds within its halo.
+
+    Args:
+        img: Image (zyx or yx).
+        mask: Foreground mask of the image.
+        sigma: Sigma of the gaussian filter (also the minimal distance of the
+            maxima).
+        z_block_size: Number of z-planes processed together. If None (or 0),
+            the full stack is processed at once.
+        float_watershed: If True, the smoothed image is kept as float32.
+            Otherwise, it is rounded & cast to uint16.
+        max_workers: Number of blocks processed concurrently.
     """
     # TODO: There are inconsistencies with the watershed algorithm, if there is
     # anisotropy in xy and z
-    if sigma:
-        img_processed = gaussian(img, sigma=sigma, preserve_range=True).astype('uint16')
-        min_distance = int(np.round(sigma))
+    min_distance = int(np.round(sigma)) if sigma else 1
+
+    def _smooth(block):
+        if not sigma:
+            return block.astype(np.float32, copy=False) if float_watershed else block
+        # float32 (the image is usually normalized to [0, 1])
+        smoothed = ndimage.gaussian_filter(
+            block, sigma, mode="nearest", output=np.float32
+        )
+        if float_watershed:
+            return smoothed
+        np.rint(smoothed, out=smoothed)
+        np.clip(smoothed, 0, np.iinfo(np.uint16).max, out=smoothed)
+        return smoothed.astype(np.uint16)
+
+    def _find_maxima(img_processed, block_mask):
+        return peak_local_max(
+            img_processed,
+            labels=block_mask,
+            min_distance=min_distance,
+            exclude_border=False,
+        )
+
+    n_z = img.shape[0]
+    if img.ndim != 3 or not z_block_size or z_block_size >= n_z:
+        img_processed = _smooth(img)
+        coords = _find_maxima(img_processed, mask)
+        maximas = np.zeros(img.shape, dtype=bool)
+        maximas[tuple(coords.T)] = True
+        maximas, _ = ndimage.label(maximas)
+        return watershed(-img_processed, maximas, mask=mask)
+
+    halo = (int(4 * sigma + 0.5) if sigma else 0) + 2 * min_distance
+    blocks = []
+    for start in range(0, n_z, z_block_size):
+        stop = min(start + z_block_size, n_z)
+        blocks.append((start, stop, max(start - halo, 0), min(stop + halo, n_z)))
+
+    # smooth & find maxima per block (keeping maxima in the block's core)
+    if float_watershed:
+        processed_dtype = np.float32
     else:
-        img_processed = img
-        min_distance = 1
-    coords = peak_local_max(
-        img_processed, labels=mask, min_distance=min_distance, exclude_border=False
-    )
+        processed_dtype = "uint16" if sigma else img.dtype
+    img_processed = np.empty(img.shape, dtype=processed_dtype)
     maximas = np.zeros(img.shape, dtype=bool)
-    maximas[tuple(coords.T)] = True
+
+    def _block_maxima(block):
+        start, stop, halo_start, halo_stop = block
+        block_processed = _smooth(img[halo_start:halo_stop])
+        coords = _find_maxima(block_processed, mask[halo_start:halo_stop])
+        coords[:, 0] += halo_start
+        coords = coords[(coords[:, 0] >= start) & (coords[:, 0] < stop)]
+        img_processed[start:stop] = block_processed[
+            start - halo_start : stop - halo_start
+        ]
+        maximas[tuple(coords.T)] = True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_block_maxima, blocks))
     maximas, _ = ndimage.label(maximas)
-    labels = watershed(-img_processed, maximas, mask=mask)
+
+    # watershed per block, with the seeds labelled for the whole stack
+    labels = np.zeros(img.shape, dtype=maximas.dtype)
+
+    def _block_watershed(block):
+        start, stop, halo_start, halo_stop = block
+        block_labels = watershed(
+            -img_processed[halo_start:halo_stop],
+            maximas[halo_start:halo_stop],
+            mask=mask[halo_start:halo_stop],
+        )
+        labels[start:stop] = block_labels[start - halo_start : stop - halo_start]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_block_watershed, blocks))
     return labels
 
 
@@ -228,6 +443,9 @@ def segment_ROI(
     fill_2d: bool = True,
     fill_max_size: float = 1000,
     normalize: CustomNormalizer = None,
+    z_block_size: Optional[int] = None,
+    float_watershed: bool = False,
+    max_workers: int = 1,
 ):
     """Instance spot-segmentation via laplacian of gaussian and intensity-watershed
 
@@ -247,6 +465,12 @@ def segment_ROI(
             You can turn off the default rescaling. With the "custom" option,
             you can either provide your own rescaling percentiles or fixed
             rescaling upper and lower bound integers.
+        z_block_size: Number of z-planes per block of the watershed (see
+            `separate_watershed`). If None (or 0), the full stack is used.
+        float_watershed: If True, the watershed uses the smoothed image as
+            float32 instead of uint16 (see `separate_watershed`).
+        max_workers: Number of z-planes (and watershed blocks) processed
+            concurrently.
     """
     if normalize is None:
         normalize = CustomNormalizer()
@@ -271,8 +495,10 @@ def segment_ROI(
         raise ValueError("Input image should have only one channel")
     img_zyx = img[0]
 
+    # planes are segmented concurrently (the filters release the GIL)
     mask = np.empty_like(img_zyx, dtype="bool")
-    for z in range(img_zyx.shape[0]):
+
+    def _spot_mask(z):
         mask[z] = spot_mask_2D(
             img_zyx[z],
             gaussian_smoothing_sigma,
@@ -280,7 +506,17 @@ def segment_ROI(
             fill_2d,
             fill_max_size,
         )
-    labels = separate_watershed(img_zyx, mask, gaussian_smoothing_sigma)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(_spot_mask, range(img_zyx.shape[0])))
+    labels = separate_watershed(
+        img_zyx,
+        mask,
+        gaussian_smoothing_sigma,
+        z_block_size=z_block_size,
+        float_watershed=float_watershed,
+        max_workers=max_workers,
+    )
     return np.reshape(labels, img.shape)
 
 
@@ -1,15 +1,24 @@
 """Fractal task to estimate background using SMO."""
 
+import functools
+import math
+from collections import Counter
+from collections.abc import Sequence
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
 import numpy as np
 import pandas as pd
-from ngio import open_ome_zarr_container
+from ngio import Roi, open_ome_zarr_container
+from ngio.images import Image
 from ngio.tables import FeatureTable
 from pydantic import validate_call
 from smo import SMO
 
+from zmb_fractal_tasks.utils.halo import roi_halo_slices
+from zmb_fractal_tasks.utils.parallel import bounded_map
+from zmb_fractal_tasks.utils.pyramid import DirtyRegions, update_stale_pyramid
+
 
 @validate_call
 def smo_background_estimation(
@@ -18,9 +27,13 @@ def smo_background_estimation(
     pyramid_level: str = "0",
     sigma: float = 0.0,
     size: int = 7,
+    estimate_per_plane: bool = False,
     subtract_background: bool = False,
     overwrite_input_image: bool = True,
     new_well_subgroup_suffix: str = "_BG_subtracted",
+    defer_consolidation: bool = False,
+    # Parallelization
+    max_workers: int = 1,
 ) -> dict[str, Any]:
     """Estimates background of each FOV using SMO.
 
@@ -28,7 +41,10 @@ def smo_background_estimation(
     short, SMO uses local gradient amount to identify background pixels. See
     the SMO publication for details: https://doi.org/10.1364/JOSAA.477468
 
-    Limitation: Currently, does not support 3D or time-lapse images.
+    3D & time-lapse images are processed plane by plane, so only one
+    yx-plane per worker is held in memory. The BG value of a FOV & channel
+    is the median of the BG pixels of all its planes of a timepoint (or of
+    each plane, if estimate_per_plane).
 
     Args:
         zarr_url: Absolute path to the OME-Zarr image.
@@ -38,6 +54,9 @@ def smo_background_estimation(
         sigma: Standard deviation for Gaussian pre-filter to reduce noise.
         size: Window size in pixels to average gradient. Should be smaller than
             foreground objects & background regions.
+        estimate_per_plane: If True, estimate the BG of each z-plane
+            separately. Otherwise, estimate one BG value per FOV, channel &
+            timepoint.
         subtract_background: If True, subtract the estimated background from
             the image (clipping at zero).
         overwrite_input_image: If True, overwrite the input image. If False,
@@ -45,41 +64,28 @@ def smo_background_estimation(
             if subtract_background is True.
         new_well_subgroup_suffix: Suffix to add to the new well sub-group
             name. Only used if overwrite_input_image is False.
+        defer_consolidation: If `True`, the pyramid levels of the output
+            image are not updated, but only marked as stale. They are built
+            later from level 0 (e.g. by the 'Build pyramids' task, or by a
+            task reading a coarser level). Only used if subtract_background is
+            True.
+        max_workers: Number of planes processed concurrently.
     """
     omezarr = open_ome_zarr_container(zarr_url)
     source_image = omezarr.get_image(path=pyramid_level)
+    update_stale_pyramid(source_image)
 
-    # TODO: support time-lapses?
-    if source_image.is_time_series:
-        if source_image.dimensions.get("t") > 1:
-            raise ValueError(
-                "SMO background estimation does not yet support time-lapse images."
-            )
     # TODO: Add options for iterating & masking
     roi_table = omezarr.get_table("FOV_ROI_table")
 
     channels = source_image.channel_labels
+    if source_image.is_time_series:
+        timepoints = list(range(source_image.dimensions.get("t")))
+    else:
+        timepoints = [None]
 
-    # Estimate BG for each FOV & channel
-    list_of_dfs = []
-    for r, roi in enumerate(roi_table.rois()):
-        roi_df = pd.DataFrame(data=[{"label": r, "ROI": roi.name}])
-        for channel in channels:
-            channel_idx = source_image.channel_labels.index(channel)
-            patch = source_image.get_roi(roi, c=channel_idx)
-            bg_value = estimate_BG_smo(patch, sigma, size)
-            roi_df[f"BG_{channel}"] = bg_value
-        list_of_dfs.append(roi_df)
-    # create feature table
-    feat_df = pd.concat(list_of_dfs, ignore_index=True)
-    feat_table = FeatureTable(feat_df, reference_label=None)
-    omezarr.add_table("BG_feature_table", feat_table, overwrite=True)
-
-    # Apply BG subtraction
+    # open output image
     if subtract_background:
-        # open source image again at highest resolution
-        source_image = omezarr.get_image()
-        # open new ome-zarr
         if overwrite_input_image:
             output_omezarr = omezarr
         else:
@@ -87,22 +93,94 @@ def smo_background_estimation(
                 Path(zarr_url).stem + new_well_subgroup_suffix
             )
             output_omezarr = omezarr.derive_image(new_zarr_url, overwrite=True)
+            # TODO: copy all labels? -> how best?
+        output_image = output_omezarr.get_image()
+        dirty_regions = DirtyRegions(output_image)
+        n_z = source_image.dimensions.get("z")
+        if estimate_per_plane and n_z != output_image.dimensions.get("z"):
+            raise ValueError(
+                "Per-plane BG estimation & subtraction requires a pyramid level "
+                "with the same number of z-planes as level 0."
+            )
+
+    # Each plane is processed on its own. Its BG pixels are accumulated per
+    # FOV, channel & timepoint (and z-plane, if estimate_per_plane).
+    rois = roi_table.rois()
+    planes = fov_planes(source_image, rois, channels, timepoints)
+    planes_per_key = Counter(_bg_key(plane, estimate_per_plane) for plane in planes)
+
+    # If the BG is estimated at full resolution & each BG value belongs to a
+    # single plane, each plane is only read once: its BG is estimated &
+    # subtracted in the same pass
+    fused = (
+        subtract_background
+        and source_image.path == source_image.meta.paths[0]
+        and max(planes_per_key.values(), default=1) == 1
+    )
+
+    def _estimate_BG(plane):
+        *_, slices = plane
+        data = source_image.get_array(axes_order="yx", **slices)
+        bg_median = MedianAccumulator(smo_bg_pixels(data, sigma, size))
+        if fused:
+            subtract_BG(data, bg_median.median(), out=data)
+        return bg_median, data
+
+    bg_medians: dict[tuple, MedianAccumulator] = {}
+    results = bounded_map(_estimate_BG, planes, max_workers=max_workers)
+    for plane, (bg_median, data) in zip(planes, results, strict=True):
+        key = _bg_key(plane, estimate_per_plane)
+        if key in bg_medians:
+            bg_medians[key].merge(bg_median)
+        else:
+            bg_medians[key] = bg_median
+        if fused:
+            *_, slices = plane
+            output_image.set_array(data, axes_order="yx", **slices)
+            dirty_regions.add(**slices)
+    bg_values = {key: bg_median.median() for key, bg_median in bg_medians.items()}
+
+    # create feature table: one row per FOV & timepoint (& z-plane)
+    rows: dict[tuple, dict[str, Any]] = {}
+    for (r, channel, t, z), bg_value in bg_values.items():
+        if (r, t, z) not in rows:
+            row = {"label": len(rows), "ROI": rois[r].name}
+            if t is not None:
+                row["t"] = t
+            if z is not None:
+                row["z"] = z
+            rows[r, t, z] = row
+        rows[r, t, z][f"BG_{channel}"] = bg_value
+    feat_df = pd.DataFrame(list(rows.values()))
+    feat_table = FeatureTable(feat_df, reference_label=None)
+    omezarr.add_table("BG_feature_table", feat_table, overwrite=True)
+
+    # Apply BG subtraction
+    if subtract_background:
+        if not overwrite_input_image:
             # copy all tables
             for table_name in omezarr.list_tables():
                 output_omezarr.add_table(table_name, omezarr.get_table(table_name))
-            # TODO: copy all labels? -> how best?
-        output_image = output_omezarr.get_image()
 
-        # cycle through FOVs and channels and subtract BG
-        for roi in roi_table.rois():
-            for channel in channels:
-                channel_idx = source_image.channel_labels.index(channel)
-                bg = feat_df.loc[feat_df["ROI"] == roi.name, f"BG_{channel}"].values[0]
-                patch = source_image.get_roi(roi, c=channel_idx)
-                patch_corrected = subtract_BG(patch, bg)
-                output_image.set_roi(patch=patch_corrected, roi=roi, c=channel_idx)
+        if not fused:
+            # open source image again at highest resolution
+            source_image = omezarr.get_image()
+            planes = fov_planes(source_image, rois, channels, timepoints)
+
+            # cycle through planes and subtract BG
+            def _subtract_BG(plane):
+                *_, slices = plane
+                data = source_image.get_array(axes_order="yx", **slices)
+                bg_value = bg_values[_bg_key(plane, estimate_per_plane)]
+                return subtract_BG(data, bg_value, out=data)
+
+            results = bounded_map(_subtract_BG, planes, max_workers=max_workers)
+            for (*_, slices), data in zip(planes, results, strict=True):
+                output_image.set_array(data, axes_order="yx", **slices)
+                dirty_regions.add(**slices)
 
-        output_image.consolidate()
+        # Update the pyramid where the image was corrected
+        dirty_regions.consolidate(defer=defer_consolidation)
 
         if overwrite_input_image:
             image_list_updates = {}
@@ -116,6 +194,55 @@ def smo_background_estimation(
     return image_list_updates
 
 
+# plane of a FOV: (ROI index, channel, t, z, slicing kwargs)
+Plane = tuple[int, str, Optional[int], int, dict[str, Any]]
+
+
+def fov_planes(
+    image: Image,
+    rois: Sequence[Roi],
+    channels: Sequence[str],
+    timepoints: Sequence[Optional[int]] = (None,),
+) -> list[Plane]:
+    """List the yx-planes of each FOV, channel & timepoint of an image.
+
+    Args:
+        image: Image to read the planes from.
+        rois: FOV ROIs.
+        channels: Channel labels.
+        timepoints: Timepoints (or None, if the image is not a time series).
+
+    Returns:
+        (ROI index, channel, t, z, slices) of each plane, where slices can be
+        passed to `image.get_array(axes_order="yx", **slices)`. An image
+        without a z axis has a single plane (z=0) per FOV.
+    """
+    planes = []
+    for r, roi in enumerate(rois):
+        _, fov_slices, _ = roi_halo_slices(roi, image, halo={})
+        z_slice = fov_slices.get("z")
+        z_planes = [None] if z_slice is None else range(z_slice.start, z_slice.stop)
+        for channel in channels:
+            channel_idx = image.channel_labels.index(channel)
+            for t in timepoints:
+                for z in z_planes:
+                    slices = {**fov_slices, "c": channel_idx}
+                    if z is not None:
+                        slices["z"] = z
+                    if t is not None:
+                        slices["t"] = t
+                    planes.append((r, channel, t, z or 0, slices))
+    return planes
+
+
+def _bg_key(
+    plane: Plane, per_plane: bool
+) -> tuple[int, str, Optional[int], Optional[int]]:
+    """Key of the BG value of a plane: (ROI index, channel, t, z or None)."""
+    r, channel, t, z, _ = plane
+    return r, channel, t, z if per_plane else None
+
+
 def estimate_BG_smo(patch: np.ndarray, sigma: float, size: int) -> float:
     """Estimate background using SMO.
 
@@ -125,30 +252,146 @@ def estimate_BG_smo(patch: np.ndarray, sigma: float, size: int) -> float:
         size : Averaging window size in pixels. Should be smaller than
             foreground objects.
     """
+    return median(smo_bg_pixels(patch, sigma, size))
+
+
+def smo_bg_pixels(patch: np.ndarray, sigma: float, size: int) -> np.ndarray:
+    """Get the values of the background pixels of an image, using SMO.
+
+    Args:
+        patch: nD numpy array (image to find the BG pixels of)
+        sigma : Standard deviation for Gaussian kernel of pre-filter.
+        size : Averaging window size in pixels. Should be smaller than
+            foreground objects.
+
+    Returns:
+        1D array of the values of the BG pixels.
+    """
     # remove singleton dimensions
     image = np.squeeze(patch)
-    # initialize SMO
-    smo = SMO(sigma=sigma, size=size, shape=image.shape)
-    # estimate BG
+    # SMO operator is shared by all images of the same shape
+    smo = get_smo(sigma=sigma, size=size, shape=image.shape)
     # TODO: expose threshold as parameter?
-    bg_value = np.median(smo.bg_mask(image, threshold=0.05).compressed())
-    return bg_value
+    bg_mask = smo.bg_mask(image, threshold=0.05)
+    return bg_mask.data[~np.ma.getmaskarray(bg_mask)]
+
+
+@functools.lru_cache(maxsize=16)
+def get_smo(sigma: float, size: int, shape: tuple[int, ...]) -> SMO:
+    """Get an SMO operator (cached, since its setup is as costly as one image).
+
+    Args:
+        sigma: Standard deviation for Gaussian kernel of pre-filter.
+        size: Averaging window size in pixels.
+        shape: Shape of the images.
+    """
+    return SMO(sigma=sigma, size=size, shape=shape)
 
 
-def subtract_BG(patch: np.ndarray, bg_value: float) -> np.ndarray:
+class MedianAccumulator:
+    """Median of values that are added in parts (e.g. plane by plane).
+
+    Values of 8/16-bit integer dtypes are counted in a histogram of all
+    possible values, so parts are merged cheaply & the memory use doesn't
+    grow with the number of values. Other values are kept until the median
+    is calculated.
+    """
+
+    def __init__(self, values: Optional[np.ndarray] = None):
+        """Start accumulating values.
+
+        Args:
+            values: Optional first values to add.
+        """
+        self._counts: Optional[np.ndarray] = None
+        self._offset = 0
+        self._values: list[np.ndarray] = []
+        if values is not None:
+            self.add(values)
+
+    def add(self, values: np.ndarray) -> None:
+        """Add values (of any shape)."""
+        values = np.ravel(values)
+        if values.dtype.kind in "ui" and values.dtype.itemsize <= 2:
+            info = np.iinfo(values.dtype)
+            if info.min != 0:
+                values = values.astype(np.intp) - info.min
+            n_bins = info.max - info.min + 1
+            self._add_counts(np.bincount(values, minlength=n_bins), int(info.min))
+        else:
+            self._values.append(values)
+
+    def merge(self, other: "MedianAccumulator") -> None:
+        """Add all values of another accumulator."""
+        if other._counts is not None:
+            self._add_counts(other._counts, other._offset)
+        self._values.extend(other._values)
+
+    def median(self) -> float:
+        """Median of all values (same as `np.median`)."""
+        if self._counts is None:
+            return float(np.median(np.concatenate(self._values or [[]])))
+        if self._values:
+            values = np.repeat(np.arange(self._counts.size), self._counts)
+            values = np.concatenate([values + self._offset, *self._values])
+            return float(np.median(values))
+        cumulative_counts = np.cumsum(self._counts)
+        n = int(cumulative_counts[-1])
+        if n == 0:
+            return float(np.median([]))
+        lower, upper = np.searchsorted(
+            cumulative_counts, [(n - 1) // 2, n // 2], side="right"
+        )
+        return (lower + upper) / 2 + self._offset
+
+    def _add_counts(self, counts: np.ndarray, offset: int) -> None:
+        """Add a histogram of values (counts[i] = count of value i + offset)."""
+        if self._counts is None:
+            self._counts, self._offset = counts.copy(), offset
+        elif offset == self._offset and counts.size == self._counts.size:
+            self._counts += counts
+        else:
+            # histograms of different dtypes: keep the values instead
+            self._values.append(np.repeat(np.arange(counts.size) + offset, counts))
+
+
+def median(values: np.ndarray) -> float:
+    """Median of a 1D array, using a histogram for 8/16-bit integers.
+
+    Gives the same result as `np.median`, but counting integer values is
+    faster than partitioning them.
+    """
+    return MedianAccumulator(values).median()
+
+
+def subtract_BG(
+    patch: np.ndarray,
+    bg_value: float,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
     """Subtract background from an image, clipping at zero.
 
+    For integer images, the result is truncated (like casting the float
+    result back to the integer dtype).
+
     Args:
         patch: nD numpy array (image to subtract BG from)
         bg_value: background value to subtract
+        out: Optional output array with the shape & dtype of patch. Can be
+            patch itself, to subtract in place.
     """
-    dtype = patch.dtype
-    new_img = np.where(
-        patch > bg_value,
-        patch - bg_value,
-        0,
-    )
-    return new_img.astype(dtype)
+    if out is None:
+        out = np.empty_like(patch)
+    if np.isnan(bg_value):
+        out[...] = 0
+        return out
+    if np.issubdtype(patch.dtype, np.integer):
+        # p - bg truncated, for p > bg, is p - ceil(bg)
+        bg_value = min(math.ceil(bg_value), np.iinfo(patch.dtype).max)
+    # max(p, bg) - bg == max(p - bg, 0)
+    np.maximum(patch, bg_value, out=out)
+    np.subtract(out, bg_value, out=out)
+    return out
 
 
 if __name__ == "__main__":
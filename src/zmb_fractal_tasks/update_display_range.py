@@ -8,6 +8,8 @@ import zarr
 from ngio import open_ome_zarr_container
 from pydantic import validate_call
 
+from zmb_fractal_tasks.utils.pyramid import update_stale_pyramid
+
 
 @validate_call
 def update_display_range(
@@ -36,6 +38,7 @@ def update_display_range(
     omezarr = open_ome_zarr_container(zarr_url)
 
     image = omezarr.get_image(path=pyramid_level)
+    update_stale_pyramid(image)
 
     roi_table = omezarr.get_table("FOV_ROI_table")
 
@@ -0,0 +1,278 @@
+"""Vectorized grouped aggregation of feature tables."""
+
+from collections.abc import Sequence
+
+import numpy as np
+import pandas as pd
+
+# aggregation methods that are computed by segment reductions. All other
+# methods are delegated to pandas.
+SEGMENT_AGGREGATIONS = ("count", "sum", "mean", "std", "sem", "min", "max")
+
+
+class GroupedStats:
+    """Mergeable per-group statistics of a block of numeric columns.
+
+    The statistics are stored as partial moments (count, sum, sum of squared
+    deviations from the mean, min & max) per group and column. This allows to
+    compute them in one sorted pass with `np.add.reduceat`-style segment
+    reductions, and to merge statistics of different tables (e.g. of different
+    images) without keeping the underlying rows in memory.
+
+    NaN values are ignored, like in pandas.
+
+    self.keys is a (sorted) pandas Index of the group keys.
+    self.columns is the list of aggregated column names.
+    self.size is the number of rows (objects) of each group (n_groups,).
+    self.count, self.sum, self.m2, self.min, self.max are 2D arrays of shape
+    (n_groups, n_columns).
+    """
+
+    def __init__(
+        self,
+        keys: pd.Index,
+        columns: Sequence[str],
+        count: np.ndarray,
+        sum: np.ndarray,
+        m2: np.ndarray,
+        min: np.ndarray,
+        max: np.ndarray,
+        size: np.ndarray,
+    ):
+        """Initialize from precomputed partial moments & group sizes."""
+        self.keys = keys
+        self.columns = list(columns)
+        self.size = size
+        self.count = count
+        self.sum = sum
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    @classmethod
+    def from_dataframe(
+        cls,
+        df: pd.DataFrame,
+        by: str | Sequence[str],
+        columns: Sequence[str],
+        block_size: int = 16,
+    ) -> "GroupedStats":
+        """Compute grouped statistics of columns of a dataframe.
+
+        Args:
+            df: Dataframe containing the grouping and value columns.
+            by: Name of the column (or list of columns) to group by. Rows with
+                missing group keys are dropped.
+            columns: Names of the numeric columns to aggregate.
+            block_size: Number of columns that are reduced together.
+        """
+        columns = list(columns)
+        codes, keys = _factorize(df, by)
+        valid = codes >= 0
+        codes = codes[valid]
+        n_groups = len(keys)
+        n_cols = len(columns)
+
+        count = np.zeros((n_groups, n_cols), dtype=np.float64)
+        sums = np.zeros((n_groups, n_cols), dtype=np.float64)
+        m2 = np.zeros((n_groups, n_cols), dtype=np.float64)
+        mins = np.full((n_groups, n_cols), np.nan, dtype=np.float64)
+        maxs = np.full((n_groups, n_cols), np.nan, dtype=np.float64)
+        if n_groups == 0:
+            size = np.zeros(0, dtype=np.int64)
+            return cls(keys, columns, count, sums, m2, mins, maxs, size)
+
+        # sort once by group, so that each group is a contiguous segment
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        order = np.flatnonzero(valid)[order]  # row positions in df
+        starts = np.searchsorted(codes, np.arange(n_groups), side="left")
+        sizes = np.diff(np.append(starts, len(codes)))
+
+        # reduce blocks of columns, to bound the size of temporary arrays.
+        # (Each column is stored contiguously, so reductions run along rows.)
+        for b in range(0, n_cols, block_size):
+            block = slice(b, min(b + block_size, n_cols))
+            values = np.empty((block.stop - block.start, len(codes)))
+            for i, column in enumerate(columns[block]):
+                np.take(_to_float(df[column]), order, out=values[i])
+            isnan = np.isnan(values)
+            has_nan = isnan.any()
+            if has_nan:
+                nan_count = np.add.reduceat(isnan, starts, axis=1, dtype=np.int64)
+                count[:, block] = (sizes - nan_count).T
+                values[isnan] = np.inf
+            else:
+                count[:, block] = sizes[:, None]
+            mins[:, block] = np.minimum.reduceat(values, starts, axis=1).T
+            if has_nan:
+                values[isnan] = -np.inf
+            maxs[:, block] = np.maximum.reduceat(values, starts, axis=1).T
+            if has_nan:
+                values[isnan] = 0.0
+            sums[:, block] = np.add.reduceat(values, starts, axis=1).T
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean = sums[:, block] / count[:, block]
+            np.subtract(values, mean.T[:, codes], out=values)
+            if has_nan:
+                values[isnan] = 0.0
+            np.square(values, out=values)
+            m2[:, block] = np.add.reduceat(values, starts, axis=1).T
+        empty_groups = count == 0
+        mins[empty_groups] = np.nan
+        maxs[empty_groups] = np.nan
+        return cls(keys, columns, count, sums, m2, mins, maxs, sizes.astype(np.int64))
+
+    def merge(self, other: "GroupedStats") -> "GroupedStats":
+        """Combine with statistics of another table (with the same columns)."""
+        if self.columns != other.columns:
+            raise ValueError("Cannot merge statistics of different columns")
+        keys = self.keys.union(other.keys)
+        n_groups, n_cols = len(keys), len(self.columns)
+        arrays = {}
+        for name, fill in (
+            ("count", 0.0),
+            ("sum", 0.0),
+            ("m2", 0.0),
+            ("min", np.nan),
+            ("max", np.nan),
+        ):
+            arrays[name] = []
+            for stats in (self, other):
+                arr = np.full((n_groups, n_cols), fill, dtype=np.float64)
+                arr[keys.get_indexer(stats.keys)] = getattr(stats, name)
+                arrays[name].append(arr)
+
+        size = np.zeros(n_groups, dtype=np.int64)
+        for stats in (self, other):
+            size[keys.get_indexer(stats.keys)] += stats.size
+
+        count_a, count_b = arrays["count"]
+        sum_a, sum_b = arrays["sum"]
+        count = count_a + count_b
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = sum_b / count_b - sum_a / count_a
+            correction = delta**2 * count_a * count_b / count
+        # groups that are empty on one side don't need a correction
+        correction[(count_a == 0) | (count_b == 0)] = 0.0
+        m2 = arrays["m2"][0] + arrays["m2"][1] + correction
+        return GroupedStats(
+            keys,
+            self.columns,
+            count,
+            sum_a + sum_b,
+            m2,
+            np.fmin(*arrays["min"]),
+            np.fmax(*arrays["max"]),
+            size,
+        )
+
+    def get(self, method: str) -> np.ndarray:
+        """Get aggregated values of all columns (n_groups, n_columns).
+
+        Args:
+            method: One of 'count', 'sum', 'mean', 'std', 'sem', 'min', 'max'.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if method == "count":
+                return self.count.astype(np.int64)
+            if method == "sum":
+                return self.sum
+            if method == "mean":
+                return np.where(self.count > 0, self.sum / self.count, np.nan)
+            if method in ("std", "sem"):
+                # sample standard deviation (ddof=1), like pandas
+                std = np.where(
+                    self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan
+                )
+                if method == "std":
+                    return std
+                return std / np.sqrt(self.count)
+            if method == "min":
+                return self.min
+            if method == "max":
+                return self.max
+        raise ValueError(
+            f"Aggregation method '{method}' not supported. "
+            f"Supported methods are: {SEGMENT_AGGREGATIONS}"
+        )
+
+
+def grouped_aggregate(
+    df: pd.DataFrame,
+    by: str | Sequence[str],
+    columns: Sequence[str],
+    methods: Sequence[str],
+) -> dict[tuple[str, str], pd.Series]:
+    """Aggregate columns of a dataframe per group with multiple methods.
+
+    Methods in SEGMENT_AGGREGATIONS are computed for all numeric columns
+    together via segment reductions. Other methods (or non-numeric columns)
+    fall back to pandas groupby.
+
+    Args:
+        df: Dataframe containing the grouping and value columns.
+        by: Name of the column (or list of columns) to group by.
+        columns: Names of the columns to aggregate.
+        methods: Aggregation methods, e.g. 'mean', 'std'.
+
+    Returns:
+        Dictionary mapping (column, method) to a Series indexed by the sorted
+        group keys.
+    """
+    numeric_columns = [
+        c
+        for c in dict.fromkeys(columns)
+        if pd.api.types.is_numeric_dtype(df[c])
+        and not pd.api.types.is_bool_dtype(df[c])
+    ]
+    stats = GroupedStats.from_dataframe(df, by=by, columns=numeric_columns)
+    index = stats.keys.copy()
+
+    results = {}
+    fallback = []
+    for method in dict.fromkeys(methods):
+        if method not in SEGMENT_AGGREGATIONS:
+            fallback.extend((c, method) for c in columns)
+            continue
+        values = stats.get(method)
+        for i, column in enumerate(numeric_columns):
+            series = pd.Series(values[:, i], index=index)
+            results[(column, method)] = _restore_dtype(series, df[column], method)
+        fallback.extend((c, method) for c in columns if c not in numeric_columns)
+
+    if fallback:
+        group = df.groupby(by=by)
+        df_fallback = group.agg(**{f"{c}\0{m}": (c, m) for c, m in fallback})
+        df_fallback = df_fallback.reindex(index)
+        for column, method in fallback:
+            results[(column, method)] = df_fallback[f"{column}\0{method}"]
+    return results
+
+
+def _factorize(
+    df: pd.DataFrame, by: str | Sequence[str]
+) -> tuple[np.ndarray, pd.Index]:
+    """Get integer group codes (-1 for missing keys) and sorted group keys."""
+    if isinstance(by, str):
+        codes, uniques = pd.factorize(df[by], sort=True)
+        return codes, pd.Index(uniques, name=by)
+    group = df.groupby(by=list(by), sort=True)
+    codes = group.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    return codes, group.size().index
+
+
+def _to_float(series: pd.Series) -> np.ndarray:
+    """Convert a (possibly nullable) numeric series to float64 with NaNs."""
+    return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _restore_dtype(result: pd.Series, source: pd.Series, method: str) -> pd.Series:
+    """Keep integer dtype for sum/min/max of integer columns, like pandas."""
+    if (
+        method in ("sum", "min", "max")
+        and pd.api.types.is_integer_dtype(source)
+        and not result.isna().any()
+    ):
+        return result.astype(source.dtype)
+    return result
@@ -0,0 +1,47 @@
+"""Cellpose models shared within a worker process.
+
+Building a Cellpose model loads its weights from disk & initializes torch,
+which can take longer than segmenting a batch of ROIs. Models are therefore
+built lazily & kept in a small LRU cache, so tasks running in a long-lived
+worker (or segmenting batch by batch) build each model only once.
+"""
+
+import functools
+from typing import Optional
+
+import torch
+from cellpose import models
+
+# number of models kept in memory
+MAX_CACHED_MODELS = 4
+
+
+def get_cellpose_model(
+    model_type: str = "nuclei",
+    gpu: bool = False,
+    torch_threads: Optional[int] = None,
+) -> models.Cellpose:
+    """Get a Cellpose model (cached per process).
+
+    Args:
+        model_type: Type of cellpose model.
+        gpu: If `True`, run the model on the GPU.
+        torch_threads: Number of threads torch uses for CPU inference. This
+            is a process-wide setting, applied on each call (the cached model
+            doesn't depend on it). If None, the current setting is kept (by
+            default, all cores).
+    """
+    if torch_threads is not None:
+        torch.set_num_threads(torch_threads)
+    return _get_cellpose_model(model_type, gpu)
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_MODELS)
+def _get_cellpose_model(model_type: str, gpu: bool) -> models.Cellpose:
+    """Build a Cellpose model (cached by model type & device)."""
+    return models.Cellpose(gpu=gpu, model_type=model_type)
+
+
+def clear_cellpose_models() -> None:
+    """Remove all cached models (e.g. to free GPU memory)."""
+    _get_cellpose_model.cache_clear()
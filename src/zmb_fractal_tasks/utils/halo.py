@@ -0,0 +1,59 @@
+"""Helpers to process ROIs together with a margin (halo) of their neighbours."""
+
+import math
+from collections.abc import Mapping
+
+from ngio import Roi
+from ngio.images import Image, Label
+
+
+def roi_halo_slices(
+    roi: Roi,
+    image: Image | Label,
+    halo: Mapping[str, int],
+) -> tuple[dict[str, slice], dict[str, slice], tuple[slice, ...]]:
+    """Get pixel slices of a ROI and of the ROI extended by a halo.
+
+    The extended region is clipped to the image. Reading the extended region,
+    processing it and writing back only the core region avoids artifacts at
+    the borders of the ROI (e.g. seams between neighbouring FOVs).
+
+    Like ngio's `get_roi`, fractional pixel coordinates are converted with
+    floor (start) & ceil (stop). Axes the image doesn't have (e.g. z of a yx
+    label) are left out of the slicing dictionaries.
+
+    Args:
+        roi: ROI in world coordinates.
+        image: Image or label the ROI refers to.
+        halo: Margin in pixels per axis, e.g. {"z": 1, "y": 10, "x": 10}.
+            Missing axes get no margin.
+
+    Returns:
+        Slicing dictionary of the extended region, slicing dictionary of the
+        ROI (both to be passed to `get_array`/`set_array`), and the slices of
+        the ROI within a "zyx" array of the extended region (a missing axis
+        is a singleton, of which the full slice is taken).
+    """
+    roi_pixels = roi.to_roi_pixels(image.pixel_size)
+    extended_slices = {}
+    core_slices = {}
+    core_in_extended = []
+    for axis in ("z", "y", "x"):
+        size = image.dimensions.get(axis)
+        if size is None:
+            core_in_extended.append(slice(None))
+            continue
+        start = getattr(roi_pixels, axis)
+        length = getattr(roi_pixels, f"{axis}_length")
+        if start is None or length is None:
+            start, stop = 0, size
+        else:
+            start, stop = math.floor(start), math.ceil(start + length)
+            start, stop = max(start, 0), min(stop, size)
+        margin = halo.get(axis, 0)
+        extended_start = max(start - margin, 0)
+        extended_stop = min(stop + margin, size)
+        extended_slices[axis] = slice(extended_start, extended_stop)
+        core_slices[axis] = slice(start, stop)
+        core_in_extended.append(slice(start - extended_start, stop - extended_start))
+    return extended_slices, core_slices, tuple(core_in_extended)
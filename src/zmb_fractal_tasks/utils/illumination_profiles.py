@@ -0,0 +1,167 @@
+"""Store & load illumination profiles, shared within a worker process.
+
+A profile is stored as a folder of .npy files (one folder per channel):
+- flatfield.npy: flatfield (yx)
+- inv_flatfield.npy: reciprocal of the flatfield (float32), as used to
+  correct images
+- darkfield.npy: darkfield (float32, yx). Absent if the darkfield is zero.
+- baseline.npy: baseline of each image used to calculate the profile
+  (optional)
+
+The arrays are memory-mapped read-only, so all processes on a node that
+apply the same profile share one copy in the page cache. Loaded profiles
+are cached, so each process loads a profile only once.
+"""
+
+import functools
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import tifffile
+
+
+class IlluminationProfile:
+    """Illumination profile of one channel, ready to correct images.
+
+    Attributes:
+        inv_flatfield: Reciprocal of the flatfield (float32, yx).
+        darkfield: Darkfield (float32, yx), or None if it is zero.
+        baseline: Baselines of the images used to calculate the profile, or
+            None if not available.
+    """
+
+    def __init__(
+        self,
+        inv_flatfield: np.ndarray,
+        darkfield: Optional[np.ndarray] = None,
+        baseline: Optional[np.ndarray] = None,
+    ):
+        """Create a profile from precomputed arrays.
+
+        Args:
+            inv_flatfield: Reciprocal of the flatfield (yx).
+            darkfield: Darkfield (yx), or None if it is zero.
+            baseline: Baselines of the images used to calculate the profile.
+        """
+        self.inv_flatfield = inv_flatfield
+        self.darkfield = darkfield
+        self.baseline = baseline
+
+    @classmethod
+    def from_arrays(
+        cls,
+        flatfield: np.ndarray,
+        darkfield: Optional[np.ndarray] = None,
+        baseline: Optional[np.ndarray] = None,
+    ) -> "IlluminationProfile":
+        """Create a profile from a flatfield (and darkfield).
+
+        Args:
+            flatfield: Flatfield (yx).
+            darkfield: Darkfield (yx). Dropped if it is zero.
+            baseline: Baselines of the images used to calculate the profile.
+        """
+        if darkfield is not None:
+            if darkfield.shape != flatfield.shape:
+                raise ValueError(
+                    "Error in illumination profile:\n"
+                    f"{flatfield.shape=}\n{darkfield.shape=}"
+                )
+            darkfield = darkfield.astype(np.float32) if darkfield.any() else None
+        return cls(np.reciprocal(flatfield, dtype=np.float32), darkfield, baseline)
+
+
+def save_illumination_profile(
+    folder_path: str | Path,
+    flatfield: np.ndarray,
+    darkfield: Optional[np.ndarray] = None,
+    baseline: Optional[np.ndarray] = None,
+) -> None:
+    """Save an illumination profile to a (new or empty) folder.
+
+    Args:
+        folder_path: Folder to save the profile in.
+        flatfield: Flatfield (yx).
+        darkfield: Darkfield (yx). Not saved if it is zero.
+        baseline: Baselines of the images used to calculate the profile.
+    """
+    folder_path = Path(folder_path)
+    folder_path.mkdir(parents=True, exist_ok=True)
+    profile = IlluminationProfile.from_arrays(flatfield, darkfield, baseline)
+    np.save(folder_path / "flatfield.npy", flatfield)
+    np.save(folder_path / "inv_flatfield.npy", profile.inv_flatfield)
+    if profile.darkfield is not None:
+        np.save(folder_path / "darkfield.npy", profile.darkfield)
+    if baseline is not None:
+        np.save(folder_path / "baseline.npy", baseline)
+
+
+def load_illumination_profile(folder_path: str | Path) -> IlluminationProfile:
+    """Load an illumination profile saved with `save_illumination_profile`.
+
+    Profiles saved without inv_flatfield.npy (or with a zero darkfield) are
+    supported as well. The result is cached per process, as long as the
+    files are not modified. Its arrays are read-only.
+
+    Args:
+        folder_path: Folder containing the profile.
+    """
+    folder_path = Path(folder_path).resolve()
+    return _load_illumination_profile(folder_path, _modification_times(folder_path))
+
+
+def load_tiff_illumination_profile(file_path: str | Path) -> IlluminationProfile:
+    """Load an illumination profile from a flatfield .tif file (cached).
+
+    Args:
+        file_path: Path to the flatfield image (yx).
+    """
+    file_path = Path(file_path).resolve()
+    return _load_tiff_illumination_profile(file_path, os.stat(file_path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=64)
+def _load_illumination_profile(
+    folder_path: Path, modification_times: tuple[int, ...]
+) -> IlluminationProfile:
+    """Load an illumination profile (cached by folder & modification times)."""
+    if (folder_path / "inv_flatfield.npy").exists():
+        inv_flatfield = np.load(folder_path / "inv_flatfield.npy", mmap_mode="r")
+    else:
+        flatfield = np.load(folder_path / "flatfield.npy", mmap_mode="r")
+        inv_flatfield = np.reciprocal(flatfield, dtype=np.float32)
+    darkfield = None
+    if (folder_path / "darkfield.npy").exists():
+        darkfield = np.load(folder_path / "darkfield.npy", mmap_mode="r")
+        if darkfield.dtype != np.float32:
+            darkfield = darkfield.astype(np.float32)
+        if not darkfield.any():
+            darkfield = None
+    baseline = None
+    if (folder_path / "baseline.npy").exists():
+        baseline = np.load(folder_path / "baseline.npy")
+    for array in (inv_flatfield, darkfield):
+        if array is not None:
+            array.flags.writeable = False
+    return IlluminationProfile(inv_flatfield, darkfield, baseline)
+
+
+@functools.lru_cache(maxsize=64)
+def _load_tiff_illumination_profile(
+    file_path: Path, modification_time: int
+) -> IlluminationProfile:
+    """Load an illumination profile from a .tif (cached by path & mtime)."""
+    profile = IlluminationProfile.from_arrays(tifffile.imread(file_path))
+    profile.inv_flatfield.flags.writeable = False
+    return profile
+
+
+def _modification_times(folder_path: Path) -> tuple[int, ...]:
+    """Modification times of the files of a profile (0 if missing)."""
+    times = []
+    for name in ("flatfield", "inv_flatfield", "darkfield", "baseline"):
+        path = folder_path / f"{name}.npy"
+        times.append(path.stat().st_mtime_ns if path.exists() else 0)
+    return tuple(times)
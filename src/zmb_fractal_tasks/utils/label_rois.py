@@ -0,0 +1,155 @@
+"""Collect the bounding boxes of labels while they are written.
+
+Building a masking ROI table from a finished label image needs another pass
+over the whole image. Instead, segmentation tasks find the bounding boxes of
+the labels of each ROI (with `ndimage.find_objects`) right before writing
+them, offset them to the coordinates of the label image & merge them across
+ROIs.
+"""
+
+import threading
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+from ngio import Roi, RoiPixels
+from ngio.images import Image, Label
+from ngio.tables import MaskingRoiTable
+from scipy import ndimage
+
+from zmb_fractal_tasks.utils.halo import roi_halo_slices
+
+# bounding boxes: (labels, starts, stops), with one row per label
+Boxes = tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def find_label_boxes(
+    labels: np.ndarray, origin: Optional[Sequence[int]] = None
+) -> Boxes:
+    """Find the bounding boxes of all labels of an array.
+
+    Args:
+        labels: Label array (e.g. zyx).
+        origin: Position of labels[0, 0, ...] in the label image (pixels),
+            which is added to the boxes. Defaults to zeros.
+
+    Returns:
+        Labels (n,), start (n, ndim) & stop (n, ndim) of their boxes.
+    """
+    if origin is None:
+        origin = (0,) * labels.ndim
+    objects = ndimage.find_objects(labels) if labels.size > 0 else []
+    found = [(label, slices) for label, slices in enumerate(objects, start=1)]
+    found = [(label, slices) for label, slices in found if slices is not None]
+    ids = np.array([label for label, _ in found], dtype=np.int64)
+    starts = np.array(
+        [[s.start for s in slices] for _, slices in found], dtype=np.int64
+    ).reshape(-1, labels.ndim)
+    stops = np.array(
+        [[s.stop for s in slices] for _, slices in found], dtype=np.int64
+    ).reshape(-1, labels.ndim)
+    origin = np.asarray(origin, dtype=np.int64)
+    return ids, starts + origin, stops + origin
+
+
+def roi_origin(roi: Roi, image: Image | Label) -> tuple[int, int, int]:
+    """Position (z, y, x in pixels) of a ROI in an image or label.
+
+    Starts are floored, like in ngio's `get_roi`. A missing axis (e.g. z of a
+    yx label) starts at 0, matching arrays read with `axes_order="zyx"`.
+    """
+    _, core_slices, _ = roi_halo_slices(roi, image, halo={})
+    return tuple(
+        core_slices[axis].start if axis in core_slices else 0
+        for axis in ("z", "y", "x")
+    )
+
+
+class LabelBoxes:
+    """Bounding boxes of the labels of a label image, collected per ROI.
+
+    Boxes of the same label (e.g. of labels spanning several ROIs) are
+    merged. Adding boxes is thread-safe.
+    """
+
+    def __init__(self, axes: Sequence[str] = ("z", "y", "x")):
+        """Start collecting boxes.
+
+        Args:
+            axes: Axes of the boxes (e.g. ("t", "z", "y", "x")).
+        """
+        self.axes = tuple(axes)
+        self._boxes: list[Boxes] = []
+        self._lock = threading.Lock()
+
+    def add(self, boxes: Boxes, offset: int = 0) -> None:
+        """Add boxes (e.g. from `find_label_boxes`).
+
+        Args:
+            boxes: Labels, starts & stops of the boxes.
+            offset: Offset added to the labels (e.g. to make them unique
+                across ROIs).
+        """
+        ids, starts, stops = boxes
+        with self._lock:
+            self._boxes.append((ids + offset, starts, stops))
+
+    def add_labels(
+        self, labels: np.ndarray, origin: Sequence[int], offset: int = 0
+    ) -> None:
+        """Add the boxes of all labels of an array.
+
+        Args:
+            labels: Label array with the axes of the boxes.
+            origin: Position of labels[0, 0, ...] in the label image.
+            offset: Offset added to the labels (after finding their boxes).
+        """
+        self.add(find_label_boxes(labels, origin), offset=offset)
+
+    def merged(self) -> Boxes:
+        """Get the boxes of all labels (sorted by label), merged by label."""
+        n_axes = len(self.axes)
+        with self._lock:
+            ids = np.concatenate([b[0] for b in self._boxes] + [np.empty(0, int)])
+            starts = np.concatenate(
+                [b[1] for b in self._boxes] + [np.empty((0, n_axes), int)]
+            )
+            stops = np.concatenate(
+                [b[2] for b in self._boxes] + [np.empty((0, n_axes), int)]
+            )
+        order = np.argsort(ids, kind="stable")
+        ids, starts, stops = ids[order], starts[order], stops[order]
+        unique_ids, first = np.unique(ids, return_index=True)
+        if len(unique_ids) == len(ids):
+            return ids, starts, stops
+        return (
+            unique_ids,
+            np.minimum.reduceat(starts, first, axis=0),
+            np.maximum.reduceat(stops, first, axis=0),
+        )
+
+    def to_rois(self, label_image: Label) -> list[Roi]:
+        """Convert the boxes to ROIs (in world coordinates).
+
+        Args:
+            label_image: Label image (level) the boxes refer to.
+        """
+        rois = []
+        for label, start, stop in zip(*self.merged(), strict=True):
+            box = {}
+            for axis, axis_start, axis_stop in zip(self.axes, start, stop, strict=True):
+                box[axis] = int(axis_start)
+                box[f"{axis}_length"] = int(axis_stop - axis_start)
+            roi_pixels = RoiPixels(name=str(label), label=int(label), **box)
+            rois.append(roi_pixels.to_roi(label_image.pixel_size))
+        return rois
+
+    def to_masking_roi_table(self, label_image: Label) -> MaskingRoiTable:
+        """Build a masking ROI table (one ROI per label) of a label image.
+
+        Args:
+            label_image: Label image (level) the boxes refer to.
+        """
+        return MaskingRoiTable(
+            self.to_rois(label_image), reference_label=label_image.meta.name
+        )
@@ -0,0 +1,190 @@
+"""Write label images with the smallest dtype that fits all labels."""
+
+import threading
+
+import numpy as np
+import zarr
+from ngio import OmeZarrContainer, Roi
+from ngio.images import Image, Label
+
+from zmb_fractal_tasks.utils.pyramid import DirtyRegions
+
+# dtypes used for label images, from smallest to largest
+LABEL_DTYPES = ("uint16", "uint32", "uint64")
+
+
+def smallest_label_dtype(max_label: int, min_dtype: str = LABEL_DTYPES[0]) -> str:
+    """Get the smallest unsigned label dtype that can hold max_label.
+
+    Args:
+        max_label: Largest label value that has to fit into the dtype.
+        min_dtype: Smallest dtype to return.
+    """
+    for dtype in LABEL_DTYPES[LABEL_DTYPES.index(min_dtype) :]:
+        if max_label <= np.iinfo(dtype).max:
+            return dtype
+    raise ValueError(f"Label {max_label} does not fit into any label dtype.")
+
+
+class LabelWriter:
+    """Write ROIs of a label image, widening its dtype as needed.
+
+    A new label image is created with the smallest label dtype (or the dtype
+    expected from max_label). Patches are cast to the current dtype when they
+    are written. If a patch contains labels that don't fit, the label image
+    is widened first, by rewriting its existing chunks one by one with the
+    larger dtype.
+
+    Writes are serialized by self.lock, since neighbouring ROIs may share
+    chunks. The lock is reentrant, so it can be shared with callers that
+    read & write ROIs under the same lock.
+    """
+
+    def __init__(
+        self,
+        ome_zarr_container: OmeZarrContainer,
+        name: str,
+        path: str | None = None,
+        overwrite: bool = False,
+        max_label: int = 0,
+        ref_image: Image | Label | None = None,
+        create: bool = True,
+    ):
+        """Create a new label image (or open an existing one).
+
+        Args:
+            ome_zarr_container: Container of the image to derive the label
+                image from.
+            name: Name of the new label image.
+            path: Pyramid level of the label image to write to. If None, the
+                highest resolution level is used.
+            overwrite: If `True`, overwrite an existing label image.
+            max_label: Expected largest label, used to choose the initial
+                dtype.
+            ref_image: Image or label to derive the label image from. If None,
+                the main image of the container is used.
+            create: If `False`, the existing label image is opened (e.g. to
+                write some of its ROIs again) & overwrite, max_label and
+                ref_image are ignored.
+        """
+        self._container = ome_zarr_container
+        self.name = name
+        self.path = path
+        self.lock = threading.RLock()
+        if create:
+            ome_zarr_container.derive_label(
+                name=name,
+                ref_image=ref_image,
+                overwrite=overwrite,
+                dtype=smallest_label_dtype(max_label),
+            )
+        self.label_image = ome_zarr_container.get_label(name=name, path=path)
+        self.dirty_regions = DirtyRegions(self.label_image)
+
+    @property
+    def dtype(self) -> str:
+        """Current dtype of the label image."""
+        return str(self.label_image.dtype)
+
+    def ensure_fits(self, max_label: int) -> None:
+        """Widen the dtype of the label image, if max_label doesn't fit."""
+        with self.lock:
+            if max_label > np.iinfo(self.dtype).max:
+                self._widen(smallest_label_dtype(max_label, min_dtype=self.dtype))
+
+    def get_roi(self, roi: Roi, **kwargs) -> np.ndarray:
+        """Read a ROI of the label image (see `Label.get_roi`)."""
+        return self.label_image.get_roi(roi, **kwargs)
+
+    def set_roi(self, roi: Roi, patch: np.ndarray, **kwargs) -> None:
+        """Write a ROI of the label image (see `Label.set_roi`).
+
+        The patch is cast to the dtype of the label image, which is widened
+        first if necessary.
+        """
+        max_label = int(patch.max()) if patch.size > 0 else 0
+        with self.lock:
+            self.ensure_fits(max_label)
+            patch = patch.astype(self.dtype, copy=False)
+            self.label_image.set_roi(roi, patch=patch, **kwargs)
+            self.dirty_regions.add_roi(roi, **kwargs)
+
+    def set_array(self, patch: np.ndarray, **kwargs) -> None:
+        """Write a region of the label image (see `Label.set_array`).
+
+        The patch is cast to the dtype of the label image, which is widened
+        first if necessary.
+        """
+        max_label = int(patch.max()) if patch.size > 0 else 0
+        with self.lock:
+            self.ensure_fits(max_label)
+            patch = patch.astype(self.dtype, copy=False)
+            self.label_image.set_array(patch, **kwargs)
+            self.dirty_regions.add(**kwargs)
+
+    def consolidate(self, defer: bool = False) -> None:
+        """Update the pyramid levels of the label image, where it was written.
+
+        Args:
+            defer: If `True`, only mark the pyramid as stale.
+        """
+        with self.lock:
+            self.dirty_regions.consolidate(defer=defer)
+
+    def _widen(self, dtype: str) -> None:
+        """Rewrite all pyramid levels of the label image with a larger dtype."""
+        array = self.label_image.zarr_array
+        group_path = array.path.rsplit("/", 1)[0]
+        for level_path in self.label_image.meta.paths:
+            level = zarr.open_array(
+                array.store, path=f"{group_path}/{level_path}", mode="r"
+            )
+            widen_zarr_array(level, dtype)
+        self.label_image = self._container.get_label(name=self.name, path=self.path)
+        self.dirty_regions.image = self.label_image
+
+
+def widen_zarr_array(array: zarr.Array, dtype: str) -> zarr.Array:
+    """Change the dtype of a zarr array, one chunk at a time.
+
+    The widened chunks are written to a new array next to the original one,
+    which is only swapped in (by renaming) once all chunks are written. If the
+    process is interrupted before, the original array is unchanged. Empty
+    chunks are not stored.
+
+    Args:
+        array: Zarr (v2) array to widen. Its values must fit into dtype.
+        dtype: New dtype of the array.
+
+    Returns:
+        The widened array (at the path of the original array).
+    """
+    widening_path = f"{array.path}.widening"
+    widened = zarr.create(
+        shape=array.shape,
+        chunks=array.chunks,
+        dtype=dtype,
+        compressor=array.compressor,
+        fill_value=array.fill_value,
+        order=array.order,
+        filters=array.filters,
+        store=array.store,
+        path=widening_path,
+        overwrite=True,
+        dimension_separator=array._dimension_separator,
+        write_empty_chunks=False,
+    )
+    widened.attrs.put(array.attrs.asdict())
+    for block in np.ndindex(*array.cdata_shape):
+        widened.blocks[block] = array.blocks[block].astype(dtype)
+
+    # swap the arrays: the original is only removed once the widened one is
+    # in place
+    replaced_path = f"{array.path}.replaced"
+    zarr.storage.rmdir(array.store, replaced_path)
+    zarr.storage.rename(array.store, array.path, replaced_path)
+    zarr.storage.rename(array.store, widening_path, array.path)
+    zarr.storage.rmdir(array.store, replaced_path)
+    return zarr.open_array(
+        array.store, path=array.path, mode="r+", write_empty_chunks=False
+    )
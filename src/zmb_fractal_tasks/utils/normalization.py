@@ -274,34 +274,89 @@ def normalized_image(
     upper_p: float = 99.0,
     lower_bound: Optional[int] = None,
     upper_bound: Optional[int] = None,
-):
+) -> np.ndarray:
     """Normalize a single channel image.
 
     Based on
     https://github.com/MouseLand/cellpose/blob/...
     ...4f5661983c3787efa443bbbd3f60256f4fd8bf53/cellpose/transforms.py#L375
+
+    The percentiles are computed once (from a histogram, for 8/16-bit
+    images) & the image is rescaled into a single new float32 array. The
+    input image is not modified.
     """
-    img = img.astype(np.float32)
     if lower_p is not None:
-        # ptp can still give nan's with weird images
-        i99 = np.percentile(img, upper_p)
-        i1 = np.percentile(img, lower_p)
-        if i99 - i1 > +1e-3:  # np.ptp(img[k]) > 1e-3:
-            img = normalize_percentile(img, lower=lower_p, upper=upper_p)
-            if invert:
-                img = -1 * img + 1
-        else:
-            img = 0
+        lower, upper = image_percentiles(img, [lower_p, upper_p])
     elif lower_bound is not None:
-        if upper_bound - lower_bound > +1e-3:
-            img = normalize_bounds(img, lower=lower_bound, upper=upper_bound)
-            if invert:
-                img = -1 * img + 1
-        else:
-            img = 0
+        lower, upper = lower_bound, upper_bound
     else:
         raise ValueError("No normalization mode specified")
-    return img
+    # ptp can still give nan's with weird images
+    if upper - lower <= 1e-3:
+        return np.zeros(img.shape, dtype=np.float32)
+    out = rescale_intensity(img, lower, upper)
+    if invert:
+        np.subtract(1, out, out=out)
+    return out
+
+
+def image_percentiles(img: np.ndarray, percentiles: Sequence[float]) -> np.ndarray:
+    """Percentiles of an image, same as `np.percentile` (linear method).
+
+    For 8/16-bit integer images, the values are counted in a histogram
+    instead of being copied & partitioned.
+
+    Args:
+        img: Image (any shape).
+        percentiles: Percentiles to compute (between 0 and 100).
+    """
+    percentiles = np.asarray(percentiles, dtype=np.float64)
+    if img.size == 0 or img.dtype.kind not in "ui" or img.dtype.itemsize > 2:
+        return np.percentile(img, percentiles)
+    offset = int(np.iinfo(img.dtype).min)
+    values = img.ravel()
+    if offset != 0:
+        values = values.astype(np.int32) - offset
+    cumulative_counts = np.cumsum(np.bincount(values))
+    # linear interpolation between the neighbouring values, as np.percentile
+    index = percentiles / 100 * (img.size - 1)
+    lower_index = np.floor(index)
+    below = np.searchsorted(cumulative_counts, lower_index, side="right")
+    above = np.searchsorted(
+        cumulative_counts, np.minimum(lower_index + 1, img.size - 1), side="right"
+    )
+    below, above = below + offset, above + offset
+    weight = index - lower_index
+    return np.where(
+        weight >= 0.5,
+        above - (above - below) * (1 - weight),
+        below + (above - below) * weight,
+    )
+
+
+def rescale_intensity(
+    img: np.ndarray,
+    lower: float,
+    upper: float,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Rescale an image so that lower becomes 0.0 and upper becomes 1.0.
+
+    Args:
+        img: The image to be rescaled.
+        lower: Value mapped to 0.0.
+        upper: Value mapped to 1.0.
+        out: Optional float32 output array with the shape of img. Can be img
+            itself (if it is float32), to rescale in place.
+
+    Returns:
+        The rescaled image (float32).
+    """
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+    np.subtract(img, np.float32(lower), out=out, casting="unsafe")
+    np.divide(out, np.float32(upper - lower), out=out)
+    return out
 
 
 def normalize_percentile(Y: np.ndarray, lower: float = 1, upper: float = 99):
@@ -315,11 +370,8 @@ def normalize_percentile(Y: np.ndarray, lower: float = 1, upper: float = 99):
         upper: Upper percentile
 
     """
-    X = Y.copy()
-    x01 = np.percentile(X, lower)
-    x99 = np.percentile(X, upper)
-    X = (X - x01) / (x99 - x01)
-    return X
+    x01, x99 = image_percentiles(Y, [lower, upper])
+    return rescale_intensity(Y, x01, x99)
 
 
 def normalize_bounds(Y: np.ndarray, lower: int = 0, upper: int = 65535):
@@ -331,6 +383,4 @@ def normalize_bounds(Y: np.ndarray, lower: int = 0, upper: int = 65535):
         upper: Upper normalization value
 
     """
-    X = Y.copy()
-    X = (X - lower) / (upper - lower)
-    return X
+    return rescale_intensity(Y, lower, upper)
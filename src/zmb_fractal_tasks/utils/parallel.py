@@ -0,0 +1,51 @@
+"""Helpers to process ROIs concurrently with bounded memory."""
+
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def bounded_map(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    max_workers: int = 1,
+    max_pending: Optional[int] = None,
+) -> Iterator[R]:
+    """Map fn over items in a thread pool, yielding results in order.
+
+    Unlike `ThreadPoolExecutor.map`, items are submitted lazily: at most
+    max_pending items are being processed or waiting to be consumed at any
+    time. This bounds the memory used by results (e.g. ROI patches), while the
+    consumer (e.g. writing the patches) runs concurrently with the workers.
+
+    Args:
+        fn: Function to apply to each item.
+        items: Items to process.
+        max_workers: Number of threads.
+        max_pending: Maximum number of submitted, unconsumed items. Defaults
+            to 2 * max_workers.
+    """
+    if max_pending is None:
+        max_pending = 2 * max_workers
+    max_pending = max(max_pending, 1)
+    if max_workers <= 1 and max_pending <= 1:
+        yield from map(fn, items)
+        return
+
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
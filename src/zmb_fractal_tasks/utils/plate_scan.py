@@ -0,0 +1,125 @@
+"""Scan the metadata of all images of a plate once, to share it in a task."""
+
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Optional
+
+from ngio import OmeZarrContainer, open_ome_zarr_container
+
+from zmb_fractal_tasks.utils.parallel import bounded_map
+
+
+class ImageInfo:
+    """Metadata of an OME-Zarr image (of a plate).
+
+    The plate & well attributes are None for an image that isn't part of a
+    plate (e.g. ".../image.zarr").
+
+    Attributes:
+        zarr_url: Path or url to the OME-Zarr image.
+        plate_url: Path or url to the plate containing the image.
+        plate_name: Name of the plate (without ".zarr").
+        well_row: Row of the well (e.g. "B").
+        well_column: Column of the well (e.g. 3).
+        well_name: Name of the well (e.g. "B03").
+        omezarr: Opened OME-Zarr container of the image.
+        image: Highest resolution level of the image.
+        wavelength_ids: Wavelength ids of the channels.
+        channel_labels: Labels of the channels.
+        tables: Tables (with their data loaded), by name.
+    """
+
+    def __init__(self, zarr_url: str, omezarr: OmeZarrContainer):
+        """Read the metadata of an image.
+
+        Args:
+            zarr_url: Path or url to the OME-Zarr image.
+            omezarr: Opened OME-Zarr container of the image.
+        """
+        self.zarr_url = zarr_url
+        self.plate_url, self.well_row, self.well_column = parse_zarr_url(zarr_url)
+        self.plate_name = plate_name(self.plate_url)
+        self.well_name = well_name(self.well_row, self.well_column)
+        self.omezarr = omezarr
+        self.image = omezarr.get_image()
+        self.wavelength_ids = self.image.wavelength_ids
+        self.channel_labels = self.image.channel_labels
+        self.tables: dict[str, Any] = {}
+
+    def load_table(self, name: str) -> Any:
+        """Load a table of the image (if not loaded yet) & return it."""
+        if name not in self.tables:
+            table = self.omezarr.get_table(name)
+            table.set_table_data()
+            self.tables[name] = table
+        return self.tables[name]
+
+
+def parse_zarr_url(
+    zarr_url: str,
+) -> tuple[Optional[str], Optional[str], Optional[int]]:
+    """Split the url of an image of a plate into plate url, well row & column.
+
+    E.g. ".../plate.zarr/B/03/0" -> (".../plate.zarr", "B", 3). For an image
+    that isn't part of a plate (e.g. ".../image.zarr"), (None, None, None)
+    is returned.
+    """
+    parts = Path(zarr_url).as_posix().split(".zarr/", 1)
+    if len(parts) != 2:
+        return None, None, None
+    plate_url, component = parts
+    component = component.split("/")
+    if len(component) < 3 or not component[1].isdigit():
+        return None, None, None
+    return plate_url + ".zarr", component[0], int(component[1])
+
+
+def plate_name(plate_url: Optional[str]) -> Optional[str]:
+    """Name of a plate (e.g. ".../plate.zarr" -> "plate"), None if no plate."""
+    return None if plate_url is None else Path(plate_url).stem
+
+
+def well_name(well_row: Optional[str], well_column: Optional[int]) -> Optional[str]:
+    """Name of a well (e.g. "B", 3 -> "B03"), None if no well."""
+    if well_row is None or well_column is None:
+        return None
+    return f"{well_row}{well_column:02d}"
+
+
+def scan_images(
+    zarr_urls: Sequence[str],
+    tables: Sequence[str] = (),
+    max_workers: int = 8,
+) -> list[ImageInfo]:
+    """Open the images & read their metadata (and tables) concurrently.
+
+    Args:
+        zarr_urls: Paths or urls to the OME-Zarr images.
+        tables: Names of tables to load from each image. If an image doesn't
+            have the table, an error is raised.
+        max_workers: Number of images read concurrently.
+
+    Returns:
+        Metadata of each image, in the order of zarr_urls.
+    """
+
+    def _scan_image(zarr_url):
+        image_info = ImageInfo(zarr_url, open_ome_zarr_container(zarr_url))
+        for name in tables:
+            image_info.load_table(name)
+        return image_info
+
+    return list(bounded_map(_scan_image, zarr_urls, max_workers=max_workers))
+
+
+def group_by_plate(image_infos: Sequence[ImageInfo]) -> dict[str, list[ImageInfo]]:
+    """Group images by the plate they belong to (keeping their order).
+
+    An image that isn't part of a plate forms its own group (keyed by its
+    zarr_url).
+    """
+    plates: dict[str, list[ImageInfo]] = {}
+    for image_info in image_infos:
+        key = image_info.plate_url or image_info.zarr_url
+        plates.setdefault(key, []).append(image_info)
+    return plates
@@ -0,0 +1,289 @@
+"""Incremental & deferred consolidation of image pyramids.
+
+`Image.consolidate()` rebuilds all pyramid levels from the full resolution
+level. Here, the regions written to an image are tracked, and only the
+pyramid blocks that overlap these regions are recomputed.
+
+Consolidation can also be deferred: the image is only marked as "pyramid
+stale" (in the attributes of its zarr group) and its pyramid is built
+later in a single pass from level 0, e.g. by a later task that reads a
+coarser level or by the `build_pyramids` task.
+
+The recomputed blocks match ngio's (dask) consolidation: it zooms each
+source block independently (with "grid-constant" boundaries), so zooming
+only the touched blocks gives the same result as zooming the whole level.
+"""
+
+import itertools
+import logging
+import math
+import threading
+from collections.abc import Iterable, Sequence
+from typing import Literal
+
+import numpy as np
+import zarr
+from ngio import Roi
+from ngio.images import Image, Label
+from scipy.ndimage import zoom
+
+# region of an array: (start, stop) per axis
+Region = tuple[tuple[int, int], ...]
+
+# key of the zarr group attributes, where the pyramid state is stored
+ATTRS_KEY = "zmb_fractal_tasks"
+
+
+class DirtyRegions:
+    """Regions of an image (or label) that were written.
+
+    The regions are stored as index ranges of the written zarr array (e.g.
+    pyramid level 0), so they can be used to update the coarser levels with
+    `consolidate_regions`. Adding regions is thread-safe.
+    """
+
+    def __init__(self, image: Image | Label):
+        """Track regions written to image.
+
+        Args:
+            image: Image or label that is written to.
+        """
+        self.image = image
+        self.regions: list[Region] = []
+        self._lock = threading.Lock()
+
+    def add_roi(self, roi: Roi, **slicing_kwargs) -> None:
+        """Mark a ROI as written.
+
+        Args:
+            roi: ROI that was written (in world coordinates).
+            **slicing_kwargs: Additional slicing of other axes, e.g. `c=0`.
+        """
+        roi_pixels = roi.to_roi_pixels(self.image.pixel_size)
+        for axis in ("x", "y", "z", "t"):
+            start = getattr(roi_pixels, axis)
+            length = getattr(roi_pixels, f"{axis}_length")
+            if axis in slicing_kwargs or start is None or length is None:
+                continue
+            # be conservative with fractional pixels
+            slicing_kwargs[axis] = slice(math.floor(start), math.ceil(start + length))
+        self.add(**slicing_kwargs)
+
+    def add(self, **slicing_kwargs) -> None:
+        """Mark a region as written.
+
+        Args:
+            **slicing_kwargs: Slice (or index) per axis, e.g.
+                `y=slice(0, 100), c=0`. Missing axes are fully included, other
+                keyword arguments (e.g. axes_order) are ignored.
+        """
+        region = []
+        for axis, size in zip(
+            self.image.axes, self.image.zarr_array.shape, strict=True
+        ):
+            index = slicing_kwargs.get(axis)
+            if index is None:
+                region.append((0, size))
+            elif isinstance(index, slice):
+                start, stop, _ = index.indices(size)
+                region.append((start, stop))
+            elif isinstance(index, int):
+                region.append((index, index + 1))
+            else:
+                region.append((min(index), max(index) + 1))
+        with self._lock:
+            self.regions.append(tuple(region))
+
+    def consolidate(
+        self,
+        order: Literal["nearest", "linear", "cubic"] | None = None,
+        defer: bool = False,
+    ) -> None:
+        """Update the pyramid levels of the image in the written regions.
+
+        If the pyramid is already stale, it is rebuilt completely.
+
+        Args:
+            order: Interpolation order. Defaults to "nearest" for labels and
+                "linear" for images, like `consolidate()`.
+            defer: If `True`, only mark the pyramid as stale. (Only possible
+                if level 0 was written, since stale pyramids are rebuilt from
+                level 0.)
+        """
+        written_level_0 = self.image.path == self.image.meta.paths[0]
+        if defer and written_level_0:
+            mark_pyramid_stale(self.image)
+        elif written_level_0 and is_pyramid_stale(self.image):
+            consolidate_pyramid(self.image, order=order)
+        else:
+            consolidate_regions(self.image, self.regions, order=order)
+
+
+def mark_pyramid_stale(image: Image | Label) -> None:
+    """Mark the pyramid levels of an image as outdated."""
+    group = _image_group(image, mode="r+")
+    attrs = group.attrs.get(ATTRS_KEY, {})
+    group.attrs[ATTRS_KEY] = {**attrs, "pyramid_stale": True}
+
+
+def is_pyramid_stale(image: Image | Label) -> bool:
+    """Check whether the pyramid levels of an image are outdated."""
+    attrs = _image_group(image).attrs.get(ATTRS_KEY, {})
+    return bool(attrs.get("pyramid_stale", False))
+
+
+def consolidate_pyramid(
+    image: Image | Label,
+    order: Literal["nearest", "linear", "cubic"] | None = None,
+) -> None:
+    """Build all pyramid levels of an image from level 0, block by block.
+
+    Args:
+        image: Image or label (of any level).
+        order: Interpolation order. Defaults to "nearest" for labels and
+            "linear" for images.
+    """
+    if order is None:
+        order = _default_order(image)
+    group = _image_group(image, mode="r+")
+    paths = image.meta.paths
+    source = group[paths[0]]
+    targets = [group[path] for path in paths[1:]]
+    full_region = tuple((0, size) for size in source.shape)
+    _consolidate_arrays(source, targets, [full_region], order=order)
+    attrs = group.attrs.get(ATTRS_KEY, {})
+    group.attrs[ATTRS_KEY] = {**attrs, "pyramid_stale": False}
+
+
+def update_stale_pyramid(image: Image | Label) -> None:
+    """Build the pyramid of an image, if it is stale & a coarser level is used.
+
+    Call this before reading from a pyramid level other than level 0.
+    """
+    if image.path != image.meta.paths[0] and is_pyramid_stale(image):
+        logging.info(f"Building stale pyramid before reading level {image.path}")
+        consolidate_pyramid(image)
+
+
+def consolidate_regions(
+    image: Image | Label,
+    regions: Sequence[Region],
+    order: Literal["nearest", "linear", "cubic"] | None = None,
+) -> None:
+    """Update the pyramid levels of an image, only where regions changed.
+
+    Args:
+        image: Image or label whose level image.path was written.
+        regions: Written regions (index ranges of image.zarr_array).
+        order: Interpolation order. Defaults to "nearest" for labels and
+            "linear" for images.
+    """
+    if order is None:
+        order = _default_order(image)
+    group = _image_group(image, mode="r+")
+    source = image.zarr_array
+    targets = [group[path] for path in image.meta.paths if path != image.path]
+    _consolidate_arrays(source, targets, regions, order=order)
+
+
+def _consolidate_arrays(
+    source: zarr.Array,
+    targets: list[zarr.Array],
+    regions: Sequence[Region],
+    order: Literal["nearest", "linear", "cubic"],
+) -> None:
+    """Update target levels from source, where regions of source changed."""
+    processed = [(source, list(regions))]
+    # same order as ngio: always zoom from the closest processed level
+    while targets:
+        source_idx, target_idx = _find_closest_arrays(
+            [array for array, _ in processed], targets
+        )
+        source, source_regions = processed[source_idx]
+        target = targets.pop(target_idx)
+        target_regions = zoom_regions(source, target, source_regions, order=order)
+        processed.append((target, target_regions))
+
+
+def zoom_regions(
+    source: zarr.Array,
+    target: zarr.Array,
+    regions: Iterable[Region],
+    order: Literal["nearest", "linear", "cubic"] = "linear",
+) -> list[Region]:
+    """Zoom the blocks of source that overlap regions into target.
+
+    Returns:
+        The regions of target that were written.
+    """
+    scale = np.array(target.shape) / np.array(source.shape)
+    # block layout of ngio's dask_zoom
+    block_shape = np.maximum(1, np.round(np.array(source.chunks) * scale) / scale)
+    block_shape = block_shape.astype(int)
+    block_output_shape = np.ceil(block_shape * scale).astype(int)
+
+    blocks = set()
+    for region in regions:
+        ranges = [
+            range(start // size, -(-stop // size))
+            for (start, stop), size in zip(region, block_shape, strict=True)
+        ]
+        blocks.update(itertools.product(*ranges))
+
+    written = []
+    for block in sorted(blocks):
+        source_slices = tuple(
+            slice(i * size, min((i + 1) * size, n))
+            for i, size, n in zip(block, block_shape, source.shape, strict=True)
+        )
+        zoomed = zoom(
+            source[source_slices],
+            scale,
+            order={"nearest": 0, "linear": 1, "cubic": 2}[order],
+            mode="grid-constant",
+            grid_mode=True,
+        )
+        starts = [i * size for i, size in zip(block, block_output_shape, strict=True)]
+        stops = [
+            min(start + size, n)
+            for start, size, n in zip(starts, zoomed.shape, target.shape, strict=True)
+        ]
+        if any(stop <= start for start, stop in zip(starts, stops, strict=True)):
+            continue
+        target[tuple(map(slice, starts, stops))] = zoomed[
+            tuple(
+                slice(0, stop - start)
+                for start, stop in zip(starts, stops, strict=True)
+            )
+        ]
+        written.append(tuple(zip(starts, stops, strict=True)))
+    return written
+
+
+def _find_closest_arrays(
+    processed: Sequence[zarr.Array], to_be_processed: Sequence[zarr.Array]
+) -> tuple[int, int]:
+    """Get indices of the closest pair of (processed, unprocessed) arrays."""
+    distances = np.array(
+        [
+            [
+                np.sqrt(np.sum((np.array(a.shape) - np.array(b.shape)) ** 2))
+                for b in to_be_processed
+            ]
+            for a in processed
+        ]
+    )
+    source_idx, target_idx = np.unravel_index(distances.argmin(), distances.shape)
+    return int(source_idx), int(target_idx)
+
+
+def _image_group(image: Image | Label, mode: str = "r") -> zarr.Group:
+    """Get the zarr group containing the pyramid levels of an image."""
+    array = image.zarr_array
+    group_path = array.path.rsplit("/", 1)[0] if "/" in array.path else ""
+    return zarr.open_group(array.store, path=group_path, mode=mode)
+
+
+def _default_order(image: Image | Label) -> Literal["nearest", "linear"]:
+    """Interpolation order used by ngio to consolidate an image or label."""
+    return "nearest" if isinstance(image, Label) else "linear"
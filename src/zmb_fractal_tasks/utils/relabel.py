@@ -0,0 +1,93 @@
+"""Helper functions to keep labels unique across ROIs."""
+
+from typing import Optional
+
+import numpy as np
+import zarr
+from ngio.images import Label
+
+# key of the per-ROI label offsets in the attributes of a label image
+LABEL_OFFSETS_KEY = "roi_label_offsets"
+
+
+def add_label_offset(labels: np.ndarray, offset: int) -> np.ndarray:
+    """Add an offset to all non-zero labels.
+
+    Works in place, unless the dtype of labels is too small for the new
+    labels. In that case, a copy with a larger dtype is returned.
+    """
+    if offset == 0 or labels.size == 0:
+        return labels
+    offset = int(offset)
+    max_label = int(labels.max()) + offset
+    if not np.can_cast(np.min_scalar_type(max_label), labels.dtype):
+        labels = labels.astype(
+            np.result_type(labels.dtype, np.min_scalar_type(max_label))
+        )
+    np.add(labels, offset, out=labels, where=labels > 0, casting="unsafe")
+    return labels
+
+
+# ROIs are identified by their name & timepoint (None for images without t)
+RoiKey = tuple[str, Optional[int]]
+
+
+def save_label_offsets(
+    label_image: Label, offsets: dict[RoiKey, tuple[int, int]]
+) -> None:
+    """Store the label offset & count of each ROI in the label image attrs.
+
+    With them, single ROIs can be segmented again later & relabelled on their
+    own (see `roi_label_offset`), without relabelling the whole image.
+
+    Args:
+        label_image: Label image the ROIs were written to.
+        offsets: (offset, label count) by ROI name & timepoint.
+    """
+    records = [
+        {"name": name, "t": t, "offset": int(offset), "count": int(count)}
+        for (name, t), (offset, count) in offsets.items()
+    ]
+    _label_group(label_image, mode="r+").attrs[LABEL_OFFSETS_KEY] = records
+
+
+def load_label_offsets(label_image: Label) -> dict[RoiKey, tuple[int, int]]:
+    """Load the label offsets stored by `save_label_offsets`.
+
+    Returns:
+        (offset, label count) by ROI name & timepoint. Empty if no offsets
+        are stored.
+    """
+    records = _label_group(label_image, mode="r").attrs.get(LABEL_OFFSETS_KEY, [])
+    return {(r["name"], r["t"]): (r["offset"], r["count"]) for r in records}
+
+
+def roi_label_offset(
+    offsets: dict[RoiKey, tuple[int, int]], key: RoiKey, label_count: int
+) -> int:
+    """Get the label offset of a ROI & add it to the offsets of all ROIs.
+
+    A ROI that was not segmented before gets the labels after the largest
+    label so far, so adding the ROIs one by one to empty offsets gives each
+    ROI the label counts of all previous ROIs as offset. A ROI that is
+    segmented again keeps its offset, if its new labels fit into its previous
+    label range. Otherwise, its labels are also placed after the largest
+    label. offsets is updated with the offset & count of the ROI.
+
+    Args:
+        offsets: Offsets of all ROIs (e.g. from `load_label_offsets`).
+        key: Name & timepoint of the ROI.
+        label_count: Number of (local) labels of the ROI.
+    """
+    offset, previous_count = offsets.get(key, (None, 0))
+    if offset is None or label_count > previous_count:
+        offset = max((o + c for o, c in offsets.values()), default=0)
+    offsets[key] = (offset, max(label_count, previous_count))
+    return offset
+
+
+def _label_group(label_image: Label, mode: str) -> zarr.Group:
+    """Open the zarr group of a label image (containing all its levels)."""
+    array = label_image.zarr_array
+    group_path = array.path.rsplit("/", 1)[0]
+    return zarr.open_group(array.store, path=group_path, mode=mode)
@@ -0,0 +1,176 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from ngio import create_ome_zarr_from_array, open_ome_zarr_container
+from ngio.tables import FeatureTable
+
+from zmb_fractal_tasks.aggregate_features_plate import (
+    add_plate_columns,
+    aggregate_features_plate,
+    aggregated_stats_to_dataframe,
+)
+from zmb_fractal_tasks.measure_features import LabelInput, measure_features
+from zmb_fractal_tasks.utils.aggregation import GroupedStats
+from zmb_fractal_tasks.utils.channel_utils import MeasurementChannels
+
+
+@pytest.fixture
+def zarr_with_measurements(zarr_MIP_path, tmp_path):
+    """Create a zarr with measurement tables for testing."""
+    test_zarr = tmp_path / "test_aggregate_zarr.zarr"
+    shutil.copytree(zarr_MIP_path, test_zarr, dirs_exist_ok=True)
+
+    zarr_url = str(test_zarr / "B" / "03" / "0")
+    measure_features(
+        zarr_url=zarr_url,
+        input_labels=[
+            LabelInput(
+                input_label_name="nuclei", output_table_name="nuclei_measurements"
+            )
+        ],
+        channels_to_measure=MeasurementChannels(
+            use_all_channels=False,
+            mode="label",
+            identifiers=["DAPI"],
+        ),
+        structure_props=["area"],
+        intensity_props=["intensity_mean"],
+        roi_table="FOV_ROI_table",
+        append_to_table=False,
+    )
+    return test_zarr
+
+
+def test_aggregate_features_plate(zarr_with_measurements, tmp_path):
+    zarr_url = str(zarr_with_measurements / "B" / "03" / "0")
+    zarr_dir = tmp_path / "output"
+    zarr_dir.mkdir()
+
+    aggregate_features_plate(
+        zarr_urls=[zarr_url],
+        zarr_dir=str(zarr_dir),
+        input_table_name="nuclei_measurements",
+        aggregation_methods=["mean", "max"],
+    )
+
+    df = pd.read_csv(zarr_dir / "nuclei_measurements_aggregated.csv")
+    assert len(df) == 1
+    assert list(df.columns[:3]) == ["plate", "well", "count"]
+    assert df["well"].iloc[0] == "B03"
+    assert "area_mean" in df.columns
+    assert "DAPI_intensity_mean_max" in df.columns
+
+
+def test_aggregate_features_plate_by_condition(zarr_with_measurements, tmp_path):
+    zarr_url = str(zarr_with_measurements / "B" / "03" / "0")
+    plate_layout_path = tmp_path / "plate_layout.csv"
+    pd.DataFrame(
+        {"3": ["control", "control"], "4": ["treatment", "treatment"]},
+        index=["A", "B"],
+    ).to_csv(plate_layout_path)
+
+    aggregate_features_plate(
+        zarr_urls=[zarr_url],
+        zarr_dir=str(tmp_path),
+        input_table_name="nuclei_measurements",
+        output_table_name="condition_means",
+        group_by=["condition"],
+        features_to_aggregate=["area"],
+        aggregation_methods=["mean"],
+        plate_layout_path=str(plate_layout_path),
+    )
+
+    df = pd.read_csv(Path(tmp_path) / "condition_means.csv")
+    df_org = open_ome_zarr_container(zarr_url).get_table("nuclei_measurements")
+    df_org = df_org.dataframe
+    assert list(df.columns) == ["condition", "count", "area_mean"]
+    assert df["condition"].iloc[0] == "control"
+    assert df["count"].iloc[0] == len(df_org)
+    assert df["area_mean"].iloc[0] == pytest.approx(df_org["area"].mean())
+
+
+def test_aggregate_features_plate_condition_requires_layout(tmp_path):
+    with pytest.raises(ValueError):
+        aggregate_features_plate(
+            zarr_urls=[],
+            zarr_dir=str(tmp_path),
+            input_table_name="nuclei_measurements",
+            group_by=["condition"],
+        )
+
+
+def test_aggregated_stats_to_dataframe_count():
+    table_df = pd.DataFrame(
+        {"well": ["B03", "B03", "B04"], "intensity": [np.nan, 1.0, 2.0]}
+    )
+    # count is the number of objects, not of the non-NaN values of a feature
+    stats = GroupedStats.from_dataframe(table_df, by="well", columns=["intensity"])
+    df = aggregated_stats_to_dataframe(stats, ["mean"])
+    assert list(df["count"]) == [2, 1]
+    assert list(df["intensity_mean"]) == [1.0, 2.0]
+    # without features
+    stats = GroupedStats.from_dataframe(table_df, by="well", columns=[])
+    df = aggregated_stats_to_dataframe(stats, ["mean"])
+    assert list(df.columns) == ["well", "count"]
+    assert list(df["count"]) == [2, 1]
+
+
+def test_add_plate_columns():
+    table_df = pd.DataFrame({"label": [1, 2], "area": [10, 20]})
+    plate_layout = pd.DataFrame({"3": ["control"]}, index=["B"])
+    df = add_plate_columns(table_df, "/data/my_plate.zarr/B/03/0", plate_layout)
+    assert list(df["plate"]) == ["my_plate"] * 2
+    assert list(df["well"]) == ["B03"] * 2
+    assert list(df["condition"]) == ["control"] * 2
+    # images that are not part of a plate have no plate & well
+    df = add_plate_columns(table_df, "/data/img.zarr")
+    assert df["plate"].isna().all() and df["well"].isna().all()
+    with pytest.raises(ValueError):
+        add_plate_columns(table_df, "/data/img.zarr", plate_layout)
+
+
+def test_aggregate_features_plate_not_in_plate(tmp_path):
+    zarr_url = str(tmp_path / "img.zarr")
+    omezarr = create_ome_zarr_from_array(
+        zarr_url, np.zeros((1, 16, 16), dtype=np.uint16), xy_pixelsize=1.0
+    )
+    table_df = pd.DataFrame({"label": [1, 2], "area": [10, 20]}).set_index("label")
+    omezarr.add_table("nuclei_measurements", FeatureTable(table_df))
+    with pytest.raises(ValueError, match="not part of a plate"):
+        aggregate_features_plate(
+            zarr_urls=[zarr_url],
+            zarr_dir=str(tmp_path),
+            input_table_name="nuclei_measurements",
+        )
+
+
+def test_aggregate_features_plate_differing_columns(tmp_path):
+    tables = {
+        "B/03/0": pd.DataFrame({"label": [1, 2], "area": [10, 20], "extra": [1, 2]}),
+        "B/04/0": pd.DataFrame({"label": [1], "intensity": [5.0], "area": [30]}),
+    }
+    zarr_urls = []
+    for component, table_df in tables.items():
+        zarr_url = str(tmp_path / "plate.zarr" / component)
+        omezarr = create_ome_zarr_from_array(
+            zarr_url, np.zeros((1, 16, 16), dtype=np.uint16), xy_pixelsize=1.0
+        )
+        omezarr.add_table("features", FeatureTable(table_df.set_index("label")))
+        zarr_urls.append(zarr_url)
+
+    # the features of the first table are used for all tables
+    aggregate_features_plate(
+        zarr_urls=zarr_urls,
+        zarr_dir=str(tmp_path),
+        input_table_name="features",
+        aggregation_methods=["mean"],
+    )
+    df = pd.read_csv(tmp_path / "features_aggregated.csv")
+    assert list(df.columns) == ["plate", "well", "count", "area_mean", "extra_mean"]
+    assert list(df["well"]) == ["B03", "B04"]
+    assert list(df["count"]) == [2, 1]
+    assert list(df["area_mean"]) == [15, 30]
+    assert df["extra_mean"].iloc[0] == 1.5 and np.isnan(df["extra_mean"].iloc[1])
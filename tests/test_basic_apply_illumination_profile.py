@@ -1,6 +1,10 @@
+import numpy as np
+
 from zmb_fractal_tasks.basic_apply_illumination_profile import (
+    IlluminationCorrection,
     InitArgsBaSiCApply,
     basic_apply_illumination_profile,
+    correct,
 )
 from zmb_fractal_tasks.basic_correct_illumination_plate_init import (
     AdvancedBaSiCParameters,
@@ -44,3 +48,22 @@ def test_basic_apply_illumination_profile(tmpdir, zarr_path):
         init_args=init_args,
     )
     # TODO: Check outputs
+
+
+def test_illumination_correction_kernel():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 60000, size=(1, 3, 32, 32), dtype=np.uint16)
+    flatfield = rng.uniform(0.5, 1.5, size=(32, 32))
+    darkfield = rng.uniform(0, 100, size=(32, 32))
+    baseline = 100
+
+    expected = np.clip((img - darkfield) / flatfield - baseline, 0, 65535)
+    corrected = correct(img, flatfield, darkfield, baseline)
+    assert corrected.dtype == np.uint16
+    np.testing.assert_allclose(corrected, expected, atol=1)
+
+    # in place, with a precomputed correction
+    correction = IlluminationCorrection(flatfield, darkfield, baseline)
+    result = correction(img, out=img)
+    assert result is img
+    np.testing.assert_array_equal(img, corrected)
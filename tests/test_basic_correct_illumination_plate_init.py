@@ -1,9 +1,15 @@
+import numpy as np
+from ngio import create_ome_zarr_from_array
+
 from zmb_fractal_tasks.basic_correct_illumination_plate_init import (
     AdvancedBaSiCParameters,
     CoreBaSiCParameters,
     OutputOptions,
     basic_correct_illumination_plate_init,
+    load_fov_planes,
+    sample_fov_planes,
 )
+from zmb_fractal_tasks.utils.plate_scan import scan_images
 
 
 def test_basic_correct_illumination_plate_init(tmpdir, zarr_path):
@@ -33,3 +39,84 @@ def test_basic_correct_illumination_plate_init(tmpdir, zarr_path):
     assert "parallelization_list" in result
     assert len(result["parallelization_list"]) == 1
     # TODO: Check outputs
+
+
+def test_basic_downsample_while_loading(tmp_path, zarr_MIP_path):
+    profiles = {}
+    for downsample_while_loading in (False, True):
+        zarr_dir = tmp_path / str(downsample_while_loading)
+        basic_correct_illumination_plate_init(
+            zarr_urls=[str(zarr_MIP_path / "B" / "03" / "0")],
+            zarr_dir=str(zarr_dir),
+            core_basic_parameters=CoreBaSiCParameters(
+                get_darkfield=True, random_seed=11
+            ),
+            advanced_basic_parameters=AdvancedBaSiCParameters(
+                downsample_while_loading=downsample_while_loading
+            ),
+            max_workers=4,
+        )
+        profiles[downsample_while_loading] = {
+            path.relative_to(zarr_dir): np.load(path)
+            for path in zarr_dir.rglob("*.npy")
+        }
+    assert profiles[True].keys() == profiles[False].keys()
+    for name, profile in profiles[False].items():
+        np.testing.assert_allclose(profiles[True][name], profile, rtol=1e-5)
+
+
+def test_basic_fit_in_processes(tmp_path, zarr_MIP_path):
+    profiles = {}
+    for max_processes in (0, 2):
+        zarr_dir = tmp_path / str(max_processes)
+        basic_correct_illumination_plate_init(
+            zarr_urls=[str(zarr_MIP_path / "B" / "03" / "0")],
+            zarr_dir=str(zarr_dir),
+            core_basic_parameters=CoreBaSiCParameters(random_seed=11),
+            max_processes=max_processes,
+        )
+        profiles[max_processes] = {
+            path.relative_to(zarr_dir): np.load(path)
+            for path in zarr_dir.rglob("*.npy")
+        }
+    assert profiles[0].keys() == profiles[2].keys()
+    for name, profile in profiles[0].items():
+        np.testing.assert_array_equal(profiles[2][name], profile)
+
+
+def test_sample_fov_planes_2D(tmp_path):
+    array = np.arange(2 * 32 * 48, dtype=np.uint16).reshape(2, 32, 48)
+    zarr_url = str(tmp_path / "plate.zarr" / "B" / "03" / "0")
+    omezarr = create_ome_zarr_from_array(
+        zarr_url, array, xy_pixelsize=1.0, levels=1, axes_names="cyx"
+    )
+    omezarr.add_table("FOV_ROI_table", omezarr.build_image_roi_table("FOV_1"))
+    image_infos = scan_images([zarr_url], tables=["FOV_ROI_table"])
+    channel = image_infos[0].wavelength_ids[1]
+
+    planes = sample_fov_planes(image_infos, channel, n_images_sampled=1)
+    assert [slices for _, slices in planes] == [
+        {"y": slice(0, 32), "x": slice(0, 48), "c": 1}
+    ]
+    np.testing.assert_array_equal(load_fov_planes(planes), array[1:])
+
+
+def test_basic_correct_illumination_plate_init_not_in_plate(tmp_path):
+    rng = np.random.default_rng(0)
+    zarr_urls = [str(tmp_path / f"img_{i}.zarr") for i in range(4)]
+    for zarr_url in zarr_urls:
+        omezarr = create_ome_zarr_from_array(
+            zarr_url,
+            rng.poisson(100, (1, 3, 32, 32)).astype(np.uint16),
+            xy_pixelsize=1.0,
+            levels=1,
+        )
+        omezarr.add_table("FOV_ROI_table", omezarr.build_image_roi_table("FOV_1"))
+    result = basic_correct_illumination_plate_init(
+        zarr_urls=zarr_urls,
+        zarr_dir=str(tmp_path),
+        core_basic_parameters=CoreBaSiCParameters(random_seed=11),
+    )
+    parallelization_list = result["parallelization_list"]
+    assert [item["zarr_url"] for item in parallelization_list] == zarr_urls
+    assert list((tmp_path / "BaSiC_illumination_profiles").iterdir())
@@ -0,0 +1,31 @@
+import numpy as np
+from ngio import open_ome_zarr_container
+
+from zmb_fractal_tasks.build_pyramids import build_pyramids
+from zmb_fractal_tasks.expand_segmentation import expand_segmentation
+from zmb_fractal_tasks.utils.pyramid import is_pyramid_stale
+
+
+def test_build_pyramids(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    expand_segmentation(
+        zarr_url=zarr_url,
+        input_label_name="nuclei",
+        expansion_distance=10,
+        union_output_label_name="cells",
+        save_difference=False,
+        defer_consolidation=True,
+    )
+    omezarr = open_ome_zarr_container(zarr_url)
+    assert is_pyramid_stale(omezarr.get_label("cells"))
+    assert not is_pyramid_stale(omezarr.get_label("nuclei"))
+
+    build_pyramids(zarr_url=zarr_url)
+
+    label = omezarr.get_label("cells")
+    assert not is_pyramid_stale(label)
+    built = [omezarr.get_label("cells", path=p).get_array() for p in label.meta.paths]
+    label.consolidate()
+    full = [omezarr.get_label("cells", path=p).get_array() for p in label.meta.paths]
+    for built_level, full_level in zip(built, full, strict=True):
+        np.testing.assert_array_equal(built_level, full_level)
@@ -1,4 +1,7 @@
-from zmb_fractal_tasks.expand_segmentation import expand_segmentation
+import numpy as np
+from ngio import create_ome_zarr_from_array, open_ome_zarr_container
+
+from zmb_fractal_tasks.expand_segmentation import expand_labels_ROI, expand_segmentation
 
 
 def test_expand_segmentation(zarr_MIP_path):
@@ -12,3 +15,136 @@ def test_expand_segmentation(zarr_MIP_path):
         difference_output_label_name="cytoplasms",
     )
     # TODO: Check outputs
+
+
+def test_expand_segmentation_parallel(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    expand_segmentation(
+        zarr_url=zarr_url,
+        input_label_name="nuclei",
+        expansion_distance=10,
+        union_output_label_name="cells",
+        difference_output_label_name="cytoplasms",
+        max_workers=4,
+    )
+    omezarr = open_ome_zarr_container(zarr_url)
+    nuclei = omezarr.get_label("nuclei").get_as_numpy()
+    cells = omezarr.get_label("cells").get_as_numpy()
+    cytoplasms = omezarr.get_label("cytoplasms").get_as_numpy()
+    np.testing.assert_array_equal(cells[nuclei > 0], nuclei[nuclei > 0])
+    np.testing.assert_array_equal(cytoplasms, np.where(nuclei > 0, 0, cells))
+    assert (cells > 0).sum() > (nuclei > 0).sum()
+
+
+def test_expand_labels_ROI_3D_blocks():
+    rng = np.random.default_rng(0)
+    x = np.zeros((20, 48, 48), dtype=np.uint16)
+    x[tuple(rng.integers(0, [20, 48, 48], size=(30, 3)).T)] = np.arange(1, 31)
+    spacing = (3.0, 1.0, 1.0)
+
+    full = expand_labels_ROI(x, expansion_distance=6, spacing=spacing)
+    blocks = expand_labels_ROI(x, expansion_distance=6, spacing=spacing, z_block_size=4)
+    np.testing.assert_array_equal(blocks, full)
+
+    # single object: expanded by 6 pixels in xy, but only 2 planes in z
+    x = np.zeros((11, 21, 21), dtype=np.uint16)
+    x[5, 10, 10] = 1
+    expanded = expand_labels_ROI(x, expansion_distance=6, spacing=spacing)
+    z, _, x = np.nonzero(expanded)
+    assert (z.min(), z.max()) == (3, 7)
+    assert (x.min(), x.max()) == (4, 16)
+
+
+def test_expand_segmentation_across_ROI_borders(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    expand_segmentation(
+        zarr_url=zarr_url,
+        input_ROI_table="FOV_ROI_table",
+        input_label_name="nuclei",
+        expansion_distance=10,
+        union_output_label_name="cells_fov",
+        difference_output_label_name="cytoplasms_fov",
+        expand_across_ROI_borders=True,
+        max_workers=2,
+    )
+    expand_segmentation(
+        zarr_url=zarr_url,
+        input_ROI_table="well_ROI_table",
+        input_label_name="nuclei",
+        expansion_distance=10,
+        union_output_label_name="cells_well",
+        difference_output_label_name="cytoplasms_well",
+    )
+    omezarr = open_ome_zarr_container(zarr_url)
+    for name in ["cells", "cytoplasms"]:
+        np.testing.assert_array_equal(
+            omezarr.get_label(f"{name}_fov").get_as_numpy(),
+            omezarr.get_label(f"{name}_well").get_as_numpy(),
+        )
+
+
+def test_expand_segmentation_output_ROI_table(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    for save_union in (True, False):
+        expand_segmentation(
+            zarr_url=zarr_url,
+            input_label_name="nuclei",
+            expansion_distance=10,
+            save_union=save_union,
+            union_output_label_name="cells",
+            difference_output_label_name="cytoplasms",
+            output_ROI_table="cells_ROI_table",
+            expand_across_ROI_borders=True,
+        )
+        omezarr = open_ome_zarr_container(zarr_url)
+        table = omezarr.get_table("cells_ROI_table")
+        label_name = "cells" if save_union else "cytoplasms"
+        expected = omezarr.get_label(label_name).build_masking_roi_table()
+        assert table.reference_label == label_name
+        keys = ("label", "x", "y", "z", "x_length", "y_length", "z_length")
+        boxes = [
+            sorted(tuple(getattr(roi, key) for key in keys) for roi in rois)
+            for rois in (table.rois(), expected.rois())
+        ]
+        assert boxes[0] == boxes[1]
+
+
+def test_expand_segmentation_2D_across_ROI_borders(tmp_path):
+    zarr_url = str(tmp_path / "image_2D.zarr")
+    omezarr = create_ome_zarr_from_array(
+        zarr_url,
+        np.zeros((1, 64, 96), dtype=np.uint16),
+        xy_pixelsize=0.5,
+        levels=1,
+        axes_names="cyx",
+    )
+    omezarr.add_table("FOV_ROI_table", omezarr.build_image_roi_table("FOV_1"))
+    nuclei = np.zeros((64, 96), dtype=np.uint16)
+    nuclei[10:20, 10:20] = 1
+    nuclei[40:50, 60:70] = 2
+    omezarr.derive_label("nuclei").set_array(nuclei, axes_order="yx")
+
+    expand_segmentation(
+        zarr_url=zarr_url,
+        input_ROI_table="FOV_ROI_table",
+        input_label_name="nuclei",
+        expansion_distance=3,
+        union_output_label_name="cells",
+        difference_output_label_name="cytoplasms",
+        output_ROI_table="cells_ROI_table",
+        expand_across_ROI_borders=True,
+    )
+    omezarr = open_ome_zarr_container(zarr_url)
+    cells = omezarr.get_label("cells").get_array(axes_order="yx")
+    assert cells.shape == (64, 96)
+    expected = expand_labels_ROI(nuclei[None], expansion_distance=3)[0]
+    np.testing.assert_array_equal(cells, expected)
+    assert (cells > 0).sum() > (nuclei > 0).sum()
+    table = omezarr.get_table("cells_ROI_table")
+    expected = omezarr.get_label("cells").build_masking_roi_table()
+    keys = ("label", "x", "y", "x_length", "y_length")
+    boxes = [
+        sorted(tuple(getattr(roi, key) for key in keys) for roi in rois)
+        for rois in (table.rois(), expected.rois())
+    ]
+    assert boxes[0] == boxes[1]
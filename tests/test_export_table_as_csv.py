@@ -1,8 +1,11 @@
 import shutil
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pytest
+from ngio import create_ome_zarr_from_array, open_ome_zarr_container
+from ngio.tables import FeatureTable
 
 from zmb_fractal_tasks.export_table_as_csv import export_table_as_csv
 from zmb_fractal_tasks.measure_features import LabelInput, measure_features
@@ -172,3 +175,53 @@ def test_export_table_plate_name_parsing(zarr_with_measurements, tmp_path):
     # Should be the stem of the zarr file
     expected_plate_name = zarr_with_measurements.stem
     assert df["plate"].iloc[0] == expected_plate_name
+
+
+def test_export_table_multiple_images(zarr_with_measurements, tmp_path):
+    """Test that the tables of all images are appended with a running index."""
+    zarr_url = str(zarr_with_measurements / "B" / "03" / "0")
+    export_table_as_csv(
+        zarr_urls=[zarr_url, zarr_url],
+        zarr_dir=str(tmp_path),
+        tables_to_export=["nuclei_measurements"],
+    )
+
+    df = pd.read_csv(tmp_path / "nuclei_measurements.csv", index_col=0)
+    table_df = open_ome_zarr_container(zarr_url).get_table("nuclei_measurements")
+    n_objects = len(table_df.dataframe)
+    assert list(df.index) == list(range(2 * n_objects))
+    assert list(df.columns[:2]) == ["plate", "well"]
+    pd.testing.assert_frame_equal(
+        df.iloc[n_objects:].reset_index(drop=True),
+        df.iloc[:n_objects].reset_index(drop=True),
+    )
+
+
+def test_export_table_differing_columns(tmp_path):
+    """Test that the columns of all tables are exported."""
+    tables = {
+        "B/03/0": pd.DataFrame({"label": [1, 2], "area": [10, 20]}),
+        "B/04/0": pd.DataFrame({"label": [1], "area": [30], "extra": [0.5]}),
+    }
+    zarr_urls = []
+    for component, table_df in tables.items():
+        zarr_url = str(tmp_path / "plate.zarr" / component)
+        omezarr = create_ome_zarr_from_array(
+            zarr_url, np.zeros((1, 16, 16), dtype=np.uint16), xy_pixelsize=1.0
+        )
+        omezarr.add_table("features", FeatureTable(table_df.set_index("label")))
+        zarr_urls.append(zarr_url)
+
+    export_table_as_csv(
+        zarr_urls=zarr_urls, zarr_dir=str(tmp_path), tables_to_export=["features"]
+    )
+    df = pd.read_csv(tmp_path / "features.csv", index_col=0)
+    assert list(df.columns) == ["plate", "well", "label", "area", "extra"]
+    assert list(df["well"]) == ["B03", "B03", "B04"]
+    assert list(df["area"]) == [10, 20, 30]
+    np.testing.assert_array_equal(df["extra"], [np.nan, np.nan, 0.5])
+    # no temporary files are left
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "features.csv",
+        "plate.zarr",
+    ]
@@ -4,6 +4,7 @@ import numpy as np
 import tifffile
 from ngio import open_ome_zarr_container
 
+from zmb_fractal_tasks.basic_apply_illumination_profile import correct
 from zmb_fractal_tasks.illumination_correction import illumination_correction
 
 
@@ -310,6 +311,7 @@ def test_illumination_correction_multiple_rois(zarr_path, tmpdir):
         background=0,
         input_ROI_table="FOV_ROI_table",
         overwrite_input_image=True,
+        max_workers=4,
     )
 
     # Check all ROIs were corrected
@@ -321,3 +323,7 @@ def test_illumination_correction_multiple_rois(zarr_path, tmpdir):
         assert not np.array_equal(original_data, corrected_data), (
             f"ROI {idx} should be modified"
         )
+        np.testing.assert_array_equal(
+            corrected_data,
+            correct(original_data, flatfield, np.zeros_like(flatfield), 0),
+        )
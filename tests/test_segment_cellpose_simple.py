@@ -1,3 +1,6 @@
+import numpy as np
+from ngio import open_ome_zarr_container
+
 from zmb_fractal_tasks.histogram_aggregate_plate import histogram_aggregate_plate
 from zmb_fractal_tasks.histogram_calculate import histogram_calculate
 from zmb_fractal_tasks.segment_cellpose_simple import segment_cellpose_simple
@@ -5,6 +8,7 @@ from zmb_fractal_tasks.utils.normalization import (
     CustomNormalizer,
     NormalizedChannelInputModel,
 )
+from zmb_fractal_tasks.utils.relabel import load_label_offsets
 
 
 def test_segment_cellpose_simple(zarr_MIP_path):
@@ -35,3 +39,74 @@ def test_segment_cellpose_simple(zarr_MIP_path):
         diameter=60.0,
     )
     # TODO: Check outputs
+
+
+def test_segment_cellpose_simple_roi_batches(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    channel = NormalizedChannelInputModel(
+        label="DAPI",
+        normalize=CustomNormalizer(mode="default"),
+    )
+    labels = []
+    for roi_batch_size in (16, 1):
+        segment_cellpose_simple(
+            zarr_url=zarr_url,
+            pyramid_level="2",
+            channel=channel,
+            diameter=60.0,
+            roi_batch_size=roi_batch_size,
+        )
+        label_image = open_ome_zarr_container(zarr_url).get_label("cellpose")
+        labels.append(label_image.get_array())
+    # streaming the ROIs in batches gives the same (unique) labels
+    np.testing.assert_array_equal(labels[0], labels[1])
+
+
+def test_segment_cellpose_simple_single_ROI(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    channel = NormalizedChannelInputModel(
+        label="DAPI",
+        normalize=CustomNormalizer(mode="default"),
+    )
+    segment_cellpose_simple(
+        zarr_url=zarr_url, pyramid_level="2", channel=channel, diameter=60.0
+    )
+    omezarr = open_ome_zarr_container(zarr_url)
+    rois = omezarr.get_table("FOV_ROI_table").rois()
+    label_image = omezarr.get_label("cellpose", path="2")
+    stored_offsets = load_label_offsets(label_image)
+    assert list(stored_offsets) == [(roi.name, None) for roi in rois]
+    before = label_image.get_array()
+
+    # segmenting a ROI again with the same parameters keeps its labels (the
+    # last ROI, since the rounded ROIs share a row of pixels at level 2)
+    segment_cellpose_simple(
+        zarr_url=zarr_url,
+        pyramid_level="2",
+        channel=channel,
+        diameter=60.0,
+        ROI_names=[rois[-1].name],
+    )
+    label_image = omezarr.get_label("cellpose", path="2")
+    np.testing.assert_array_equal(label_image.get_array(), before)
+    assert load_label_offsets(label_image) == stored_offsets
+
+
+def test_segment_cellpose_simple_3D(zarr_3D_path):
+    zarr_url = str(zarr_3D_path / "B" / "03" / "0")
+    channel = NormalizedChannelInputModel(
+        label="DAPI",
+        normalize=CustomNormalizer(mode="default"),
+    )
+    for do_3D in (False, True):
+        segment_cellpose_simple(
+            zarr_url=zarr_url,
+            pyramid_level="2",
+            channel=channel,
+            diameter=60.0,
+            do_3D=do_3D,
+        )
+        omezarr = open_ome_zarr_container(zarr_url)
+        image = omezarr.get_image(path="2")
+        labels = omezarr.get_label("cellpose", path="2").get_array()
+        assert labels.shape[-3:] == image.get_array().shape[-3:]
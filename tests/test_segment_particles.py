@@ -1,9 +1,26 @@
+import numpy as np
+import pytest
+from ngio import open_ome_zarr_container
+from scipy import ndimage
+
 from zmb_fractal_tasks.histogram_calculate import histogram_calculate
-from zmb_fractal_tasks.segment_particles import segment_particles
+from zmb_fractal_tasks.segment_particles import (
+    gaussian_laplace_threshold,
+    log_filter_bank,
+    segment_particles,
+    segment_ROI,
+)
 from zmb_fractal_tasks.utils.normalization import (
     CustomNormalizer,
     NormalizedChannelInputModel,
 )
+from zmb_fractal_tasks.utils.relabel import load_label_offsets
+
+
+def roi_boxes(rois):
+    """(label, start & length per axis) of ROIs, sorted by label."""
+    keys = ("x", "y", "z", "x_length", "y_length", "z_length")
+    return sorted((roi.label, *[getattr(roi, key) for key in keys]) for roi in rois)
 
 
 def test_segment_particles(zarr_path):
@@ -26,3 +43,148 @@ def test_segment_particles(zarr_path):
         ),
     )
     # TODO: Check outputs
+
+
+def test_segment_particles_output_ROI_table(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    for max_workers in (1, 2):
+        segment_particles(
+            zarr_url=zarr_url,
+            pyramid_level="1",
+            channel=NormalizedChannelInputModel(label="DAPI"),
+            output_ROI_table="particles_ROI_table",
+            max_workers=max_workers,
+        )
+        omezarr = open_ome_zarr_container(zarr_url)
+        rois = omezarr.get_table("particles_ROI_table").rois()
+        expected = omezarr.get_label("particles", path="1").build_masking_roi_table()
+        assert len(rois) > 0
+        assert roi_boxes(rois) == roi_boxes(expected.rois())
+
+
+def test_segment_particles_label_offsets(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    segment_particles(
+        zarr_url=zarr_url,
+        pyramid_level="1",
+        channel=NormalizedChannelInputModel(label="DAPI"),
+        max_workers=2,
+    )
+    omezarr = open_ome_zarr_container(zarr_url)
+    label_image = omezarr.get_label("particles", path="1")
+    rois = omezarr.get_table("FOV_ROI_table").rois()
+    stored_offsets = load_label_offsets(label_image)
+    assert list(stored_offsets) == [(roi.name, None) for roi in rois]
+    # the labels of each ROI are in its stored label range
+    for roi in rois:
+        offset, count = stored_offsets[(roi.name, None)]
+        labels = np.unique(label_image.get_roi(roi))
+        labels = labels[labels > 0]
+        assert len(labels) == count
+        assert labels.min() == offset + 1 and labels.max() == offset + count
+
+
+def test_segment_particles_single_ROI(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    channel = NormalizedChannelInputModel(label="DAPI")
+    segment_particles(zarr_url=zarr_url, pyramid_level="1", channel=channel)
+    omezarr = open_ome_zarr_container(zarr_url)
+    rois = omezarr.get_table("FOV_ROI_table").rois()
+    label_image = omezarr.get_label("particles", path="1")
+    stored_offsets = load_label_offsets(label_image)
+    before = {roi.name: label_image.get_roi(roi) for roi in rois}
+    rerun_roi = rois[1]
+
+    # fewer labels keep the label range of the ROI, more labels are appended
+    for s2_param, append in (([[1, 0.2]], False), ([[1, 0.01]], True)):
+        segment_particles(
+            zarr_url=zarr_url,
+            pyramid_level="1",
+            channel=channel,
+            ROI_names=[rerun_roi.name],
+            s2_param=s2_param,
+            output_ROI_table="particles_ROI_table",
+        )
+        label_image = omezarr.get_label("particles", path="1")
+        offsets = load_label_offsets(label_image)
+        offset, count = offsets[(rerun_roi.name, None)]
+        max_label = max(o + c for o, c in stored_offsets.values())
+        assert offset == (
+            max_label if append else stored_offsets[(rerun_roi.name, None)][0]
+        )
+        labels = label_image.get_roi(rerun_roi)
+        assert labels.max() > offset
+        assert labels[labels > 0].min() > offset
+        assert labels.max() <= offset + count
+        # the other ROIs are unchanged
+        for roi in rois:
+            if roi.name != rerun_roi.name:
+                np.testing.assert_array_equal(
+                    label_image.get_roi(roi), before[roi.name]
+                )
+                assert offsets[(roi.name, None)] == stored_offsets[(roi.name, None)]
+        masking_rois = omezarr.get_table("particles_ROI_table").rois()
+        assert len(masking_rois) == len(np.unique(label_image.get_array())) - 1
+
+
+def test_segment_particles_single_ROI_without_offsets(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    omezarr = open_ome_zarr_container(zarr_url)
+    omezarr.derive_label("particles")
+    with pytest.raises(ValueError, match="no label offsets"):
+        segment_particles(
+            zarr_url=zarr_url,
+            channel=NormalizedChannelInputModel(label="DAPI"),
+            ROI_names=["FOV_1"],
+        )
+
+
+def test_log_filter_bank():
+    rng = np.random.default_rng(0)
+    image = ndimage.gaussian_filter(rng.random((64, 64), dtype=np.float32), 1)
+    sigmas = [2.0, 1.0, 4.0, 1.5]
+    seen = []
+    for sigma, response in log_filter_bank(image, sigmas, presmooth_sigma=1.0):
+        seen.append(sigma)
+        expected = ndimage.gaussian_laplace(image, np.hypot(sigma, 1.0))
+        core = (slice(16, -16),) * 2
+        np.testing.assert_allclose(
+            response[core], expected[core], atol=1e-2 * np.abs(expected).max()
+        )
+    assert seen == sorted(sigmas)
+
+
+def test_gaussian_laplace_threshold():
+    rng = np.random.default_rng(0)
+    image = rng.random((32, 32), dtype=np.float32)
+    s2_param = [[1, 0.04], [1, 0.5]]
+    mask = gaussian_laplace_threshold(image, s2_param)
+    expected = -ndimage.gaussian_laplace(image, 1) > 0.04
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_segment_ROI_planes_and_blocks():
+    rng = np.random.default_rng(0)
+    img = np.zeros((12, 64, 64), dtype=np.float32)
+    spots = rng.integers(0, [12, 64, 64], (40, 3))
+    img[tuple(spots.T)] = rng.uniform(500, 2000, 40)
+    img = ndimage.gaussian_filter(img, 1.5) * 50 + rng.normal(100, 5, img.shape)
+    img = img.clip(0).astype(np.uint16)[None]
+    kwargs = {
+        "gaussian_smoothing_sigma": 1.0,
+        "s2_param": [[1, 0.04], [2, 0.1]],
+        "normalize": CustomNormalizer(mode="default"),
+    }
+    labels = segment_ROI(img, **kwargs)
+    # planes in parallel give the same result
+    np.testing.assert_array_equal(segment_ROI(img, max_workers=4, **kwargs), labels)
+    # blocks of planes keep each seed once
+    blocked = segment_ROI(img, z_block_size=4, max_workers=2, **kwargs)
+    assert blocked.max() == labels.max()
+    np.testing.assert_array_equal(blocked > 0, labels > 0)
+    # without the uint16 cast there are no plateaus, so blocks match exactly
+    kwargs["float_watershed"] = True
+    np.testing.assert_array_equal(
+        segment_ROI(img, z_block_size=4, max_workers=2, **kwargs),
+        segment_ROI(img, **kwargs),
+    )
@@ -1,5 +1,12 @@
+import numpy as np
+import pandas as pd
+from ngio import create_ome_zarr_from_array, open_ome_zarr_container
+
 from zmb_fractal_tasks.smo_background_estimation import (
+    MedianAccumulator,
+    median,
     smo_background_estimation,
+    subtract_BG,
 )
 
 
@@ -14,3 +21,145 @@ def test_smo_background_estimation(zarr_path):
         new_well_subgroup_suffix="BG_subtracted",
     )
     # TODO: Check outputs
+
+
+def test_smo_background_estimation_parallel(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    tables = []
+    for max_workers in (1, 4):
+        smo_background_estimation(zarr_url=zarr_url, max_workers=max_workers)
+        omezarr = open_ome_zarr_container(zarr_url)
+        tables.append(omezarr.get_table("BG_feature_table").dataframe)
+    pd.testing.assert_frame_equal(tables[0], tables[1])
+
+
+def test_median():
+    rng = np.random.default_rng(0)
+    for dtype, low in ((np.uint16, 0), (np.int16, -1000), (np.float32, 0)):
+        for n in (1, 10, 11):
+            values = rng.integers(low, 1000, n).astype(dtype)
+            assert median(values) == np.median(values)
+
+
+def test_median_accumulator():
+    rng = np.random.default_rng(0)
+    for dtype in (np.uint8, np.int16, np.float32):
+        parts = [rng.integers(0, 100, n).astype(dtype) for n in (5, 0, 8)]
+        accumulator = MedianAccumulator()
+        for part in parts:
+            accumulator.merge(MedianAccumulator(part))
+        assert accumulator.median() == np.median(np.concatenate(parts))
+    # parts of different dtypes
+    accumulator = MedianAccumulator(np.array([1, 2], dtype=np.uint8))
+    accumulator.add(np.array([-5, 7, 9], dtype=np.int16))
+    assert accumulator.median() == 2
+
+
+def test_smo_background_estimation_per_plane(zarr_3D_path):
+    zarr_url = str(zarr_3D_path / "B" / "03" / "0")
+    original = open_ome_zarr_container(zarr_url).get_image()
+    smo_background_estimation(
+        zarr_url=zarr_url,
+        estimate_per_plane=True,
+        subtract_background=True,
+        overwrite_input_image=False,
+        new_well_subgroup_suffix="_BG_subtracted",
+    )
+    omezarr = open_ome_zarr_container(zarr_url)
+    bg_df = omezarr.get_table("BG_feature_table").dataframe
+    n_fovs = len(omezarr.get_table("FOV_ROI_table").rois())
+    assert len(bg_df) == n_fovs * original.dimensions.get("z")
+    assert "t" not in bg_df.columns
+    # each plane has its own BG subtracted
+    output = open_ome_zarr_container(zarr_url + "_BG_subtracted").get_image()
+    row = bg_df.iloc[-1]
+    roi = omezarr.get_table("FOV_ROI_table").get(row["ROI"])
+    for c, channel in enumerate(original.channel_labels):
+        plane = original.get_roi(roi, c=c, axes_order="zyx")[row["z"]]
+        expected = subtract_BG(plane, row[f"BG_{channel}"])
+        result = output.get_roi(roi, c=c, axes_order="zyx")[row["z"]]
+        np.testing.assert_array_equal(result, expected)
+
+
+def test_smo_background_estimation_time_series(tmp_path):
+    rng = np.random.default_rng(0)
+    array = rng.poisson(100, (3, 1, 2, 64, 64)).astype(np.uint16)
+    array[1] += 100
+    array[..., 20:30, 20:30] += 2000
+    zarr_url = str(tmp_path / "time_series.zarr")
+    omezarr = create_ome_zarr_from_array(
+        zarr_url, array, xy_pixelsize=1.0, levels=2, axes_names="tczyx"
+    )
+    omezarr.add_table("FOV_ROI_table", omezarr.build_image_roi_table("FOV_1"))
+
+    smo_background_estimation(zarr_url=zarr_url, subtract_background=True)
+
+    omezarr = open_ome_zarr_container(zarr_url)
+    bg_df = omezarr.get_table("BG_feature_table").dataframe
+    assert list(bg_df["t"]) == [0, 1, 2]
+    assert "z" not in bg_df.columns
+    bg_values = bg_df.filter(like="BG_").to_numpy()
+    assert (np.abs(bg_values - [[100], [200], [100]]) <= 5).all()
+    # the BG of each timepoint is removed
+    means = omezarr.get_image().get_array().mean(axis=(1, 2, 3, 4))
+    np.testing.assert_allclose(means, means[0], rtol=0.05)
+
+
+def test_smo_background_subtraction_single_pass(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    original = open_ome_zarr_container(zarr_url).get_image().get_array()
+    smo_background_estimation(
+        zarr_url=zarr_url,
+        subtract_background=True,
+        overwrite_input_image=False,
+        new_well_subgroup_suffix="_BG_subtracted",
+        max_workers=2,
+    )
+    omezarr = open_ome_zarr_container(zarr_url)
+    bg_df = omezarr.get_table("BG_feature_table").dataframe
+    output = open_ome_zarr_container(zarr_url + "_BG_subtracted")
+    assert "BG_feature_table" in output.list_tables()
+    # the image is unchanged, the output has its BG subtracted
+    np.testing.assert_array_equal(omezarr.get_image().get_array(), original)
+    assert (output.get_image().get_array() <= original).all()
+    assert bg_df.filter(like="BG_").to_numpy().min() > 0
+
+
+def test_subtract_BG():
+    rng = np.random.default_rng(0)
+    patch = rng.integers(0, 2000, (1, 16, 16), dtype=np.uint16)
+    for bg_value in (0.0, 771.0, 771.5, 5000.0):
+        expected = np.where(patch > bg_value, patch - bg_value, 0).astype(np.uint16)
+        np.testing.assert_array_equal(subtract_BG(patch, bg_value), expected)
+        in_place = patch.copy()
+        assert subtract_BG(in_place, bg_value, out=in_place) is in_place
+        np.testing.assert_array_equal(in_place, expected)
+
+
+def test_smo_background_estimation_2D(tmp_path):
+    rng = np.random.default_rng(0)
+    array = rng.poisson(100, (2, 64, 64)).astype(np.uint16)
+    array[1] += 100
+    array[:, 20:30, 20:30] += 2000
+    zarr_url = str(tmp_path / "image_2D.zarr")
+    omezarr = create_ome_zarr_from_array(
+        zarr_url, array, xy_pixelsize=1.0, levels=2, axes_names="cyx"
+    )
+    omezarr.add_table("FOV_ROI_table", omezarr.build_image_roi_table("FOV_1"))
+
+    for estimate_per_plane in (False, True):
+        smo_background_estimation(
+            zarr_url=zarr_url,
+            subtract_background=True,
+            overwrite_input_image=False,
+            estimate_per_plane=estimate_per_plane,
+        )
+        bg_df = open_ome_zarr_container(zarr_url).get_table("BG_feature_table")
+        bg_values = bg_df.dataframe.filter(like="BG_").to_numpy()
+        assert (np.abs(bg_values - [[100, 200]]) <= 5).all()
+    output_path = str(tmp_path / "image_2D_BG_subtracted")
+    output = open_ome_zarr_container(output_path).get_image()
+    for c, bg_value in enumerate(bg_values[0]):
+        np.testing.assert_array_equal(
+            output.get_array(c=c, axes_order="yx"), subtract_BG(array[c], bg_value)
+        )
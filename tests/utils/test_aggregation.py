@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from zmb_fractal_tasks.utils.aggregation import (
+    GroupedStats,
+    grouped_aggregate,
+)
+
+
+@pytest.fixture
+def seed_df():
+    rng = np.random.default_rng(0)
+    n = 500
+    df = pd.DataFrame(
+        {
+            "well": rng.choice(["B03", "B04"], n),
+            "parent_ID": pd.array(rng.integers(1, 20, n), dtype="Int64"),
+            "area": rng.integers(0, 1000, n),
+            "intensity": rng.normal(size=n),
+        }
+    )
+    df.loc[:10, "intensity"] = np.nan
+    df.loc[20:25, "parent_ID"] = pd.NA
+    return df
+
+
+@pytest.mark.parametrize("method", ["count", "sum", "mean", "std", "sem", "min", "max"])
+def test_grouped_aggregate_matches_pandas(seed_df, method):
+    result = grouped_aggregate(
+        seed_df, by="parent_ID", columns=["area", "intensity"], methods=[method]
+    )
+    expected = seed_df.groupby("parent_ID")[["area", "intensity"]].agg(method)
+    for column in ["area", "intensity"]:
+        np.testing.assert_allclose(
+            result[(column, method)].to_numpy(dtype=float),
+            expected[column].to_numpy(dtype=float),
+        )
+        assert result[(column, method)].index.equals(expected.index)
+
+
+def test_grouped_aggregate_fallback(seed_df):
+    result = grouped_aggregate(
+        seed_df, by="parent_ID", columns=["intensity"], methods=["median"]
+    )
+    expected = seed_df.groupby("parent_ID")["intensity"].median()
+    np.testing.assert_allclose(result[("intensity", "median")], expected)
+
+    result = grouped_aggregate(
+        seed_df, by="parent_ID", columns=["well"], methods=["max"]
+    )
+    expected = seed_df.groupby("parent_ID")["well"].max()
+    assert list(result[("well", "max")]) == list(expected)
+
+
+def test_grouped_stats_merge(seed_df):
+    columns = ["area", "intensity"]
+    stats_all = GroupedStats.from_dataframe(seed_df, by="parent_ID", columns=columns)
+    stats_merged = GroupedStats.from_dataframe(
+        seed_df.iloc[:200], by="parent_ID", columns=columns
+    ).merge(
+        GroupedStats.from_dataframe(seed_df.iloc[200:], by="parent_ID", columns=columns)
+    )
+
+    assert stats_merged.keys.equals(stats_all.keys)
+    np.testing.assert_array_equal(stats_merged.size, stats_all.size)
+    for method in ["count", "sum", "mean", "std", "sem", "min", "max"]:
+        np.testing.assert_allclose(stats_merged.get(method), stats_all.get(method))
+
+
+def test_grouped_stats_multiple_keys(seed_df):
+    stats = GroupedStats.from_dataframe(
+        seed_df, by=["well", "parent_ID"], columns=["intensity"]
+    )
+    expected = seed_df.groupby(["well", "parent_ID"])["intensity"].mean()
+
+    assert stats.keys.equals(expected.index)
+    np.testing.assert_allclose(stats.get("mean")[:, 0], expected.to_numpy())
+
+
+def test_grouped_stats_size(seed_df):
+    # number of rows per group, also where the first column has NaNs
+    stats = GroupedStats.from_dataframe(
+        seed_df, by="parent_ID", columns=["intensity", "area"]
+    )
+    expected = seed_df.groupby("parent_ID").size()
+    np.testing.assert_array_equal(stats.size, expected.to_numpy())
+    assert (stats.get("count")[:, 0] < stats.size).any()
+
+    stats = GroupedStats.from_dataframe(seed_df, by="parent_ID", columns=[])
+    np.testing.assert_array_equal(stats.size, expected.to_numpy())
+
+
+def test_grouped_stats_empty():
+    df = pd.DataFrame({"parent_ID": pd.array([], dtype="Int64"), "area": []})
+    stats = GroupedStats.from_dataframe(df, by="parent_ID", columns=["area"])
+
+    assert len(stats.keys) == 0
+    assert stats.size.shape == (0,)
+    assert stats.get("mean").shape == (0, 1)
@@ -0,0 +1,34 @@
+import torch
+
+from zmb_fractal_tasks.utils import cellpose_models
+from zmb_fractal_tasks.utils.cellpose_models import (
+    clear_cellpose_models,
+    get_cellpose_model,
+)
+
+
+class _Model:
+    """Stand-in for a Cellpose model (building one needs its weights)."""
+
+    def __init__(self, gpu, model_type):
+        self.gpu = gpu
+        self.model_type = model_type
+
+
+def test_get_cellpose_model(monkeypatch):
+    monkeypatch.setattr(cellpose_models.models, "Cellpose", _Model)
+    n_threads = torch.get_num_threads()
+    clear_cellpose_models()
+    try:
+        model = get_cellpose_model(model_type="nuclei", torch_threads=1)
+        assert torch.get_num_threads() == 1
+        # the model is only built once, whatever the number of threads
+        assert get_cellpose_model(model_type="nuclei", torch_threads=1) is model
+        assert get_cellpose_model(model_type="nuclei", torch_threads=2) is model
+        assert torch.get_num_threads() == 2
+        assert get_cellpose_model(model_type="cyto") is not model
+        clear_cellpose_models()
+        assert get_cellpose_model(model_type="nuclei") is not model
+    finally:
+        clear_cellpose_models()
+        torch.set_num_threads(n_threads)
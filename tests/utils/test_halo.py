@@ -0,0 +1,43 @@
+import numpy as np
+from ngio import Roi, create_ome_zarr_from_array
+
+from zmb_fractal_tasks.utils.halo import roi_halo_slices
+
+
+def test_roi_halo_slices_fractional_roi(tmp_path):
+    array = np.arange(2 * 3 * 40 * 50, dtype=np.uint16).reshape(2, 3, 40, 50)
+    omezarr = create_ome_zarr_from_array(
+        str(tmp_path / "image.zarr"), array, xy_pixelsize=0.5, levels=1
+    )
+    image = omezarr.get_image()
+    # starts & stops between pixels (e.g. after rescaling a ROI table)
+    roi = Roi(name="roi", x=2.3, y=1.7, z=0, x_length=6.1, y_length=4.9, z_length=2)
+    extended, core, core_in_extended = roi_halo_slices(
+        roi, image, halo={"y": 3, "x": 100}
+    )
+    expected = image.get_roi(roi, axes_order="czyx")
+    np.testing.assert_array_equal(image.get_array(axes_order="czyx", **core), expected)
+    assert extended == {"z": slice(0, 2), "y": slice(0, 17), "x": slice(0, 50)}
+    patch = image.get_array(axes_order="czyx", **extended)
+    np.testing.assert_array_equal(patch[(slice(None), *core_in_extended)], expected)
+
+
+def test_roi_halo_slices_2D(tmp_path):
+    array = np.zeros((1, 40, 50), dtype=np.uint16)
+    omezarr = create_ome_zarr_from_array(
+        str(tmp_path / "image.zarr"),
+        array,
+        xy_pixelsize=1.0,
+        levels=1,
+        axes_names="cyx",
+    )
+    image = omezarr.get_image()
+    roi = Roi(name="roi", x=10, y=20, z=0, x_length=10, y_length=10, z_length=1)
+    extended, core, core_in_extended = roi_halo_slices(
+        roi, image, halo={"z": 2, "y": 5, "x": 5}
+    )
+    assert extended == {"y": slice(15, 35), "x": slice(5, 25)}
+    assert core == {"y": slice(20, 30), "x": slice(10, 20)}
+    assert core_in_extended == (slice(None), slice(5, 15), slice(5, 15))
+    patch = image.get_array(axes_order="zyx", **extended)
+    assert patch[core_in_extended].shape == (1, 10, 10)
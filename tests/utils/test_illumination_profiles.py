@@ -0,0 +1,42 @@
+import numpy as np
+
+from zmb_fractal_tasks.utils.illumination_profiles import (
+    load_illumination_profile,
+    save_illumination_profile,
+)
+
+
+def test_save_load_illumination_profile(tmp_path):
+    rng = np.random.default_rng(0)
+    flatfield = rng.uniform(0.5, 1.5, size=(16, 16)).astype(np.float32)
+    baseline = rng.uniform(0, 100, size=10)
+
+    # zero darkfield is not stored
+    save_illumination_profile(
+        tmp_path / "C01", flatfield, np.zeros_like(flatfield), baseline
+    )
+    assert not (tmp_path / "C01" / "darkfield.npy").exists()
+    profile = load_illumination_profile(tmp_path / "C01")
+    assert profile.darkfield is None
+    assert isinstance(profile.inv_flatfield, np.memmap)
+    assert not profile.inv_flatfield.flags.writeable
+    np.testing.assert_allclose(profile.inv_flatfield, 1 / flatfield, rtol=1e-6)
+    np.testing.assert_array_equal(profile.baseline, baseline)
+    # profiles are cached
+    assert load_illumination_profile(tmp_path / "C01") is profile
+
+    darkfield = rng.uniform(0, 100, size=(16, 16))
+    save_illumination_profile(tmp_path / "C02", flatfield, darkfield)
+    profile = load_illumination_profile(tmp_path / "C02")
+    np.testing.assert_allclose(profile.darkfield, darkfield, rtol=1e-6)
+    assert profile.baseline is None
+
+
+def test_load_illumination_profile_without_derived_arrays(tmp_path):
+    flatfield = np.full((8, 8), 2.0)
+    np.save(tmp_path / "flatfield.npy", flatfield)
+    np.save(tmp_path / "darkfield.npy", np.zeros_like(flatfield))
+    profile = load_illumination_profile(tmp_path)
+    assert profile.darkfield is None
+    assert profile.inv_flatfield.dtype == np.float32
+    np.testing.assert_array_equal(profile.inv_flatfield, 0.5)
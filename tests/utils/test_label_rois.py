@@ -0,0 +1,61 @@
+import numpy as np
+from ngio import Roi, create_ome_zarr_from_array, open_ome_zarr_container
+
+from zmb_fractal_tasks.utils.label_rois import (
+    LabelBoxes,
+    find_label_boxes,
+    roi_origin,
+)
+
+
+def roi_boxes(rois):
+    """(label, start & length per axis) of ROIs, sorted by label."""
+    keys = ("x", "y", "z", "x_length", "y_length", "z_length")
+    return sorted((roi.label, *[getattr(roi, key) for key in keys]) for roi in rois)
+
+
+def test_find_label_boxes():
+    labels = np.zeros((2, 10, 10), dtype=np.uint16)
+    labels[0, 1:3, 2:5] = 1
+    labels[:, 5, 5:] = 4
+    ids, starts, stops = find_label_boxes(labels, origin=(0, 100, 200))
+    np.testing.assert_array_equal(ids, [1, 4])
+    np.testing.assert_array_equal(starts, [[0, 101, 202], [0, 105, 205]])
+    np.testing.assert_array_equal(stops, [[1, 103, 205], [2, 106, 210]])
+    ids, starts, stops = find_label_boxes(np.zeros((1, 5, 5), dtype=np.uint16))
+    assert ids.shape == (0,) and starts.shape == stops.shape == (0, 3)
+
+
+def test_label_boxes_merged_across_rois(zarr_3D_path):
+    omezarr = open_ome_zarr_container(str(zarr_3D_path / "B" / "03" / "0"))
+    omezarr.derive_label("objects", overwrite=True)
+    label_image = omezarr.get_label("objects", path="1")
+    labels = np.zeros(label_image.get_array().shape, dtype=np.uint16)
+    labels[0:2, 10:20, 30:300] = 1  # spans two FOVs
+    labels[1:3, 100:200, 5:10] = 7
+    label_image.set_array(labels)
+
+    label_boxes = LabelBoxes()
+    for roi in omezarr.get_table("FOV_ROI_table").rois():
+        patch = label_image.get_roi(roi, axes_order="zyx")
+        label_boxes.add_labels(patch, roi_origin(roi, label_image))
+
+    table = label_boxes.to_masking_roi_table(label_image)
+    assert table.reference_label == "objects"
+    expected = label_image.build_masking_roi_table()
+    assert roi_boxes(table.rois()) == roi_boxes(expected.rois())
+
+
+def test_roi_origin(tmp_path):
+    omezarr = create_ome_zarr_from_array(
+        str(tmp_path / "image.zarr"),
+        np.zeros((1, 40, 50), dtype=np.uint16),
+        xy_pixelsize=0.5,
+        levels=1,
+        axes_names="cyx",
+    )
+    label_image = omezarr.derive_label("objects")
+    roi = Roi(name="roi", x=2.3, y=1.7, z=0, x_length=6, y_length=5, z_length=1)
+    # starts are floored (like get_roi), z of the yx label is 0
+    assert roi_origin(roi, label_image) == (0, 3, 4)
+    assert roi_origin(roi, omezarr.get_image()) == (0, 3, 4)
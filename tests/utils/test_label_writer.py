@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import zarr
+from ngio import open_ome_zarr_container
+
+from zmb_fractal_tasks.utils.label_writer import (
+    LabelWriter,
+    smallest_label_dtype,
+    widen_zarr_array,
+)
+
+
+def test_smallest_label_dtype():
+    assert smallest_label_dtype(0) == "uint16"
+    assert smallest_label_dtype(65535) == "uint16"
+    assert smallest_label_dtype(65536) == "uint32"
+    assert smallest_label_dtype(10, min_dtype="uint32") == "uint32"
+
+
+def test_label_writer_widens(zarr_MIP_path):
+    omezarr = open_ome_zarr_container(str(zarr_MIP_path / "B" / "03" / "0"))
+    rois = omezarr.get_table("FOV_ROI_table").rois()
+    label_image = LabelWriter(omezarr, name="widened", overwrite=True)
+    assert label_image.dtype == "uint16"
+
+    patch = label_image.get_roi(rois[0])
+    label_image.set_roi(rois[0], patch=np.full_like(patch, 7, dtype=np.uint32))
+    label_image.set_roi(rois[1], patch=np.full_like(patch, 70000, dtype=np.uint32))
+    label_image.consolidate()
+    assert label_image.dtype == "uint32"
+
+    label = open_ome_zarr_container(str(zarr_MIP_path / "B" / "03" / "0")).get_label(
+        "widened"
+    )
+    assert label.dtype == "uint32"
+    assert np.all(label.get_roi(rois[0]) == 7)
+    assert np.all(label.get_roi(rois[1]) == 70000)
+
+
+def test_widen_zarr_array(tmp_path, monkeypatch):
+    store = zarr.DirectoryStore(str(tmp_path / "labels.zarr"))
+    data = np.zeros((20, 30), dtype=np.uint16)
+    data[:10, :10] = 7
+    array = zarr.create(
+        shape=data.shape, chunks=(10, 10), dtype="uint16", store=store, path="0"
+    )
+    array[:] = data
+    array.attrs["key"] = "value"
+
+    # interrupted before the swap: the original array is unchanged
+    def _interrupt(*args):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(zarr.storage, "rename", _interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            widen_zarr_array(array, "uint32")
+    original = zarr.open_array(store, path="0", mode="r")
+    assert original.dtype == np.uint16
+    np.testing.assert_array_equal(original[:], data)
+
+    widened = widen_zarr_array(array, "uint32")
+    assert widened.dtype == np.uint32
+    assert widened.attrs["key"] == "value"
+    np.testing.assert_array_equal(widened[:], data)
+    # only the widened array is left, without its empty chunks
+    assert sorted(zarr.open_group(store, mode="r").array_keys()) == ["0"]
+    assert widened.nchunks_initialized == 1
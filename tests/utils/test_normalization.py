@@ -0,0 +1,40 @@
+import numpy as np
+
+from zmb_fractal_tasks.utils.normalization import (
+    image_percentiles,
+    normalized_image,
+    rescale_intensity,
+)
+
+
+def test_image_percentiles():
+    rng = np.random.default_rng(0)
+    percentiles = [0, 0.1, 1, 33.3, 50, 99, 100]
+    for dtype in (np.uint8, np.uint16, np.int16, np.float32):
+        for size in (1, 2, 1001):
+            img = rng.integers(0, 200, size).astype(dtype)
+            np.testing.assert_array_equal(
+                image_percentiles(img, percentiles), np.percentile(img, percentiles)
+            )
+
+
+def test_normalized_image():
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 4000, (2, 16, 16), dtype=np.uint16)
+    original = img.copy()
+    normalized = normalized_image(img, lower_p=1, upper_p=99)
+    assert normalized.dtype == np.float32
+    np.testing.assert_array_equal(img, original)
+    lower, upper = np.percentile(img, [1, 99])
+    np.testing.assert_allclose(normalized, (img - lower) / (upper - lower), atol=1e-6)
+    inverted = normalized_image(img, invert=True, lower_p=1, upper_p=99)
+    np.testing.assert_allclose(inverted, 1 - normalized, atol=1e-6)
+    # constant images are set to zero
+    constant = normalized_image(np.full((4, 4), 7, dtype=np.uint16))
+    np.testing.assert_array_equal(constant, np.zeros((4, 4), dtype=np.float32))
+
+
+def test_rescale_intensity_in_place():
+    img = np.array([0.0, 5.0, 10.0], dtype=np.float32)
+    assert rescale_intensity(img, 5, 10, out=img) is img
+    np.testing.assert_array_equal(img, [-1.0, 0.0, 1.0])
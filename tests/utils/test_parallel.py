@@ -0,0 +1,26 @@
+import threading
+
+from zmb_fractal_tasks.utils.parallel import bounded_map
+
+
+def test_bounded_map():
+    assert list(bounded_map(lambda x: x**2, range(20), max_workers=4)) == [
+        x**2 for x in range(20)
+    ]
+    assert list(bounded_map(lambda x: x + 1, [1, 2], max_workers=1)) == [2, 3]
+
+
+def test_bounded_map_max_pending():
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, max
+
+    def _fn(x):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        return x
+
+    for _ in bounded_map(_fn, range(50), max_workers=4, max_pending=3):
+        with lock:
+            in_flight[0] -= 1
+    assert in_flight[1] <= 3
@@ -0,0 +1,48 @@
+import numpy as np
+from ngio import create_ome_zarr_from_array
+
+from zmb_fractal_tasks.utils.plate_scan import (
+    group_by_plate,
+    parse_zarr_url,
+    scan_images,
+)
+
+
+def test_parse_zarr_url():
+    assert parse_zarr_url("/data/my_plate.zarr/B/03/0") == (
+        "/data/my_plate.zarr",
+        "B",
+        3,
+    )
+    assert parse_zarr_url("/tmp/images/img.zarr") == (None, None, None)
+    assert parse_zarr_url("/tmp/images/img.zarr/") == (None, None, None)
+
+
+def test_scan_images(zarr_MIP_path):
+    zarr_url = str(zarr_MIP_path / "B" / "03" / "0")
+    image_infos = scan_images([zarr_url, zarr_url], tables=["FOV_ROI_table"])
+    assert len(image_infos) == 2
+    image_info = image_infos[0]
+    assert image_info.well_name == "B03"
+    assert image_info.plate_name == zarr_MIP_path.stem
+    assert image_info.wavelength_ids == image_info.image.wavelength_ids
+    assert len(image_info.tables["FOV_ROI_table"].rois()) > 0
+
+    plates = group_by_plate(image_infos)
+    assert list(plates) == [image_info.plate_url]
+    assert plates[image_info.plate_url] == image_infos
+
+
+def test_scan_images_not_in_plate(tmp_path):
+    zarr_urls = [str(tmp_path / f"img_{i}.zarr") for i in range(2)]
+    for zarr_url in zarr_urls:
+        create_ome_zarr_from_array(
+            zarr_url, np.zeros((1, 16, 16), dtype=np.uint16), xy_pixelsize=1.0
+        )
+    image_infos = scan_images(zarr_urls)
+    image_info = image_infos[0]
+    assert image_info.plate_url is None
+    assert image_info.plate_name is None
+    assert image_info.well_name is None
+    # each image is its own group
+    assert list(group_by_plate(image_infos)) == zarr_urls
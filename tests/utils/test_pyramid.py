@@ -0,0 +1,75 @@
+import numpy as np
+from ngio import open_ome_zarr_container
+
+from zmb_fractal_tasks.utils.pyramid import (
+    DirtyRegions,
+    is_pyramid_stale,
+    update_stale_pyramid,
+)
+
+
+def test_dirty_regions_consolidate(zarr_MIP_path):
+    omezarr = open_ome_zarr_container(str(zarr_MIP_path / "B" / "03" / "0"))
+    image = omezarr.get_image()
+    roi = omezarr.get_table("FOV_ROI_table").rois()[1]
+
+    dirty_regions = DirtyRegions(image)
+    patch = image.get_roi(roi, c=0, axes_order="czyx")
+    patch[:] = np.random.default_rng(0).integers(0, 1000, patch.shape)
+    image.set_roi(roi, patch=patch, c=0, axes_order="czyx")
+    dirty_regions.add_roi(roi, c=0)
+    dirty_regions.consolidate()
+    partial = [omezarr.get_image(path=p).get_array() for p in image.meta.paths]
+
+    image.consolidate()
+    full = [omezarr.get_image(path=p).get_array() for p in image.meta.paths]
+    for partial_level, full_level in zip(partial, full, strict=True):
+        np.testing.assert_array_equal(partial_level, full_level)
+
+
+def test_dirty_regions_consolidate_label(zarr_MIP_path):
+    omezarr = open_ome_zarr_container(str(zarr_MIP_path / "B" / "03" / "0"))
+    label = omezarr.get_label("nuclei")
+    roi = omezarr.get_table("FOV_ROI_table").rois()[0]
+
+    dirty_regions = DirtyRegions(label)
+    patch = label.get_roi(roi)
+    patch[patch > 0] += 1000
+    label.set_roi(roi, patch=patch)
+    dirty_regions.add_roi(roi)
+    dirty_regions.consolidate()
+    partial = [
+        omezarr.get_label("nuclei", path=p).get_array() for p in label.meta.paths
+    ]
+
+    label.consolidate()
+    full = [omezarr.get_label("nuclei", path=p).get_array() for p in label.meta.paths]
+    for partial_level, full_level in zip(partial, full, strict=True):
+        np.testing.assert_array_equal(partial_level, full_level)
+
+
+def test_dirty_regions_defer_consolidation(zarr_MIP_path):
+    omezarr = open_ome_zarr_container(str(zarr_MIP_path / "B" / "03" / "0"))
+    image = omezarr.get_image()
+    roi = omezarr.get_table("FOV_ROI_table").rois()[0]
+    coarse_before = omezarr.get_image(path=image.meta.paths[-1]).get_array()
+
+    dirty_regions = DirtyRegions(image)
+    patch = image.get_roi(roi, c=0, axes_order="czyx")
+    patch[:] = np.random.default_rng(0).integers(0, 1000, patch.shape)
+    image.set_roi(roi, patch=patch, c=0, axes_order="czyx")
+    dirty_regions.add_roi(roi, c=0)
+    dirty_regions.consolidate(defer=True)
+    assert is_pyramid_stale(image)
+    coarse = omezarr.get_image(path=image.meta.paths[-1])
+    np.testing.assert_array_equal(coarse.get_array(), coarse_before)
+
+    # the pyramid is built, when a coarser level is read
+    update_stale_pyramid(coarse)
+    assert not is_pyramid_stale(image)
+    deferred = [omezarr.get_image(path=p).get_array() for p in image.meta.paths]
+
+    image.consolidate()
+    full = [omezarr.get_image(path=p).get_array() for p in image.meta.paths]
+    for deferred_level, full_level in zip(deferred, full, strict=True):
+        np.testing.assert_array_equal(deferred_level, full_level)
@@ -0,0 +1,53 @@
+import numpy as np
+from ngio import create_ome_zarr_from_array
+
+from zmb_fractal_tasks.utils.relabel import (
+    add_label_offset,
+    load_label_offsets,
+    roi_label_offset,
+    save_label_offsets,
+)
+
+
+def test_add_label_offset():
+    labels = np.array([[0, 1], [2, 0]], dtype=np.uint16)
+    result = add_label_offset(labels, 10)
+    assert result is labels
+    np.testing.assert_array_equal(result, [[0, 11], [12, 0]])
+
+    # dtype is promoted if the new labels don't fit
+    labels = np.array([[0, 1], [2, 0]], dtype=np.uint16)
+    result = add_label_offset(labels, 70000)
+    assert result.dtype == np.uint32
+    np.testing.assert_array_equal(result, [[0, 70001], [70002, 0]])
+
+
+def test_save_label_offsets(tmp_path):
+    omezarr = create_ome_zarr_from_array(
+        str(tmp_path / "image.zarr"),
+        np.zeros((1, 16, 32), dtype=np.uint16),
+        xy_pixelsize=1.0,
+        axes_names="cyx",
+    )
+    label_image = omezarr.derive_label("objects")
+    assert load_label_offsets(label_image) == {}
+    offsets = {("FOV_0", None): (0, 3), ("FOV_1", None): (3, 5), ("FOV_0", 1): (8, 2)}
+    save_label_offsets(label_image, offsets)
+    # stored with the label image (e.g. for a later run)
+    label_image = omezarr.get_label("objects")
+    assert load_label_offsets(label_image) == offsets
+
+
+def test_roi_label_offset():
+    # new ROIs are appended after the largest label
+    offsets = {}
+    assert roi_label_offset(offsets, ("FOV_0", None), 3) == 0
+    assert roi_label_offset(offsets, ("FOV_1", None), 5) == 3
+    assert offsets == {("FOV_0", None): (0, 3), ("FOV_1", None): (3, 5)}
+    # labels fit into the previous range of the ROI
+    assert roi_label_offset(offsets, ("FOV_0", None), 2) == 0
+    assert offsets[("FOV_0", None)] == (0, 3)
+    # labels are appended after the largest label
+    assert roi_label_offset(offsets, ("FOV_0", None), 4) == 8
+    assert offsets == {("FOV_0", None): (8, 4), ("FOV_1", None): (3, 5)}
+    assert roi_label_offset(offsets, ("FOV_2", None), 1) == 12